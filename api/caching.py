@@ -0,0 +1,216 @@
+"""Caching of results that only change when the data is reloaded.
+
+The data of the API is only changed by the load commands
+(load_data2, load_stats_data, ...). At the end of every load,
+the command calls bump_generation, which increments the dataset generation
+(stored in the DatasetGeneration table) and records the number of rows
+of the tables of the paginated lists.
+
+Cache keys include the generation, so that everything that was cached
+before the load is no longer used afterwards (the old entries
+are evicted from the cache when they expire or when the cache is full).
+
+Paginator counts: every page of a paginated list (see api/pagination.py) returns
+the total number of results, which requires a COUNT(*) of the filtered
+(and often joined) queryset; for filtered lists and searches, this is often
+more expensive than fetching the page itself. cached_count therefore caches
+the count per generation and per normalized set of filter and search parameters
+(see get_count_key), for COUNT_CACHE_TIMEOUT seconds (see settings.py);
+during the first COUNT_CACHE_TIMEOUT seconds after a load, the count of an unfiltered list
+is the table size recorded by bump_generation (afterwards it is counted and cached
+like the other counts, so that changes made in the admin show up in all counts
+after at most COUNT_CACHE_TIMEOUT seconds).
+
+As long as no load command has recorded a generation (e.g., in the tests),
+the counts are not cached.
+
+The counts are stored in Django's cache (settings.CACHES).
+
+Responses: the data of the responses of the read endpoints is cached
+in the "responses" cache (an LRU cache of at most MAX_ENTRIES responses, see settings.CACHES),
+per generation and per normalized URL (see get_response_key), for the number
+of seconds given for the endpoint in settings.RESPONSE_CACHE_TIMEOUTS
+(cache_response for function views, CachedResponseMixin for class views).
+Responses that are larger than RESPONSE_CACHE_MAX_SIZE bytes (e.g., list pages
+with a large page_size) are not cached, so that the cache takes at most
+MAX_ENTRIES * RESPONSE_CACHE_MAX_SIZE bytes of memory.
+The data is cached after the throttling of the view and before rendering,
+so the throttles still apply and any renderer (JSON, browsable API) can be used.
+To serve cached responses without any database query, the current generation
+itself is cached for RESPONSE_CACHE_GENERATION_TIMEOUT seconds
+(so after a load, the old responses can still be served for that long).
+"""
+
+import datetime
+import functools
+import hashlib
+import json
+import pickle
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.utils import timezone
+from rest_framework.response import Response
+
+from api.models import authorMeta, textMeta, versionMeta, a2bRelation, TextReuseStats, DatasetGeneration
+
+
+# models whose number of rows is recorded in every generation:
+SIZED_MODELS = [authorMeta, textMeta, versionMeta, a2bRelation, TextReuseStats]
+
+# key of the current generation in the "responses" cache:
+GENERATION_CACHE_KEY = "generation"
+
+# query parameters that do not change the number of results of a list:
+NON_FILTER_PARAMS = ["page", "page_size", "cursor", "count", "ordering",
+                     "fields", "omit", "expand", "compact", "format"]
+
+
+def get_generation(using="default"):
+    """Return the current DatasetGeneration
+    (None if the data was never loaded with a load command)"""
+    return DatasetGeneration.objects.using(using).order_by("id").first()
+
+
+def bump_generation(using="default"):
+    """Record that the data has changed: increment the dataset generation
+    and record the current number of rows of the list tables;
+    return the new generation"""
+    table_sizes = {model._meta.db_table: model.objects.using(using).count() for model in SIZED_MODELS}
+    generation = get_generation(using) or DatasetGeneration(generation=0)
+    generation.generation += 1
+    generation.table_sizes = table_sizes
+    generation.save(using=using)
+    # (the load commands run in their own process, so this only takes effect
+    # immediately in the current process; see get_cached_generation_key):
+    caches["responses"].delete(GENERATION_CACHE_KEY)
+    print("Dataset generation:", generation.generation)
+    return generation
+
+
+def get_generation_key(generation):
+    # NB: the time of the update is included, so that the generations
+    # of a database that was deleted and loaded again (which start at 1 again)
+    # do not use the cached results of the old database:
+    return "{}.{}".format(generation.generation, int(generation.updated.timestamp() * 1000000))
+
+
+def get_count_key(request, search_param="search"):
+    """Return a key for the filter and search parameters of a list request
+    (the same for all pages, orderings etc. of the same results)"""
+    params = []
+    for name, values in request.query_params.lists():
+        if name in NON_FILTER_PARAMS:
+            continue
+        if name == search_param:
+            # like the SearchFilter, only use the last search parameter;
+            # the order of the search terms does not matter:
+            terms = values[-1].replace("\x00", "").replace(",", " ").split()
+            values = sorted(set(terms))
+        else:
+            # (the filters ignore empty values and leading and trailing spaces):
+            values = [value.strip() for value in values]
+        if any(values):
+            params.append((name, values))
+    return json.dumps([request.path, sorted(params)])
+
+
+def is_unfiltered(queryset):
+    """Check whether a queryset selects all rows of its table"""
+    query = queryset.query
+    return (not query.where.children and not query.extra_tables
+            and len(query.alias_map) <= 1 and not query.low_mark and query.high_mark is None)
+
+
+def cached_count(queryset, count_key):
+    """Return the number of objects in a queryset,
+    from the count cache if it was counted before in the current generation
+    (count_key: the key of the filter and search parameters, see get_count_key)"""
+    generation = get_generation(queryset.db)
+    if generation is None:
+        return queryset.count()
+    timeout = getattr(settings, "COUNT_CACHE_TIMEOUT", 60 * 60)
+    table = queryset.model._meta.db_table
+    if (is_unfiltered(queryset) and table in generation.table_sizes
+            and timezone.now() - generation.updated < datetime.timedelta(seconds=timeout)):
+        return generation.table_sizes[table]
+    key = "count:{}:{}".format(get_generation_key(generation),
+                               hashlib.md5(count_key.encode("utf-8")).hexdigest())
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+def get_cached_generation_key():
+    """Return the key of the current generation (see get_generation_key),
+    which is only looked up in the database every RESPONSE_CACHE_GENERATION_TIMEOUT seconds;
+    or None if the data was never loaded with a load command"""
+    response_cache = caches["responses"]
+    key = response_cache.get(GENERATION_CACHE_KEY)
+    if key is None:
+        generation = get_generation()
+        key = get_generation_key(generation) if generation else ""
+        response_cache.set(GENERATION_CACHE_KEY, key, getattr(settings, "RESPONSE_CACHE_GENERATION_TIMEOUT", 10))
+    return key or None
+
+
+def get_response_key(request):
+    """Return a key for the normalized URL of a request
+    (the order of the query parameters does not matter)"""
+    params = sorted((name, values) for name, values in request.query_params.lists())
+    # NB: the host is included because the pagination links are absolute URLs:
+    return json.dumps([request.scheme, request.get_host(), request.path, params])
+
+
+def cached_response(endpoint, request, get_response):
+    """Return the response of a GET request from the response cache,
+    or get it with get_response() and cache its data if it was successful
+    (endpoint: the name of the timeout of the endpoint in settings.RESPONSE_CACHE_TIMEOUTS)"""
+    timeout = getattr(settings, "RESPONSE_CACHE_TIMEOUTS", {}).get(endpoint)
+    if not timeout or request.method != "GET":
+        return get_response()
+    generation_key = get_cached_generation_key()
+    if generation_key is None:
+        return get_response()
+    key = "response:{}:{}".format(generation_key,
+                                  hashlib.md5(get_response_key(request).encode("utf-8")).hexdigest())
+    response_cache = caches["responses"]
+    data = response_cache.get(key)
+    if data is not None:
+        return Response(data)
+    response = get_response()
+    if response.status_code == 200 and isinstance(response, Response) and fits_response_cache(response.data):
+        response_cache.set(key, response.data, timeout)
+    return response
+
+
+def fits_response_cache(data):
+    """Check whether the data of a response is not larger than RESPONSE_CACHE_MAX_SIZE bytes
+    (the size of the pickled data, which is what the cache stores)"""
+    max_size = getattr(settings, "RESPONSE_CACHE_MAX_SIZE", None)
+    if max_size is None:
+        return True
+    return len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)) <= max_size
+
+
+def cache_response(endpoint):
+    """Decorator that caches the responses of a function view
+    (put it below the @api_view decorator)"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return cached_response(endpoint, request, lambda: view(request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+class CachedResponseMixin:
+    """Cache the responses of the GET requests of a class view
+    (cache_endpoint: the name of the timeout in settings.RESPONSE_CACHE_TIMEOUTS)"""
+    cache_endpoint = None
+
+    def get(self, request, *args, **kwargs):
+        return cached_response(self.cache_endpoint, request,
+                               lambda: super(CachedResponseMixin, self).get(request, *args, **kwargs))
@@ -0,0 +1,96 @@
+"""Facet counts of the versions (used by the /facets/ endpoint).
+
+The facet values of every version (the century of the author's death,
+status, annotation status, language, text type and tags) are copied
+into the VersionFacet and VersionFacetTag tables when the data is loaded
+(see refresh_facets), so that the counts for any set of filters
+can be computed with grouped aggregates on these tables,
+without joining the text and author tables (see get_facet_counts).
+"""
+
+import collections
+
+from django.db import transaction
+from django.db.models import Count
+
+from api.models import versionMeta, VersionFacet, VersionFacetTag
+
+
+# the single-valued facets (fields of the VersionFacet table):
+FACET_FIELDS = ["century", "status", "annotation_status", "version_lang", "text_type"]
+
+
+def get_century(date_ah):
+    """Return the (hijri) century of a date, e.g. 4 for 310 AH"""
+    if date_ah is None:
+        return None
+    return (date_ah - 1) // 100 + 1
+
+
+def split_tags(tags):
+    """Split the tags field of a version into a list of unique tags"""
+    tags = (tag.strip() for tag in (tags or "").split("::"))
+    return list(dict.fromkeys(tag for tag in tags if tag))
+
+
+def refresh_facets(batch_size=1000):
+    """Rebuild the VersionFacet and VersionFacetTag tables
+    from the versions, texts and authors in the database"""
+    versions = versionMeta.objects.values_list(
+        "id", "status", "annotation_status", "version_lang", "tags",
+        "text_id__text_type", "text_id__author_id__authorDateAH").order_by("id")
+    n_versions = 0
+    with transaction.atomic():
+        VersionFacetTag.objects.all().delete()
+        VersionFacet.objects.all().delete()
+        facets = []
+        tags = []
+        for pk, status, annotation_status, lang, version_tags, text_type, date_ah in versions.iterator():
+            facets.append(VersionFacet(
+                version_id=pk, century=get_century(date_ah), status=status,
+                annotation_status=annotation_status, version_lang=lang, text_type=text_type))
+            tags.extend(VersionFacetTag(version_id=pk, tag=tag) for tag in split_tags(version_tags))
+            if len(facets) == batch_size:
+                VersionFacet.objects.bulk_create(facets)
+                VersionFacetTag.objects.bulk_create(tags, batch_size=batch_size)
+                n_versions += len(facets)
+                facets, tags = [], []
+        VersionFacet.objects.bulk_create(facets)
+        VersionFacetTag.objects.bulk_create(tags, batch_size=batch_size)
+        n_versions += len(facets)
+    return n_versions
+
+
+def get_facet_counts(versions=None):
+    """Return the facet counts of a (filtered) versionMeta queryset
+    (or of all versions if versions is None).
+
+    The single-valued facets are counted in one grouped query
+    (one row per combination of facet values), which is then
+    folded into separate counts per facet; the tags are counted
+    in a second grouped query."""
+    facets = VersionFacet.objects.all()
+    tags = VersionFacetTag.objects.all()
+    if versions is not None:
+        ids = versions.values("id")
+        facets = facets.filter(version_id__in=ids)
+        tags = tags.filter(version_id__in=ids)
+
+    total = 0
+    counts = {field: collections.Counter() for field in FACET_FIELDS}
+    for row in facets.values(*FACET_FIELDS).annotate(n=Count("pk")).order_by():
+        total += row["n"]
+        for field in FACET_FIELDS:
+            counts[field][row[field]] += row["n"]
+    counts["tags"] = collections.Counter(dict(
+        tags.values_list("tag").annotate(n=Count("pk")).order_by()))
+
+    result = {"total": total}
+    for facet, counter in counts.items():
+        if facet == "century":
+            # order centuries chronologically (unknown dates last):
+            ranked = sorted(counter.items(), key=lambda item: (item[0] is None, item[0]))
+        else:
+            ranked = counter.most_common()
+        result[facet] = [{"value": value, "count": n} for value, n in ranked]
+    return result
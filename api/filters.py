@@ -1,7 +1,13 @@
 from django_filters import rest_framework as django_filters
+from django_filters.constants import EMPTY_VALUES
 from rest_framework import filters
 
-from .models import authorMeta, personName, textMeta, versionMeta, CorpusInsights
+from django.db.models import Q
+
+from .normalization import normalize
+from .search import norm_index_lookup
+
+from .models import authorMeta, personName, textMeta, versionMeta, CorpusInsights, a2bRelation, placeMeta, TextReuseStats
 
 class NumberInFilter(django_filters.BaseInFilter, django_filters.NumberFilter):
     """
@@ -17,6 +23,24 @@ class CharInFilter(django_filters.BaseInFilter, django_filters.CharFilter):
     """
     pass  # no need to do anything more than this!
 
+class NormalizedCharFilter(django_filters.CharFilter):
+    """
+    Create a filter that normalizes the filter value (see api/normalization.py)
+    and looks it up in a normalized field (e.g., author_lat_norm instead of author_lat),
+    so that "Abu Hanifa" matches "Abū Ḥanīfaŧ" and "الامام" matches "الإمام"
+
+    The substring is looked up in the FTS5 trigram index of the normalized fields
+    (see api/search.py); values shorter than 3 characters are matched with LIKE
+    """
+    def filter(self, qs, value):
+        value = normalize(value)
+        lookup = norm_index_lookup(qs.model, self.field_name, value, qs.db)
+        if lookup is None:
+            return super().filter(qs, value)
+        if self.distinct:
+            qs = qs.distinct()
+        return self.get_method(qs)(**lookup)
+
 class NumberRangeFilter(django_filters.BaseRangeFilter, django_filters.NumberFilter):
     """
     Create a filter that allows comma-separated range in API call
@@ -24,6 +48,31 @@ class NumberRangeFilter(django_filters.BaseRangeFilter, django_filters.NumberFil
     """
     pass # no need to do anything more than this!
 
+class AuthorSubqueryFilterMixin:
+    """
+    Look up the filter value in the authorMeta table in a subquery
+    (e.g., /version/all/?died_before_AH=300:
+    text_id__author_id__in=(SELECT id FROM authorMeta WHERE authorDateAH < 300)),
+    so that SQLite finds the authors with the index on the field, instead of
+    reading all versions and joining their texts and authors
+    (author_path: the path from the filtered model to the author)
+    """
+    def __init__(self, *args, author_path, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.author_path = author_path
+
+    def filter(self, qs, value):
+        if value in EMPTY_VALUES:
+            return qs
+        authors = super().filter(authorMeta.objects.all(), value)
+        return self.get_method(qs)(**{self.author_path + "__in": authors.values("pk")})
+
+class AuthorNumberFilter(AuthorSubqueryFilterMixin, django_filters.NumberFilter):
+    pass
+
+class AuthorNumberRangeFilter(AuthorSubqueryFilterMixin, NumberRangeFilter):
+    pass
+
 
 class authorFilter(django_filters.FilterSet):
     """Define the filter fields that can be looked up for authors
@@ -42,21 +91,21 @@ class authorFilter(django_filters.FilterSet):
     """
     #author_ar_contains = django_filters.CharFilter(field_name="author_ar", lookup_expr='icontains')
     #author_lat_contains = django_filters.CharFilter(field_name="author_lat", lookup_expr='icontains')
-    author_ar = django_filters.CharFilter(field_name="author_ar", lookup_expr='icontains')
-    author_lat = django_filters.CharFilter(field_name="author_lat", lookup_expr='icontains')
+    author_ar = NormalizedCharFilter(field_name="author_ar_norm", lookup_expr='contains')
+    author_lat = NormalizedCharFilter(field_name="author_lat_norm", lookup_expr='contains')
     died_after_AH = django_filters.NumberFilter(field_name="authorDateAH", lookup_expr="gt")  # /?died_after_AH=309
     died_before_AH = django_filters.NumberFilter(field_name="authorDateAH", lookup_expr="lt") # /?died_before_AH=311
     died_between_AH = NumberRangeFilter(field_name="authorDateAH", lookup_expr="range")       # /?died_between_AH=309,311
 
-    shuhra = django_filters.CharFilter(field_name="personName__shuhra", lookup_expr='icontains')
-    ism = django_filters.CharFilter(field_name="personName__ism", lookup_expr='icontains')
-    nasab = django_filters.CharFilter(field_name="personName__nasab", lookup_expr='icontains')
-    kunya = django_filters.CharFilter(field_name="personName__kunya", lookup_expr='icontains')
-    laqab = django_filters.CharFilter(field_name="personName__laqab", lookup_expr='icontains')
-    nisba = django_filters.CharFilter(field_name="personName__nisba", lookup_expr='icontains')
+    shuhra = NormalizedCharFilter(field_name="personName__shuhra_norm", lookup_expr='contains')
+    ism = NormalizedCharFilter(field_name="personName__ism_norm", lookup_expr='contains')
+    nasab = NormalizedCharFilter(field_name="personName__nasab_norm", lookup_expr='contains')
+    kunya = NormalizedCharFilter(field_name="personName__kunya_norm", lookup_expr='contains')
+    laqab = NormalizedCharFilter(field_name="personName__laqab_norm", lookup_expr='contains')
+    nisba = NormalizedCharFilter(field_name="personName__nisba_norm", lookup_expr='contains')
 
-    text_title_ar = django_filters.CharFilter(field_name="text__title_ar", lookup_expr='icontains')
-    text_title_lat = django_filters.CharFilter(field_name="text__title_lat", lookup_expr='icontains')
+    text_title_ar = NormalizedCharFilter(field_name="text__title_ar_norm", lookup_expr='contains')
+    text_title_lat = NormalizedCharFilter(field_name="text__title_lat_norm", lookup_expr='contains')
 
     class Meta:
         model = authorMeta
@@ -86,7 +135,7 @@ class versionFilter(django_filters.FilterSet):
     tok_count_lte = django_filters.NumberFilter(field_name="tok_length", lookup_expr="lte")
     tok_count_gte = django_filters.NumberFilter(field_name="tok_length", lookup_expr="gte")
     editor = django_filters.CharFilter(field_name="editor", lookup_expr='icontains')
-    editor_place = django_filters.CharFilter(field_name="editor_place", lookup_expr='icontains')
+    editor_place = django_filters.CharFilter(field_name="edition_place", lookup_expr='icontains')
     publisher = django_filters.CharFilter(field_name="publisher", lookup_expr='icontains')
     edition_date = django_filters.CharFilter(field_name="edition_date", lookup_expr='icontains')
     edition = django_filters.CharFilter(field_name="ed_info", lookup_expr='icontains')
@@ -95,20 +144,20 @@ class versionFilter(django_filters.FilterSet):
     status = CharInFilter(field_name="status", lookup_expr='in')
     annotation_status = CharInFilter(field_name="annotation_status", lookup_expr='in')
 
-    title_ar = django_filters.CharFilter(field_name="text_id__title_ar", lookup_expr='icontains')
-    title_lat = django_filters.CharFilter(field_name="text_id__title_lat", lookup_expr='icontains')
-
-    author_ar = django_filters.CharFilter(field_name="text_id__author_id__author_ar", lookup_expr='icontains')
-    author_lat = django_filters.CharFilter(field_name="text_id__author_id__author_lat", lookup_expr='icontains')
-    died_after_AH = django_filters.NumberFilter(field_name="text_id__author_id__authorDateAH", lookup_expr="gt")
-    died_before_AH = django_filters.NumberFilter(field_name="text_id__author_id__authorDateAH", lookup_expr="lt")
-    died_between_AH = NumberRangeFilter(field_name="text_id__author_id__authorDateAH", lookup_expr="range") # /?died_between_AH=309,311
-    shuhra = django_filters.CharFilter(field_name="text_id__author_id__personName__shuhra", lookup_expr='icontains')
-    ism = django_filters.CharFilter(field_name="text_id__author_id__personName__ism", lookup_expr='icontains')
-    nasab = django_filters.CharFilter(field_name="text_id__author_id__personName__nasab", lookup_expr='icontains')
-    kunya = django_filters.CharFilter(field_name="text_id__author_id__personName__kunya", lookup_expr='icontains')
-    laqab = django_filters.CharFilter(field_name="text_id__author_id__personName__laqab", lookup_expr='icontains')
-    nisba = django_filters.CharFilter(field_name="text_id__author_id__personName__nisba", lookup_expr='icontains')
+    title_ar = NormalizedCharFilter(field_name="text_id__title_ar_norm", lookup_expr='contains')
+    title_lat = NormalizedCharFilter(field_name="text_id__title_lat_norm", lookup_expr='contains')
+
+    author_ar = NormalizedCharFilter(field_name="text_id__author_id__author_ar_norm", lookup_expr='contains')
+    author_lat = NormalizedCharFilter(field_name="text_id__author_id__author_lat_norm", lookup_expr='contains')
+    died_after_AH = AuthorNumberFilter(author_path="text_id__author_id", field_name="authorDateAH", lookup_expr="gt")
+    died_before_AH = AuthorNumberFilter(author_path="text_id__author_id", field_name="authorDateAH", lookup_expr="lt")
+    died_between_AH = AuthorNumberRangeFilter(author_path="text_id__author_id", field_name="authorDateAH", lookup_expr="range") # /?died_between_AH=309,311
+    shuhra = NormalizedCharFilter(field_name="text_id__author_id__personName__shuhra_norm", lookup_expr='contains')
+    ism = NormalizedCharFilter(field_name="text_id__author_id__personName__ism_norm", lookup_expr='contains')
+    nasab = NormalizedCharFilter(field_name="text_id__author_id__personName__nasab_norm", lookup_expr='contains')
+    kunya = NormalizedCharFilter(field_name="text_id__author_id__personName__kunya_norm", lookup_expr='contains')
+    laqab = NormalizedCharFilter(field_name="text_id__author_id__personName__laqab_norm", lookup_expr='contains')
+    nisba = NormalizedCharFilter(field_name="text_id__author_id__personName__nisba_norm", lookup_expr='contains')
 
     class Meta:
         model = versionMeta
@@ -133,25 +182,25 @@ class textFilter(django_filters.FilterSet):
     """
     #author_ar_contains = django_filters.CharFilter(field_name="author_ar", lookup_expr='icontains')
     #author_lat_contains = django_filters.CharFilter(field_name="author_lat", lookup_expr='icontains')
-    title_ar = django_filters.CharFilter(field_name="text_id__title_ar", lookup_expr='icontains')
-    title_lat = django_filters.CharFilter(field_name="text_id__title_lat", lookup_expr='icontains')
+    title_ar = NormalizedCharFilter(field_name="title_ar_norm", lookup_expr='contains')
+    title_lat = NormalizedCharFilter(field_name="title_lat_norm", lookup_expr='contains')
     text_type = django_filters.CharFilter(field_name="text_type", lookup_expr='icontains')
     tag = django_filters.CharFilter(field_name="tags", lookup_expr='icontains')
 
-    author_ar = django_filters.CharFilter(field_name="author_id__author_ar", lookup_expr='icontains')
-    author_lat = django_filters.CharFilter(field_name="author_id__author_lat", lookup_expr='icontains')
+    author_ar = NormalizedCharFilter(field_name="author_id__author_ar_norm", lookup_expr='contains')
+    author_lat = NormalizedCharFilter(field_name="author_id__author_lat_norm", lookup_expr='contains')
     author_died_after_AH = django_filters.NumberFilter(field_name="author_id__authorDateAH", lookup_expr="gt")  # /?died_after_AH=309
     author_died_before_AH = django_filters.NumberFilter(field_name="author_id__authorDateAH", lookup_expr="lt") # /?died_before_AH=311
     author_died_between_AH = NumberRangeFilter(field_name="author_id__authorDateAH", lookup_expr="range")       # /?died_between_AH=309,311
 
-    author_shuhra = django_filters.CharFilter(field_name="author_id__personName__shuhra", lookup_expr='icontains')
-    author_ism = django_filters.CharFilter(field_name="author_id__personName__ism", lookup_expr='icontains')
-    author_nasab = django_filters.CharFilter(field_name="author_id__personName__nasab", lookup_expr='icontains')
-    author_kunya = django_filters.CharFilter(field_name="author_id__personName__kunya", lookup_expr='icontains')
-    author_laqab = django_filters.CharFilter(field_name="author_id__personName__laqab", lookup_expr='icontains')
-    author_nisba = django_filters.CharFilter(field_name="author_id__personName__nisba", lookup_expr='icontains')
+    author_shuhra = NormalizedCharFilter(field_name="author_id__personName__shuhra_norm", lookup_expr='contains')
+    author_ism = NormalizedCharFilter(field_name="author_id__personName__ism_norm", lookup_expr='contains')
+    author_nasab = NormalizedCharFilter(field_name="author_id__personName__nasab_norm", lookup_expr='contains')
+    author_kunya = NormalizedCharFilter(field_name="author_id__personName__kunya_norm", lookup_expr='contains')
+    author_laqab = NormalizedCharFilter(field_name="author_id__personName__laqab_norm", lookup_expr='contains')
+    author_nisba = NormalizedCharFilter(field_name="author_id__personName__nisba_norm", lookup_expr='contains')
 
-    related_text_title_lat = django_filters.CharFilter(field_name="related_texts__title_lat", lookup_expr='icontains')
+    related_text_title_lat = NormalizedCharFilter(field_name="related_texts__title_lat_norm", lookup_expr='contains')
 
 
     class Meta:
@@ -160,25 +209,70 @@ class textFilter(django_filters.FilterSet):
         #fields = ["author_uri", "author_lat", "author_ar", "authorDateAH"]
         fields = ["text_uri", "id"]
 
+class relationFilter(django_filters.FilterSet):
+    """Define the filter fields that can be looked up for relations
+
+    E.g.,
+    http://127.0.0.1:8000/relations/all/?relation_type=sharh,tarjama
+    http://127.0.0.1:8000/relations/all/?uri=0150AbuHanifa.Wasiyya  (source or destination)
+    http://127.0.0.1:8000/relations/all/?source_uri=0786IbnMuhammadBabarti.SharhWasiyyatAbiHanifa
+    http://127.0.0.1:8000/relations/all/?dest_uri=0150AbuHanifa
+
+    """
+    relation_type = CharInFilter(field_name="relation_type__name", lookup_expr='in')
+    source_uri = django_filters.CharFilter(method="filter_source_uri")
+    dest_uri = django_filters.CharFilter(method="filter_dest_uri")
+    uri = django_filters.CharFilter(method="filter_uri")
+
+    def filter_source_uri(self, queryset, name, value):
+        return queryset.filter(side_uri_q("a", value))
+
+    def filter_dest_uri(self, queryset, name, value):
+        return queryset.filter(side_uri_q("b", value))
+
+    def filter_uri(self, queryset, name, value):
+        return queryset.filter(side_uri_q("a", value) | side_uri_q("b", value))
+
+    class Meta:
+        model = a2bRelation
+        fields = ["id"]
+
+
+def side_uri_q(side, uri):
+    """Build a filter for the relations in which the A side (side="a")
+    or the B side (side="b") is the person, text or place with this URI
+
+    (the ids of the person, text and place are looked up in subqueries,
+    so that the relations can be found with the indexes on the foreign keys,
+    instead of joining all persons, texts and places to all relations)"""
+    return Q(**{"person_{}_id__in".format(side): authorMeta.objects.filter(author_uri=uri).values("pk")}) \
+        | Q(**{"text_{}_id__in".format(side): textMeta.objects.filter(text_uri=uri).values("pk")}) \
+        | Q(**{"place_{}_id__in".format(side): placeMeta.objects.filter(thuraya_uri=uri).values("pk")})
+
+
 class textReuseFilter(django_filters.FilterSet):
     book_1 = django_filters.CharFilter(field_name="book_1", lookup_expr='icontains')
-    book_1 = django_filters.CharFilter(field_name="book_2", lookup_expr='icontains')
+    book_2 = django_filters.CharFilter(field_name="book_2", lookup_expr='icontains')
     instances_count_gt = django_filters.NumberFilter(field_name="instances_count", lookup_expr="gt")
     instances_count_lt = django_filters.NumberFilter(field_name="instances_count", lookup_expr="lt")
-    instances_count_range = django_filters.NumberFilter(field_name="instances_count", lookup_expr="range")
+    instances_count_range = NumberRangeFilter(field_name="instances_count", lookup_expr="range")
 
     book1_word_match_gt = django_filters.NumberFilter(field_name="book1_word_match", lookup_expr="gt")
     book1_word_match_lt = django_filters.NumberFilter(field_name="book1_word_match", lookup_expr="lt")
-    book1_word_match_range = django_filters.NumberFilter(field_name="book1_word_match", lookup_expr="range")
+    book1_word_match_range = NumberRangeFilter(field_name="book1_word_match", lookup_expr="range")
 
     book2_word_match_gt = django_filters.NumberFilter(field_name="book2_word_match", lookup_expr="gt")
     book2_word_match_lt = django_filters.NumberFilter(field_name="book2_word_match", lookup_expr="lt")
-    book2_word_match_range = django_filters.NumberFilter(field_name="book2_word_match", lookup_expr="range")
+    book2_word_match_range = NumberRangeFilter(field_name="book2_word_match", lookup_expr="range")
 
     book1_match_book2_per_per_gt = django_filters.NumberFilter(field_name="book1_match_book2_per", lookup_expr="gt")
     book1_match_book2_per_per_lt = django_filters.NumberFilter(field_name="book1_match_book2_per", lookup_expr="lt")
-    book1_match_book2_per_per_range = django_filters.NumberFilter(field_name="book1_match_book2_per", lookup_expr="range")
+    book1_match_book2_per_per_range = NumberRangeFilter(field_name="book1_match_book2_per", lookup_expr="range")
 
     book2_match_book1_per_gt = django_filters.NumberFilter(field_name="book2_match_book1_per", lookup_expr="gt")
     book2_match_book1_per_lt = django_filters.NumberFilter(field_name="book2_match_book1_per", lookup_expr="lt")
-    book2_match_book1_per_range = django_filters.NumberFilter(field_name="book2_match_book1_per", lookup_expr="range")
+    book2_match_book1_per_range = NumberRangeFilter(field_name="book2_match_book1_per", lookup_expr="range")
+
+    class Meta:
+        model = TextReuseStats
+        fields = ["id"]
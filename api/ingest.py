@@ -0,0 +1,995 @@
+"""Shared functions for loading the metadata into the database.
+
+The metadata csv is read as a stream of typed MetadataRecord objects
+(see iter_records), which are grouped into fixed-size chunks
+and written to the database chunk by chunk (see MetadataWriter),
+so that the whole file never needs to be kept in memory.
+
+With workers > 1, the conversion of the csv rows into records
+is done in a pool of worker processes (see map_chunks).
+
+MetadataSync compares the records with the content hashes
+stored in the database, and only writes the rows that changed
+(incremental or "delta" loading).
+
+The pairwise text reuse statistics are read in the same way
+(see iter_stats_rows) and inserted in large batches (see load_stats_rows).
+
+To avoid serving half-loaded data while loading, the data can be loaded
+into a copy of the (SQLite) database (see use_database and build_shadow_database),
+which then replaces the live database in one atomic step (see swap_database).
+
+Long loads record their progress in an IngestCheckpoint, which is saved
+in the same transaction as each chunk of rows, so that a load that crashed
+can be resumed after the last committed chunk (see start_checkpoint).
+
+The writers also keep the corpus statistics (CorpusInsights) up to date,
+by applying the changes of every chunk to them (see api.insights).
+
+All input files can be compressed (.gz, .bz2 or .xz); they are decompressed
+on the fly while they are read (see open_input), and the JSON files
+are parsed one item at a time (see iter_json_items).
+
+Used by the load_data, load_data2 and load_stats_data management commands.
+"""
+
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import decimal
+import gzip
+import hashlib
+import itertools
+import json
+import lzma
+import operator
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+import django
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction
+
+from api.insights import InsightsDelta
+from api.instrumentation import IngestReport
+from api.models import authorMeta, textMeta, versionMeta, personName, TextReuseStats, IngestCheckpoint
+from api.normalization import set_normalized_fields
+
+
+# functions to open compressed files, by file extension:
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+def open_input(filename, newline=None):
+    """Open an (optionally compressed) UTF-8 input file for reading as text.
+
+    Files ending in .gz, .bz2 or .xz are decompressed while they are read,
+    without writing a decompressed copy to disk."""
+    ext = os.path.splitext(filename)[1].lower()
+    opener = COMPRESSED_OPENERS.get(ext, open)
+    return opener(filename, mode="rt", encoding="utf-8", newline=newline)
+
+
+class JSONStream:
+    """Read JSON values one at a time from a text file, in blocks
+    (used by iter_json_items)"""
+
+    def __init__(self, file, block_size=1 << 16):
+        self.file = file
+        self.block_size = block_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        """Add the next block of the file to the buffer
+        (dropping the part that has been parsed already)"""
+        block = self.file.read(self.block_size)
+        self.eof = not block
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """Skip whitespace and return the next character ("" at the end of the file)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                return ""
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of chars"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Invalid JSON: expected one of {!r}, found {!r}".format(chars, char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """Parse and return the next JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value at the end of the buffer (e.g., a number) may continue in the next block:
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+
+def iter_json_items(filename, block_size=1 << 16):
+    """Yield the (key, value) pairs of the top-level object of a JSON file
+    one at a time, instead of loading the whole file with json.load
+    (the file is read in blocks of block_size characters)"""
+    with open_input(filename) as file:
+        stream = JSONStream(file, block_size)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.decode()
+            stream.expect(":")
+            yield key, stream.decode()
+            if stream.expect(",}") == "}":
+                return
+
+
+METADATA_FIELDNAMES = [
+    'versionUri', 'date', 'author_ar', 'author_lat', 'book', 'title_ar', 'title_lat', 'ed_info', 'id',
+    'status', 'tok_length', 'url', 'tags', 'author_from_uri', 'author_lat_shuhra', 'author_lat_full_name', 'char_length']
+
+
+class MetadataRecord(NamedTuple):
+    """One (parsed) row of the metadata csv file"""
+    version_uri: str
+    version_lang: str
+    author_uri: str
+    date: str
+    author_ar: str
+    author_lat: str
+    text_uri: str
+    title_ar: str
+    title_lat: str
+    ed_info: str
+    version_id: str
+    status: str
+    tok_length: int
+    url: str
+    tags: str
+    author_from_uri: str
+    author_lat_shuhra: str
+    author_lat_full_name: str
+    char_length: int
+    annotation_status: str
+    type: str
+
+
+def check_null(value):
+    if value == '':
+        return 0
+    else:
+        return value
+
+
+def get_annotation_status(value):
+    if value == 'mARkdown' or value == 'completed' or value == 'inProgress':
+        return value
+    else:
+        return 'notYetAnnotated'
+
+
+def get_version_lang(version_uri):
+    try:
+        return re.findall("-([a-z]{3})", version_uri)[0]
+    except:
+        return ""
+
+
+def get_uri_type(uri):
+    """Book URIs consist of at least two parts (author.book), person URIs of one"""
+    if len(uri.split(".")) > 1:
+        return "book"
+    return "person"
+
+
+def ah2ce(date):
+    """convert AH date to CE date"""
+    return 622 + (int(date) * 354 / 365.25)
+
+
+def ce2ah(date):
+    """convert CE date to AH date"""
+    return (int(date) - 622) * 365.25 / 354
+
+
+def get_authorDateAH(date, book_type):
+    if book_type == "document":
+        return ce2ah(date)
+    return int(date)
+
+
+def get_authorDateCE(date, book_type):
+    if book_type != "document":
+        return ah2ce(date)
+    return int(date)
+
+
+def make_record(data):
+    """Convert a row of the metadata csv (a dictionary) into a MetadataRecord"""
+    return MetadataRecord(
+        version_uri=data['versionUri'],
+        version_lang=get_version_lang(data['versionUri']),
+        author_uri=data['versionUri'].split(".")[0],
+        date=data['date'],
+        author_ar=data['author_ar'],
+        author_lat=data['author_lat'],
+        text_uri=data['book'],
+        title_ar=data['title_ar'],
+        title_lat=data['title_lat'],
+        ed_info=data['ed_info'],
+        version_id=data['id'],
+        status=data['status'],
+        tok_length=int(check_null(data['tok_length'])),
+        url=data['url'],
+        tags=data['tags'],
+        author_from_uri=data['author_from_uri'],
+        author_lat_shuhra=data['author_lat_shuhra'],
+        author_lat_full_name=data['author_lat_full_name'],
+        char_length=int(check_null(data['char_length'])),
+        annotation_status=get_annotation_status(data['url'].split('.')[-1]),
+        type=data.get("type") or "book",
+    )
+
+
+def make_records(rows):
+    """Convert a list of csv rows into a list of MetadataRecords
+    (this function is run in the worker processes, see iter_records)"""
+    return [make_record(data) for data in rows]
+
+
+def iter_rows(filename, skip=0):
+    """Read the metadata csv file and yield each row as a dictionary
+    (skipping the first `skip` rows after the header)"""
+    with open_input(filename) as f:
+        reader = csv.DictReader(f, fieldnames=METADATA_FIELDNAMES, delimiter='\t')
+        next(reader)  # skip the header row
+        for data in itertools.islice(reader, skip, None):
+            yield data
+
+
+def iter_records(filename, workers=1, chunk_size=1000, skip=0):
+    """Read the metadata csv file one row at a time
+    and yield a MetadataRecord for each row
+    (skipping the first `skip` rows, e.g. when resuming a load).
+
+    If workers > 1, the file is split into chunks of chunk_size rows,
+    which are converted into records in a pool of worker processes;
+    the records are still yielded in the order of the file.
+    """
+    if workers > 1:
+        chunks = iter_chunks(iter_rows(filename, skip), chunk_size)
+        for records in map_chunks(make_records, chunks, workers):
+            yield from records
+    else:
+        for data in iter_rows(filename, skip):
+            yield make_record(data)
+
+
+def map_chunks(func, chunks, workers):
+    """Apply func to every chunk in a pool of worker processes
+    and yield the results in the original order of the chunks.
+
+    Unlike Pool.imap, this does not read the whole input at once:
+    at most 2 chunks per worker are in progress at any time,
+    so memory use stays bounded.
+    """
+    pending = collections.deque()
+    # django.setup is needed for the worker processes on platforms
+    # that start them with "spawn" instead of "fork" (e.g., Windows)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+        for chunk in chunks:
+            pending.append(pool.submit(func, chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_chunks(iterable, chunk_size):
+    """Group the items of an iterable into lists of (at most) chunk_size items"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def prefetch(iterable, depth=2):
+    """Consume an iterable in a background thread.
+
+    At most `depth` items are read ahead, so that parsing the next chunk
+    of the input overlaps with writing the current chunk to the database,
+    while memory use stays bounded.
+    """
+    q = queue.Queue(maxsize=depth)
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                q.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            q.put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item = q.get()
+        if item is done:
+            break
+        yield item
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+# the record fields that are stored in each table
+# (if the hash of these fields changes, the row is updated in delta mode):
+AUTHOR_HASH_FIELDS = ("author_uri", "author_ar", "author_lat", "date", "type")
+TEXT_HASH_FIELDS = ("text_uri", "author_uri", "title_ar", "title_lat", "type", "tags")
+VERSION_HASH_FIELDS = ("version_id", "version_uri", "text_uri", "char_length", "tok_length", "url",
+                       "ed_info", "tags", "annotation_status", "status", "version_lang")
+
+
+def content_hash(record, fields):
+    """Calculate a hash of the values of the given record fields"""
+    s = "\t".join(str(getattr(record, field)) for field in fields)
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+def make_author(record):
+    """Create an (unsaved) authorMeta object from a record"""
+    # NB: bulk_create does not call save(), so the normalized fields are set here
+    return set_normalized_fields(authorMeta(
+        author_uri=record.author_uri,
+        author_ar=record.author_ar,
+        author_lat=record.author_lat,
+        date=record.date,
+        authorDateAH=get_authorDateAH(record.date, record.type),
+        authorDateCE=get_authorDateCE(record.date, record.type),
+        authorDateString=str(record.date),
+        content_hash=content_hash(record, AUTHOR_HASH_FIELDS)
+    ))
+
+
+def make_text(record):
+    """Create an (unsaved) textMeta object from a record
+    (without author: the author_id must be set before saving)"""
+    return set_normalized_fields(textMeta(
+        text_uri=record.text_uri,
+        title_ar=record.title_ar,
+        title_lat=record.title_lat,
+        text_type=record.type,
+        tags=record.tags,
+        content_hash=content_hash(record, TEXT_HASH_FIELDS)
+    ))
+
+
+def make_version(record):
+    """Create an (unsaved) versionMeta object from a record
+    (without text: the text_id must be set before saving)"""
+    return versionMeta(
+        version_id=record.version_id,
+        version_uri=record.version_uri,
+        char_length=record.char_length,
+        tok_length=record.tok_length,
+        url=record.url,
+        ed_info=record.ed_info,
+        tags=record.tags,
+        annotation_status=record.annotation_status,
+        status=record.status,
+        version_lang=record.version_lang,
+        content_hash=content_hash(record, VERSION_HASH_FIELDS)
+    )
+
+
+def make_person_names(author_id, record):
+    """Create (unsaved) personName objects for a new author.
+
+    name elements are not separately in the metadata file as it is now;
+    loading bogus data for now!"""
+    names = []
+    for lan in ("ar", "lat"):
+        name_elements = re.split(" *:: *", getattr(record, 'author_'+lan))
+        while len(name_elements) < 5:
+            name_elements.append("")
+        random.shuffle(name_elements)
+        names.append(set_normalized_fields(personName(
+            author_id_id=author_id,
+            language=lan,
+            shuhra=name_elements[0],
+            kunya=name_elements[1],
+            ism=name_elements[2],
+            laqab=name_elements[3],
+            nisba=name_elements[4],
+        )))
+    return names
+
+
+def fetch_ids(model, field, keys, batch_size=500):
+    """Return a {key: pk} dictionary for the rows of `model`
+    whose `field` value is in `keys` (queried in batches
+    to stay below SQLite's limit on the number of query parameters)"""
+    keys = list(keys)
+    ids = dict()
+    for i in range(0, len(keys), batch_size):
+        lookup = {field + "__in": keys[i:i+batch_size]}
+        ids.update(model.objects.filter(**lookup).values_list(field, "id"))
+    return ids
+
+
+class MetadataWriter:
+    """Write chunks of MetadataRecords to the database with bulk_create.
+
+    Instead of querying the database for every row, the author and text
+    primary keys are kept in in-memory maps (author_uri -> pk, text_uri -> pk),
+    so that every chunk is written in a handful of INSERT statements.
+
+    NB: author_uri is unique in the authorMeta table, so only one
+    author record is created for each Anonymous author URI.
+    """
+
+    def __init__(self, batch_size=1000, report=None):
+        self.batch_size = batch_size
+        self.report = report or IngestReport(None)
+        # build the URI -> pk maps from what is already in the database:
+        self.author_ids = dict(authorMeta.objects.values_list("author_uri", "id"))
+        self.text_ids = dict(textMeta.objects.values_list("text_uri", "id"))
+        self.seen_versions = set(versionMeta.objects.values_list("version_id", flat=True))
+        self.counts = dict(rows=0, authors=0, texts=0, versions=0, names=0, skipped=0)
+
+    def write(self, records):
+        """Write one chunk of records to the database"""
+        new_authors = dict()   # author_uri: (authorMeta object, record)
+        new_texts = dict()     # text_uri: (textMeta object, author_uri)
+        new_versions = []      # (versionMeta object, text_uri)
+        for record in records:
+            self.counts["rows"] += 1
+            author_uri = record.author_uri
+            if author_uri not in self.author_ids and author_uri not in new_authors:
+                new_authors[author_uri] = (make_author(record), record)
+
+            text_uri = record.text_uri
+            if text_uri not in self.text_ids and text_uri not in new_texts:
+                new_texts[text_uri] = (make_text(record), author_uri)
+
+            if record.version_id in self.seen_versions:
+                # duplicate version_id: keep the first record
+                self.counts["skipped"] += 1
+                continue
+            self.seen_versions.add(record.version_id)
+            version = make_version(record)
+            new_versions.append((version, text_uri))
+
+        # authors
+        # (SQLite does not return the primary keys of bulk-created rows,
+        # so these are fetched with a separate query):
+        with self.report.phase("authors") as phase:
+            authorMeta.objects.bulk_create(
+                [am for am, record in new_authors.values()], batch_size=self.batch_size)
+            self.author_ids.update(fetch_ids(authorMeta, "author_uri", new_authors))
+            phase["rows"] += len(new_authors)
+
+        # texts:
+        with self.report.phase("texts") as phase:
+            for item, author_uri in new_texts.values():
+                item.author_id_id = self.author_ids[author_uri]
+            textMeta.objects.bulk_create(
+                [item for item, author_uri in new_texts.values()], batch_size=self.batch_size)
+            self.text_ids.update(fetch_ids(textMeta, "text_uri", new_texts))
+            phase["rows"] += len(new_texts)
+
+        # versions:
+        with self.report.phase("versions") as phase:
+            for version, text_uri in new_versions:
+                version.text_id_id = self.text_ids[text_uri]
+            versionMeta.objects.bulk_create(
+                [version for version, text_uri in new_versions], batch_size=self.batch_size)
+            phase["rows"] += len(new_versions)
+
+        # names of the new authors:
+        with self.report.phase("names") as phase:
+            names = []
+            for author_uri, (am, record) in new_authors.items():
+                names.extend(make_person_names(self.author_ids[author_uri], record))
+            personName.objects.bulk_create(names, batch_size=self.batch_size)
+            phase["rows"] += len(names)
+
+        # corpus statistics:
+        with self.report.phase("insights"):
+            insights = InsightsDelta()
+            insights.authors = len(new_authors)
+            insights.books = len(new_texts)
+            insights.add_versions((v.version_uri, v.tok_length, v.status) for v, text_uri in new_versions)
+            insights.apply()
+
+        self.counts["authors"] += len(new_authors)
+        self.counts["texts"] += len(new_texts)
+        self.counts["versions"] += len(new_versions)
+        self.counts["names"] += len(names)
+
+
+def start_checkpoint(command, filename, resume=False):
+    """Return the IngestCheckpoint for a load of filename by command.
+
+    If resume is True, the checkpoint of the unfinished previous load
+    is returned (its offset is the number of input rows to skip);
+    otherwise, a new checkpoint is created (which takes over the indexes
+    that the unfinished load dropped, see load_stats_rows).
+    """
+    filename = os.path.abspath(filename)
+    if resume:
+        try:
+            checkpoint = IngestCheckpoint.objects.get(command=command)
+        except IngestCheckpoint.DoesNotExist:
+            raise CommandError("There is no unfinished {} load to resume".format(command))
+        if checkpoint.filename != filename:
+            raise CommandError("Cannot resume: the unfinished {} load was loading {}".format(
+                command, checkpoint.filename))
+        print("Resuming the load of {} after row {}".format(filename, checkpoint.offset))
+        return checkpoint
+    state = dict()
+    stale = IngestCheckpoint.objects.filter(command=command).first()
+    if stale is not None and stale.state.get("indexes"):
+        # the unfinished load dropped indexes that it did not rebuild;
+        # keep their SQL, so that this load rebuilds them:
+        state["indexes"] = stale.state["indexes"]
+    IngestCheckpoint.objects.filter(command=command).delete()
+    return IngestCheckpoint.objects.create(command=command, filename=filename, state=state)
+
+
+def finish_checkpoint(checkpoint):
+    """Delete the checkpoint of a load that finished successfully"""
+    checkpoint.delete()
+
+
+@contextlib.contextmanager
+def batch_transaction(checkpoint=None):
+    """Without a checkpoint, run the whole load in one transaction;
+    with a checkpoint, commit every chunk in a transaction of its own.
+
+    Yields the context manager to use for every chunk."""
+    if checkpoint is None:
+        with transaction.atomic():
+            yield contextlib.nullcontext
+    else:
+        yield transaction.atomic
+
+
+def fetch_version_stats(pks, batch_size=500):
+    """Return the (version_uri, tok_length, status) of the versions with the given primary keys
+    (used to remove the old values of changed or deleted versions from the corpus statistics)"""
+    pks = list(pks)
+    stats = []
+    for i in range(0, len(pks), batch_size):
+        stats.extend(versionMeta.objects.filter(id__in=pks[i:i+batch_size]).values_list(
+            "version_uri", "tok_length", "status"))
+    return stats
+
+
+def bulk_load_records(records, batch_size=1000, report=None, checkpoint=None):
+    """Load a stream of MetadataRecords into the database in chunks
+    of batch_size records, inside one transaction.
+
+    If a checkpoint (IngestCheckpoint) is given, every chunk is committed
+    in its own transaction, together with the number of records
+    that have been loaded so far, so that the load can be resumed.
+
+    The records are read in a background thread (see prefetch),
+    so that parsing the input overlaps with the database writes
+    (the "parse" phase in the report therefore overlaps with the other phases).
+    """
+    print("START BULK LOADING RECORDS")
+    report = report or IngestReport(None)
+    start = time.perf_counter()
+    writer = MetadataWriter(batch_size=batch_size, report=report)
+    with batch_transaction(checkpoint) as chunk_transaction:
+        for chunk in prefetch(iter_chunks(report.timed_iter("parse", records), batch_size)):
+            with chunk_transaction():
+                writer.write(chunk)
+                if checkpoint:
+                    checkpoint.advance(len(chunk))
+
+    elapsed = time.perf_counter() - start
+    counts = writer.counts
+    print("Loaded {} records ({} authors, {} texts, {} versions, {} names) in {:.2f} seconds ({:.0f} rows/sec)".format(
+        counts["rows"], counts["authors"], counts["texts"], counts["versions"], counts["names"],
+        elapsed, counts["rows"] / elapsed if elapsed else 0))
+    if counts["skipped"]:
+        print("Skipped {} records with a duplicate version_id".format(counts["skipped"]))
+    return counts
+
+
+# fields that are copied to existing rows if their content hash changed:
+AUTHOR_UPDATE_FIELDS = ["author_ar", "author_lat", "date", "authorDateAH", "authorDateCE",
+                        "authorDateString", "author_ar_norm", "author_lat_norm", "content_hash"]
+TEXT_UPDATE_FIELDS = ["title_ar", "title_lat", "text_type", "tags", "author_id",
+                      "title_ar_norm", "title_lat_norm", "content_hash"]
+VERSION_UPDATE_FIELDS = ["version_uri", "char_length", "tok_length", "url", "ed_info", "tags",
+                         "annotation_status", "status", "version_lang", "text_id", "content_hash"]
+
+
+class MetadataSync:
+    """Incrementally synchronize the database with a stream of MetadataRecords.
+
+    Every incoming row is compared (by author_uri, text_uri and version_id)
+    with the content hash stored in the database: only new rows are inserted,
+    only rows whose hash changed are updated, and rows that are
+    no longer in the metadata file are deleted at the end (see finish).
+
+    Only authors and texts that were created from the metadata
+    (i.e., that have a content hash) are deleted; authors that were
+    created by the relations or name elements loaders are left alone.
+    """
+
+    def __init__(self, batch_size=1000, report=None):
+        self.batch_size = batch_size
+        self.report = report or IngestReport(None)
+        # key -> (pk, content hash) maps of the rows that are already in the database:
+        self.authors = {uri: (pk, h) for uri, pk, h in authorMeta.objects.values_list(
+            "author_uri", "id", "content_hash")}
+        self.texts = {uri: (pk, h) for uri, pk, h in textMeta.objects.values_list(
+            "text_uri", "id", "content_hash")}
+        self.versions = {vid: (pk, h) for vid, pk, h in versionMeta.objects.values_list(
+            "version_id", "id", "content_hash")}
+        # keys of all incoming rows (everything else will be deleted):
+        self.seen_authors = set()
+        self.seen_texts = set()
+        self.seen_versions = set()
+        self.counts = {table: dict(inserted=0, updated=0, deleted=0)
+                       for table in ("authors", "texts", "versions")}
+        self.counts["rows"] = 0
+
+    def _sort(self, obj, key, existing, new, changed):
+        """Add obj to the `new` dictionary if its key is not in the database yet,
+        or to the `changed` dictionary if its content hash is different"""
+        if key not in existing:
+            new[key] = obj
+        elif existing[key][1] != obj.content_hash:
+            obj.pk = existing[key][0]
+            changed[key] = obj
+
+    def write(self, records):
+        """Synchronize one chunk of records with the database"""
+        new_authors, changed_authors = dict(), dict()
+        new_texts, changed_texts = dict(), dict()
+        new_versions, changed_versions = dict(), dict()
+        author_records = dict()
+        text_authors = dict()   # text_uri: author_uri
+        version_texts = dict()  # version_id: text_uri
+        for record in records:
+            self.counts["rows"] += 1
+            if record.author_uri not in self.seen_authors:
+                self.seen_authors.add(record.author_uri)
+                author_records[record.author_uri] = record
+                self._sort(make_author(record), record.author_uri,
+                           self.authors, new_authors, changed_authors)
+            if record.text_uri not in self.seen_texts:
+                self.seen_texts.add(record.text_uri)
+                text_authors[record.text_uri] = record.author_uri
+                self._sort(make_text(record), record.text_uri,
+                           self.texts, new_texts, changed_texts)
+            if record.version_id not in self.seen_versions:
+                self.seen_versions.add(record.version_id)
+                version_texts[record.version_id] = record.text_uri
+                self._sort(make_version(record), record.version_id,
+                           self.versions, new_versions, changed_versions)
+
+        # authors:
+        with self.report.phase("authors") as phase:
+            authorMeta.objects.bulk_create(new_authors.values(), batch_size=self.batch_size)
+            authorMeta.objects.bulk_update(
+                changed_authors.values(), AUTHOR_UPDATE_FIELDS, batch_size=self.batch_size)
+            for uri, pk in fetch_ids(authorMeta, "author_uri", new_authors).items():
+                self.authors[uri] = (pk, new_authors[uri].content_hash)
+            phase["rows"] += len(new_authors) + len(changed_authors)
+
+        # replace the (bogus) names that were derived from the metadata:
+        with self.report.phase("names") as phase:
+            personName.objects.filter(
+                author_id__in=[obj.pk for obj in changed_authors.values()],
+                language__in=("ar", "lat")).delete()
+            names = []
+            for uri in list(new_authors) + list(changed_authors):
+                names.extend(make_person_names(self.authors[uri][0], author_records[uri]))
+            personName.objects.bulk_create(names, batch_size=self.batch_size)
+            phase["rows"] += len(names)
+
+        # texts:
+        with self.report.phase("texts") as phase:
+            for uri, item in list(new_texts.items()) + list(changed_texts.items()):
+                item.author_id_id = self.authors[text_authors[uri]][0]
+            textMeta.objects.bulk_create(new_texts.values(), batch_size=self.batch_size)
+            textMeta.objects.bulk_update(
+                changed_texts.values(), TEXT_UPDATE_FIELDS, batch_size=self.batch_size)
+            for uri, pk in fetch_ids(textMeta, "text_uri", new_texts).items():
+                self.texts[uri] = (pk, new_texts[uri].content_hash)
+            phase["rows"] += len(new_texts) + len(changed_texts)
+
+        # versions:
+        insights = InsightsDelta()
+        with self.report.phase("versions") as phase:
+            for vid, version in list(new_versions.items()) + list(changed_versions.items()):
+                version.text_id_id = self.texts[version_texts[vid]][0]
+            insights.remove_versions(fetch_version_stats(v.pk for v in changed_versions.values()))
+            versionMeta.objects.bulk_create(new_versions.values(), batch_size=self.batch_size)
+            versionMeta.objects.bulk_update(
+                changed_versions.values(), VERSION_UPDATE_FIELDS, batch_size=self.batch_size)
+            phase["rows"] += len(new_versions) + len(changed_versions)
+
+        # corpus statistics:
+        with self.report.phase("insights"):
+            insights.authors = len(new_authors)
+            insights.books = len(new_texts)
+            insights.add_versions((v.version_uri, v.tok_length, v.status)
+                                  for v in list(new_versions.values()) + list(changed_versions.values()))
+            insights.apply()
+
+        for table, new, changed in (("authors", new_authors, changed_authors),
+                                    ("texts", new_texts, changed_texts),
+                                    ("versions", new_versions, changed_versions)):
+            self.counts[table]["inserted"] += len(new)
+            self.counts[table]["updated"] += len(changed)
+
+    def finish(self):
+        """Delete the rows that were not in the incoming records"""
+        with self.report.phase("delete"):
+            self._delete_removed()
+
+    def _delete_removed(self):
+        removed_versions = [pk for vid, (pk, h) in self.versions.items()
+                            if vid not in self.seen_versions]
+        removed_texts = [pk for uri, (pk, h) in self.texts.items()
+                         if h and uri not in self.seen_texts]
+        removed_authors = [pk for uri, (pk, h) in self.authors.items()
+                           if h and uri not in self.seen_authors]
+        insights = InsightsDelta()
+        insights.remove_versions(fetch_version_stats(removed_versions))
+        insights.books = -len(removed_texts)
+        insights.authors = -len(removed_authors)
+        for i in range(0, len(removed_versions), 500):
+            versionMeta.objects.filter(id__in=removed_versions[i:i+500]).delete()
+        for i in range(0, len(removed_texts), 500):
+            textMeta.objects.filter(id__in=removed_texts[i:i+500]).delete()
+        for i in range(0, len(removed_authors), 500):
+            # personName.author_id is not defined with on_delete=CASCADE:
+            personName.objects.filter(author_id__in=removed_authors[i:i+500]).delete()
+            authorMeta.objects.filter(id__in=removed_authors[i:i+500]).delete()
+        insights.apply()
+        self.counts["versions"]["deleted"] = len(removed_versions)
+        self.counts["texts"]["deleted"] = len(removed_texts)
+        self.counts["authors"]["deleted"] = len(removed_authors)
+
+    def changed(self):
+        """Return True if any row was inserted, updated or deleted"""
+        return any(sum(self.counts[table].values())
+                   for table in ("authors", "texts", "versions"))
+
+
+def sync_records(records, batch_size=1000, report=None):
+    """Incrementally synchronize the database with a stream of MetadataRecords
+    (inside one transaction) and report what changed."""
+    print("START SYNCING RECORDS")
+    report = report or IngestReport(None)
+    start = time.perf_counter()
+    sync = MetadataSync(batch_size=batch_size, report=report)
+    with transaction.atomic():
+        for chunk in prefetch(iter_chunks(report.timed_iter("parse", records), batch_size)):
+            sync.write(chunk)
+        sync.finish()
+
+    elapsed = time.perf_counter() - start
+    print("Synced {} records in {:.2f} seconds ({:.0f} rows/sec)".format(
+        sync.counts["rows"], elapsed, sync.counts["rows"] / elapsed if elapsed else 0))
+    for table in ("authors", "texts", "versions"):
+        print("  {}: {inserted} inserted, {updated} updated, {deleted} deleted".format(
+            table, **sync.counts[table]))
+    return sync
+
+
+# columns of the text reuse stats csv, in the order of the TextReuseStats fields:
+STATS_COLUMNS = ['_T1', '_T2', 'instances', 'WM1_Total', 'WM2_Total', 'WM_B1inB2', 'WM_B2inB1']
+STATS_FIELDS = ['book_1', 'book_2', 'instances_count', 'book1_word_match', 'book2_word_match',
+                'book1_match_book2_per', 'book2_match_book1_per']
+
+
+# the percentages are rounded like the DecimalFields (max. 2 decimal places):
+PERCENT_EXP = decimal.Decimal("0.01")
+
+
+def make_stats_rows(rows):
+    """Convert a list of text reuse stats csv rows (tuples of strings,
+    in the order of STATS_COLUMNS) into tuples of typed values
+    (this function is run in the worker processes, see iter_stats_rows).
+
+    The conversions are written out in the comprehension instead of
+    calling a function per value, which makes the conversion about twice as fast."""
+    D = decimal.Decimal
+    exp = PERCENT_EXP
+    return [(book_1, book_2,
+             int(instances) if instances else None,
+             int(wm1) if wm1 else None,
+             int(wm2) if wm2 else None,
+             D(per1).quantize(exp) if per1 else None,
+             D(per2).quantize(exp) if per2 else None)
+            for book_1, book_2, instances, wm1, wm2, per1, per2 in rows]
+
+
+def iter_stats_rows(filename, workers=1, chunk_size=10000, skip=0):
+    """Read the (tab-separated) text reuse stats file
+    and yield chunks of typed tuples, in the order of STATS_FIELDS
+    (skipping the first `skip` rows after the header)"""
+    with open_input(filename, newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader)
+        get_columns = operator.itemgetter(*[header.index(col) for col in STATS_COLUMNS])
+        rows = map(get_columns, itertools.islice(reader, skip, None))
+        chunks = iter_chunks(rows, chunk_size)
+        if workers > 1:
+            yield from map_chunks(make_stats_rows, chunks, workers)
+        else:
+            for chunk in chunks:
+                yield make_stats_rows(chunk)
+
+
+def drop_indexes(model):
+    """Drop the (non-unique) indexes of a model's table and return
+    the SQL statements to rebuild them (SQLite only)"""
+    if connection.vendor != "sqlite":
+        return []
+    with connection.cursor() as cursor:
+        # indexes that were created automatically for UNIQUE constraints have no sql:
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = %s AND sql IS NOT NULL", [model._meta.db_table])
+        indexes = cursor.fetchall()
+        for name, sql in indexes:
+            cursor.execute('DROP INDEX "{}"'.format(name))
+    return [sql for name, sql in indexes]
+
+
+def rebuild_indexes(statements):
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def load_stats_rows(chunks, raw=False, report=None, checkpoint=None):
+    """Insert chunks of text reuse stats tuples into the TextReuseStats table.
+
+    The indexes of the table are dropped before the load and rebuilt afterwards,
+    which is much faster than updating them for every inserted row.
+    With raw=True, the rows are inserted with cursor.executemany
+    instead of creating TextReuseStats objects and calling bulk_create.
+
+    If a checkpoint (IngestCheckpoint) is given, every chunk is committed
+    in its own transaction, together with the number of rows loaded so far;
+    the SQL of the dropped indexes is kept in the checkpoint,
+    so that a resumed load can still rebuild them.
+    """
+    print("START LOADING TEXT REUSE STATS")
+    report = report or IngestReport(None)
+    start = time.perf_counter()
+    n_rows = 0
+    table = connection.ops.quote_name(TextReuseStats._meta.db_table)
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        table, ", ".join(connection.ops.quote_name(f) for f in STATS_FIELDS),
+        ", ".join(["%s"] * len(STATS_FIELDS)))
+    with batch_transaction(checkpoint) as chunk_transaction:
+        with chunk_transaction():
+            indexes = drop_indexes(TextReuseStats)
+            if checkpoint:
+                indexes = checkpoint.state.get("indexes", []) + indexes
+                checkpoint.state["indexes"] = indexes
+                checkpoint.save(update_fields=["state", "updated"])
+        for chunk in prefetch(report.timed_iter("parse", chunks, size=len)):
+            with report.phase("stats") as phase, chunk_transaction():
+                if raw:
+                    with connection.cursor() as cursor:
+                        cursor.executemany(sql, chunk)
+                else:
+                    TextReuseStats.objects.bulk_create(
+                        [TextReuseStats(**dict(zip(STATS_FIELDS, row))) for row in chunk],
+                        batch_size=len(chunk))
+                if checkpoint:
+                    checkpoint.advance(len(chunk))
+                phase["rows"] += len(chunk)
+            n_rows += len(chunk)
+        with report.phase("rebuild indexes"), chunk_transaction():
+            rebuild_indexes(indexes)
+            if checkpoint:
+                checkpoint.state["indexes"] = []
+                checkpoint.save(update_fields=["state", "updated"])
+
+    elapsed = time.perf_counter() - start
+    print("Loaded {} text reuse stats rows in {:.2f} seconds ({:.0f} rows/sec)".format(
+        n_rows, elapsed, n_rows / elapsed if elapsed else 0))
+    return n_rows
+
+
+def get_live_database_path():
+    """Return the path of the default (SQLite) database file"""
+    if connection.vendor != "sqlite":
+        raise CommandError("Loading into a shadow database is only supported for SQLite")
+    return str(connection.settings_dict["NAME"])
+
+
+@contextlib.contextmanager
+def use_database(path):
+    """Temporarily point the default database connection to another SQLite file"""
+    conn = connections["default"]
+    live_path = conn.settings_dict["NAME"]
+    conn.close()
+    conn.settings_dict["NAME"] = path
+    try:
+        yield path
+    finally:
+        conn.close()
+        conn.settings_dict["NAME"] = live_path
+
+
+def build_shadow_database(live_path):
+    """Create a copy of the live database next to it (using SQLite's
+    online backup API, so that the live database can still be read
+    while it is copied) and return the path of the copy.
+
+    The data that is not reloaded (users, text reuse stats, ...)
+    is thus kept in the shadow database."""
+    shadow_path = live_path + ".shadow"
+    if os.path.exists(shadow_path):
+        os.remove(shadow_path)
+    src = sqlite3.connect(live_path)
+    dst = sqlite3.connect(shadow_path)
+    try:
+        src.backup(dst)
+        # make sure the shadow database is a single file that can be moved:
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+    return shadow_path
+
+
+def swap_database(shadow_path, live_path):
+    """Replace the live database file with the shadow database file.
+
+    os.replace is atomic: new database connections see either
+    the complete old data or the complete new data; connections that
+    are already open keep reading the old file until they are closed
+    (Django closes its connection at the end of every request by default).
+    """
+    if os.path.exists(live_path + "-wal"):
+        raise CommandError("The live database is in WAL mode and cannot be swapped safely; "
+                           "the shadow database was kept at {}".format(shadow_path))
+    os.replace(shadow_path, live_path)
@@ -0,0 +1,212 @@
+"""Keep the CorpusInsights (the corpus statistics served by /corpusinsights/)
+up to date while the data is loaded.
+
+Instead of recomputing the statistics over the whole database after
+every load, the loaders collect what they changed in an InsightsDelta
+(number of authors and books added or removed, and the versions
+that were added or removed), which is then applied to the stored
+statistics in a few queries (see InsightsDelta.apply).
+
+Only when a removed version was the largest book or one of the top books
+is the largest book or top books list looked up again in the database;
+these queries stop as soon as they have found the answer (see query_top_books).
+
+rebuild_insights recomputes everything from scratch
+(used by the load_aggregated_stats command).
+
+The number of books in the top books list (K) is stored in CorpusInsights.top_k
+(default: 10); query_top_books can also return the top K books per author
+(used by the /top-books/ endpoint).
+"""
+
+import json
+
+from django.db.models import Max, Sum
+
+from api.models import authorMeta, textMeta, versionMeta, CorpusInsights
+
+
+# default number of books in the top_10_book_by_word_count list:
+TOP_K = 10
+# largest number of books that can be requested:
+MAX_TOP_K = 100
+
+
+def get_text_uri(version_uri):
+    return ".".join(version_uri.split(".")[:2])
+
+
+def get_author_uri(version_uri):
+    return version_uri.split(".")[0]
+
+
+# functions that return the URI by which the top books are grouped:
+TOP_BOOKS_PER = {"text": get_text_uri, "author": get_author_uri}
+
+
+def query_top_books(k=TOP_K, per="text"):
+    """Return the largest version (by number of tokens) of the k largest
+    texts (per="text") or authors (per="author"), in descending order
+    (text or author uri: dict(version_uri, tok_length)).
+
+    The versions are read in descending order of tok_length (using the index
+    on that column), and reading stops as soon as k different texts
+    or authors have been found, so only a few rows are read
+    unless a text or author has many large versions."""
+    get_uri = TOP_BOOKS_PER[per]
+    top_books = dict()
+    if k < 1:
+        return top_books
+    versions = versionMeta.objects.filter(tok_length__isnull=False).order_by(
+        "-tok_length").values("version_uri", "tok_length")
+    for v in versions.iterator(chunk_size=max(k, 100)):
+        uri = get_uri(v["version_uri"])
+        if uri not in top_books:
+            top_books[uri] = v
+            if len(top_books) == k:
+                break
+    return top_books
+
+
+def get_top_books(insights):
+    """Return the top books list stored in a CorpusInsights object
+    (the list is stored as a json string)"""
+    top_books = insights.top_10_book_by_word_count
+    if isinstance(top_books, str):
+        top_books = json.loads(top_books)
+    return top_books or dict()
+
+
+def get_top_k():
+    """Return the number of books in the stored top books list"""
+    top_k = CorpusInsights.objects.order_by("id").values_list("top_k", flat=True).first()
+    return top_k or TOP_K
+
+
+def rebuild_insights(top_k=None):
+    """Recompute the corpus statistics from the whole database
+    (with a top books list of top_k books, by default the current number)"""
+    top_k = min(top_k or get_top_k(), MAX_TOP_K)
+    CorpusInsights.objects.all().delete()
+    return CorpusInsights.objects.create(
+        number_of_unique_authors=authorMeta.objects.count(),
+        number_of_books=textMeta.objects.count(),
+        number_of_versions=versionMeta.objects.count(),
+        total_word_count=versionMeta.objects.aggregate(sum=Sum("tok_length"))["sum"] or 0,
+        largest_book=versionMeta.objects.aggregate(max=Max("tok_length"))["max"] or 0,
+        total_word_count_pri=versionMeta.objects.filter(
+            status="pri").aggregate(sum=Sum("tok_length"))["sum"] or 0,
+        top_10_book_by_word_count=json.dumps(query_top_books(top_k)),
+        top_k=top_k
+    )
+
+
+def reset_insights():
+    """Set the corpus statistics to zero (after all data was deleted)"""
+    top_k = get_top_k()
+    CorpusInsights.objects.all().delete()
+    return CorpusInsights.objects.create(
+        number_of_unique_authors=0, number_of_books=0, number_of_versions=0,
+        total_word_count=0, largest_book=0, total_word_count_pri=0,
+        top_10_book_by_word_count=json.dumps(dict()), top_k=top_k)
+
+
+def get_insights():
+    """Return the CorpusInsights object
+    (computed from the database if it does not exist yet)"""
+    insights = CorpusInsights.objects.order_by("id").first()
+    if insights is None:
+        insights = rebuild_insights()
+    return insights
+
+
+class InsightsDelta:
+    """Collect the changes made by a loader to the authors, texts and versions
+    and apply them to the stored corpus statistics.
+
+    Call apply() after the changes have been written to the database
+    (in the same transaction)."""
+
+    def __init__(self):
+        self.authors = 0
+        self.books = 0
+        self.versions = 0
+        self.words = 0
+        self.words_pri = 0
+        self.largest_added = 0
+        self.top_added = dict()      # text_uri: dict(version_uri, tok_length)
+        self.largest_removed = None
+        self.removed_uris = set()    # version URIs of the removed versions
+
+    def add_version(self, version_uri, tok_length, status):
+        self.versions += 1
+        self.words += tok_length or 0
+        if status == "pri":
+            self.words_pri += tok_length or 0
+        self.largest_added = max(self.largest_added, tok_length or 0)
+        # only keep the largest version of every book;
+        # books that are not in the top k of the added books
+        # cannot end up in the top k of the corpus:
+        text_uri = get_text_uri(version_uri)
+        best = self.top_added.get(text_uri)
+        if best is None or (tok_length or 0) > best["tok_length"]:
+            self.top_added[text_uri] = dict(version_uri=version_uri, tok_length=tok_length or 0)
+            if len(self.top_added) > 2 * MAX_TOP_K:
+                self.top_added = largest_books(self.top_added, MAX_TOP_K)
+
+    def remove_version(self, version_uri, tok_length, status):
+        self.versions -= 1
+        self.words -= tok_length or 0
+        if status == "pri":
+            self.words_pri -= tok_length or 0
+        self.largest_removed = max(self.largest_removed or 0, tok_length or 0)
+        self.removed_uris.add(version_uri)
+
+    def add_versions(self, versions):
+        """Add (version_uri, tok_length, status) tuples"""
+        for v in versions:
+            self.add_version(*v)
+
+    def remove_versions(self, versions):
+        """Remove (version_uri, tok_length, status) tuples"""
+        for v in versions:
+            self.remove_version(*v)
+
+    def is_empty(self):
+        return not (self.authors or self.books or self.versions or self.top_added
+                    or self.removed_uris)
+
+    def apply(self):
+        """Update the stored corpus statistics with the collected changes"""
+        if self.is_empty():
+            return
+        insights = get_insights()
+        insights.number_of_unique_authors = (insights.number_of_unique_authors or 0) + self.authors
+        insights.number_of_books = (insights.number_of_books or 0) + self.books
+        insights.number_of_versions = (insights.number_of_versions or 0) + self.versions
+        insights.total_word_count = (insights.total_word_count or 0) + self.words
+        insights.total_word_count_pri = (insights.total_word_count_pri or 0) + self.words_pri
+
+        largest = insights.largest_book or 0
+        if self.largest_removed is not None and self.largest_removed >= largest:
+            # the largest book may have been removed:
+            largest = versionMeta.objects.aggregate(max=Max("tok_length"))["max"] or 0
+        insights.largest_book = max(largest, self.largest_added)
+
+        top_books = get_top_books(insights)
+        if any(b["version_uri"] in self.removed_uris for b in top_books.values()):
+            # one of the top books was removed (or changed):
+            top_books = query_top_books(insights.top_k)
+        else:
+            for text_uri, b in self.top_added.items():
+                if text_uri not in top_books or b["tok_length"] > top_books[text_uri]["tok_length"]:
+                    top_books[text_uri] = b
+            top_books = largest_books(top_books, insights.top_k)
+        insights.top_10_book_by_word_count = json.dumps(top_books)
+        insights.save()
+
+
+def largest_books(books, k):
+    """Return the k largest books of a text_uri: dict(version_uri, tok_length) dictionary"""
+    ranked = sorted(books.items(), key=lambda item: item[1]["tok_length"], reverse=True)
+    return dict(ranked[:k])
@@ -0,0 +1,148 @@
+"""Instrumentation for the data loading (ingest) commands.
+
+An IngestReport records, for every phase of a load (parse, authors,
+texts, versions, names, relations, stats, ...), the wall time,
+the number of rows and the number of SQL queries, plus the peak
+memory use of the process. At the end of a run, the report is
+written to a JSON file (by default in the ingest_reports folder),
+so that the performance of different releases can be compared.
+
+Usage:
+
+    report = IngestReport("load_data2")
+    with report:
+        with report.phase("authors") as phase:
+            ...
+            phase["rows"] += len(authors)
+    report.write()
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import sys
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+def get_peak_rss_mb():
+    """Return the peak resident memory of the current process in MB
+    (None on platforms without the resource module, e.g. Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes instead of kilobytes
+        rss /= 1024
+    return round(rss / 1024, 1)
+
+
+def default_report_path(command):
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(settings.BASE_DIR, "ingest_reports",
+                        "{}-{}.json".format(command, timestamp))
+
+
+class QueryCounter:
+    """Database execute wrapper that counts the executed queries
+    (see https://docs.djangoproject.com/en/3.2/topics/db/instrumentation/)"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class IngestReport:
+    """Collect timings, row counts and query counts per phase of a load"""
+
+    def __init__(self, command):
+        self.command = command
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+        self.phases = dict()  # name: dict(seconds, rows, queries)
+        self.counter = QueryCounter()
+        self.exit_stack = None
+
+    def __enter__(self):
+        # count the queries on the default connection while the report is active:
+        self.exit_stack = contextlib.ExitStack()
+        self.exit_stack.enter_context(connections["default"].execute_wrapper(self.counter))
+        return self
+
+    def __exit__(self, *exc):
+        self.exit_stack.close()
+        return False
+
+    def get_phase(self, name):
+        return self.phases.setdefault(name, dict(seconds=0.0, rows=0, queries=0))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the load. A phase can be entered several times
+        (e.g., once for every chunk); its numbers are added up.
+        The caller adds the number of processed rows to phase["rows"]."""
+        phase = self.get_phase(name)
+        queries = self.counter.count
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase["seconds"] += time.perf_counter() - start
+            phase["queries"] += self.counter.count - queries
+
+    def timed_iter(self, name, iterable, size=None):
+        """Yield the items of an iterable, adding the time spent
+        producing them (e.g., parsing the input file) to a phase.
+
+        Every item counts as one row, unless a size function is given
+        (e.g., size=len for an iterable of chunks)."""
+        phase = self.get_phase(name)
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                phase["seconds"] += time.perf_counter() - start
+                return
+            phase["seconds"] += time.perf_counter() - start
+            phase["rows"] += size(item) if size else 1
+            yield item
+
+    def as_dict(self):
+        phases = dict()
+        for name, phase in self.phases.items():
+            seconds = phase["seconds"]
+            phases[name] = dict(
+                seconds=round(seconds, 3),
+                rows=phase["rows"],
+                rows_per_sec=round(phase["rows"] / seconds) if seconds else None,
+                queries=phase["queries"])
+        return dict(
+            command=self.command,
+            started=self.started.isoformat(),
+            total_seconds=round(time.perf_counter() - self.start, 3),
+            total_queries=self.counter.count,
+            peak_rss_mb=get_peak_rss_mb(),
+            phases=phases)
+
+    def write(self, path=None):
+        """Print a summary of the report and write it to a JSON file"""
+        report = self.as_dict()
+        print("{command}: {total_seconds} seconds, {total_queries} queries, peak memory: {peak_rss_mb} MB".format(**report))
+        for name, phase in report["phases"].items():
+            print("  {:<20} {:>10.3f} s {:>10} rows {:>10} rows/sec {:>8} queries".format(
+                name, phase["seconds"], phase["rows"], phase["rows_per_sec"] or "-", phase["queries"]))
+        path = path or default_report_path(self.command)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, mode="w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print("Report written to", path)
+        return path
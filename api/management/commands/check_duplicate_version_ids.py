@@ -1,43 +1,151 @@
-import json, csv
-from webbrowser import get
-from django.db import models
-from api.models import authorMeta, textMeta, versionMeta, personName, AggregatedStats
-from django.core.management.base import BaseCommand
-from django.conf import settings
+"""Check the metadata csv (and the relations and name elements files)
+before loading them into the database.
+
+The metadata file is read as a stream, in a single pass, and the command
+reports:
+
+* duplicate version ids (the version_id column must be unique in the database)
+* orphan text URIs: rows in which the book column is empty or does not match
+  the text URI in the versionUri column
+* authors that are not in the name elements file
+* relations that point at book or person URIs that are not in the metadata
+
+Use --fix to write a copy of the metadata file in which the duplicate
+version ids are replaced by new, unique ids (this is done in one more pass
+over the file; the first row with an id keeps it).
+"""
+
+import csv
 import os
-import re
-import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.ingest import METADATA_FIELDNAMES, open_input, iter_json_items, get_uri_type
+
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--metadata", default='OpenITI_Github_clone_metadata_light-feb23.csv',
+            help="metadata csv file (path relative to the project folder)")
+        parser.add_argument(
+            "--relations", default="OpenITI_Github_clone_book_relations_selection.json",
+            help="book relations json file (path relative to the project folder)")
+        parser.add_argument(
+            "--name-elements", default="test_name_elements.json",
+            help="name elements json file (path relative to the project folder)")
+        parser.add_argument(
+            "--fix",
+            help="write a copy of the metadata file with unique version ids to this path")
+        parser.add_argument(
+            "--max-examples", type=int, default=10,
+            help="maximum number of examples that are printed for every problem")
+
     def handle(self, **options):
-        filename = 'OpenITI_Github_clone_metadata_light.csv'
-        fp  = os.path.join(settings.BASE_DIR, filename)
-        with open(fp, mode="r", encoding="utf-8") as f:
-            reader = csv.DictReader(f,fieldnames=['versionUri','date','author_ar','author_lat','book','title_ar','title_lat','ed_info','id','status','tok_length','url','tags','author_from_uri','author_lat_shuhra','author_lat_full_name','char_length'], delimiter='\t')
-       
-            next(reader)
-            version_ids = dict()
+        fp = os.path.join(settings.BASE_DIR, options["metadata"])
+        check = check_metadata(fp)
+
+        fp = os.path.join(settings.BASE_DIR, options["name_elements"])
+        name_authors = set(author_uri for author_uri, names in iter_json_items(fp))
+        missing_names = sorted(check["authors"] - name_authors)
+
+        fp = os.path.join(settings.BASE_DIR, options["relations"])
+        unknown_uris = check_relations(fp, check["authors"], check["texts"])
+
+        print("Checked {} rows ({} authors, {} texts)".format(
+            check["rows"], len(check["authors"]), len(check["texts"])))
+        n = options["max_examples"]
+        print_problems("duplicate version ids", check["duplicates"], n)
+        print_problems("orphan text URIs", check["orphans"], n)
+        print_problems("authors missing from the name elements file", missing_names, n)
+        print_problems("relations pointing at unknown URIs", unknown_uris, n)
+
+        if options["fix"]:
+            n_fixed = fix_duplicate_ids(
+                os.path.join(settings.BASE_DIR, options["metadata"]),
+                options["fix"], check["ids"])
+            print("Wrote {} ({} version ids replaced)".format(options["fix"], n_fixed))
+
+
+def print_problems(label, problems, max_examples):
+    print("{}: {}".format(label, len(problems)))
+    for problem in problems[:max_examples]:
+        print("   ", problem)
+    if len(problems) > max_examples:
+        print("    ...")
+
+
+def check_metadata(fp):
+    """Read the metadata file once and collect the version ids,
+    authors and texts, the duplicate version ids and the orphan text URIs"""
+    ids = dict()  # version_id: versionUri of the first row with that id
+    authors = set()
+    texts = set()
+    duplicates = []
+    orphans = []
+    n_rows = 0
+    with open_input(fp) as f:
+        reader = csv.DictReader(f, fieldnames=METADATA_FIELDNAMES, delimiter='\t')
+        next(reader)  # skip the header row
+        for row in reader:
+            n_rows += 1
+            version_uri = row["versionUri"]
+            if row["id"] in ids:
+                duplicates.append("{}: {} / {}".format(row["id"], ids[row["id"]], version_uri))
+            else:
+                ids[row["id"]] = version_uri
+            authors.add(version_uri.split(".")[0])
+            text_uri = ".".join(version_uri.split(".")[:2])
+            if row["book"] != text_uri:
+                orphans.append("{}: book column is {!r}".format(version_uri, row["book"]))
+            if row["book"]:
+                texts.add(row["book"])
+    return dict(rows=n_rows, ids=ids, authors=authors, texts=texts,
+                duplicates=duplicates, orphans=orphans)
+
+
+def check_relations(fp, authors, texts):
+    """Return a description of every relation with a source or destination URI
+    that is not in the metadata"""
+    unknown = []
+    for book_uri, book_relations in iter_json_items(fp):
+        for rel_d in book_relations:
+            for uri in (rel_d["source"], rel_d["dest"]):
+                known = authors if get_uri_type(uri) == "person" else texts
+                if uri not in known:
+                    unknown.append("{} -> {} ({}): unknown {} URI {}".format(
+                        rel_d["source"], rel_d["dest"], rel_d["main_rel_type"],
+                        get_uri_type(uri), uri))
+    return unknown
+
+
+def fix_duplicate_ids(fp, outfp, ids):
+    """Copy the metadata file to outfp, replacing every repeated version id
+    by the id followed by the first number that gives an unused id
+    (ids: all version ids in the file, as collected by check_metadata).
+
+    Return the number of replaced ids."""
+    used = set(ids)
+    seen = set()
+    n_fixed = 0
+    with open_input(fp, newline="") as f:
+        with open(outfp, mode="w", encoding="utf-8", newline="") as outf:
+            reader = csv.reader(f, delimiter='\t')
+            writer = csv.writer(outf, delimiter='\t', lineterminator="\n")
+            header = next(reader)
+            writer.writerow(header)
+            id_col = header.index("id")
             for row in reader:
-                if not row["id"] in version_ids:
-                    version_ids[row["id"]] = [row["versionUri"]]
+                version_id = row[id_col]
+                if version_id in seen:
+                    i = 1
+                    while version_id + str(i) in used:
+                        i += 1
+                    row[id_col] = version_id + str(i)
+                    used.add(row[id_col])
+                    n_fixed += 1
                 else:
-                    version_ids[row["id"]].append(row["versionUri"])
-                    print("DUPLICATE:", version_ids[row["id"]])
-        # with open(fp, mode="r", encoding="utf-8") as f:
-        #     data = f.read()
-        #     for version_id in version_ids:
-        #         if len(version_ids[version_id]) > 1:
-        #             for i, row in enumerate(re.findall(".+"+version_id+".+", data)):
-        #                 print(i, row)
-        #                 new_id = version_id+str(i)
-        #                 if new_id in version_ids:
-        #                     print("PROBLEM: NEW_ID ALREADY IN VERSION_IDS:", new_id)
-        #                 new_row = re.sub(version_id, new_id, row)
-        #                 data = re.sub(row, new_row, data)
-        # with open(fp, mode="w", encoding="utf-8") as f:
-        #     f.write(data)
-
-
-
-        
-                
\ No newline at end of file
+                    seen.add(version_id)
+                writer.writerow(row)
+    return n_fixed
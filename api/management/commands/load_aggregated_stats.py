@@ -1,74 +1,36 @@
 from django.db import models
-from api.models import authorMeta, textMeta, versionMeta, personName, CorpusInsights
+from api.insights import rebuild_insights, MAX_TOP_K
+from api.caching import bump_generation
 from django.core.management.base import BaseCommand
-from django.db.models import Count
-from django.db.models import Sum
-from django.db.models import Max
 import json
 from django.contrib.auth.models import User
 
 
 class Command(BaseCommand):
+    """Recompute the corpus statistics (CorpusInsights) from scratch.
+
+    NB: load_data2 keeps the statistics up to date while loading
+    (see api.insights), so this is only needed to repair them,
+    e.g. after the data was changed in the admin interface."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--top-k", type=int,
+            help="number of books in the top books list (default: keep the current number, "
+                 "or 10; at most {})".format(MAX_TOP_K))
+
     def handle(self, **options):
         superusers = User.objects.filter(is_superuser=True)
         for user in superusers:
             print(user, superusers)
         exit
-        CorpusInsights.objects.all().delete()
-
-        load_data()
-
-
-def get_distinct_count(table_name, column_name):
-    distinct_count = table_name.objects.values(
-        column_name).annotate(count=Count(column_name)).count()
-    return distinct_count
-
-
-def get_column_sum(table_name, column_name):
-    column_sum = table_name.objects.aggregate(sum=Sum(column_name))['sum']
-    return column_sum
-
-
-def get_largest_number(table_name, column_name):
-    largest_number = table_name.objects.aggregate(
-        max_number=Max(column_name))['max_number']
-    return largest_number
-
-
-def get_top_10_books():
-
-    # top_10_books = versionMeta.objects.select_related('text_id').order_by(
-    #     '-tok_length')[:10].values('version_uri', 'tok_length', 'text_id__title_lat')
-
-    #top_10_books = versionMeta.objects.order_by('-tok_length')[:10].values('version_uri', 'tok_length')
-    all_books = versionMeta.objects.order_by(
-        '-tok_length')[:60].values('version_uri', 'tok_length')
-
-    top_books = dict()
-    for b in all_books:
-        text_uri = '.'.join(b['version_uri'].split('.')[:2])
-        if text_uri not in top_books:
-            top_books[text_uri] = b
-        if len(top_books) == 10:
-            break
-
-    return top_books
-
 
-def load_data():
-    print(get_top_10_books())
-    # print(textMeta.objects.annotate(Count('text_uri', distinct=True)).query)
-    print(versionMeta.objects.aggregate(sum=Sum('tok_length'))['sum'])
-    CorpusInsights.objects.get_or_create(
+        load_data(top_k=options["top_k"])
 
-        number_of_unique_authors=authorMeta.objects.count(),
-        number_of_books=get_distinct_count(textMeta, 'text_uri'),
-        number_of_versions=versionMeta.objects.count(),
-        total_word_count=get_column_sum(versionMeta, 'tok_length'),
-        largest_book=get_largest_number(versionMeta, 'tok_length'),
-        total_word_count_pri=versionMeta.objects.filter(
-            status='pri').aggregate(sum=Sum('tok_length'))['sum'],
-        top_10_book_by_word_count=json.dumps(get_top_10_books())
 
-    )
+def load_data(top_k=None):
+    insights = rebuild_insights(top_k=top_k)
+    print(json.loads(insights.top_10_book_by_word_count))
+    print(insights.total_word_count)
+    # the cached responses (/corpusinsights/, /top-books/, ...) are not used anymore:
+    bump_generation()
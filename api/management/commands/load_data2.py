@@ -1,67 +1,187 @@
 
-import json
-import csv
-from webbrowser import get
-from django.db import models
-# , AggregatedStats
 from api.models import authorMeta, textMeta, versionMeta, personName, relationType, a2bRelation
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from api.ingest import iter_records, bulk_load_records, sync_records, get_authorDateAH, get_authorDateCE
+from api.ingest import get_live_database_path, build_shadow_database, use_database, swap_database
+from api.ingest import start_checkpoint, finish_checkpoint, iter_json_items, get_uri_type
+from api.insights import InsightsDelta, reset_insights
+from api.facets import refresh_facets
+from api.search import rebuild_search_index
+from api.caching import bump_generation
+from api.instrumentation import IngestReport
+from django.core.management import call_command
+from django.db import connection
+import collections
 import os
 import re
 import random
 
-import urllib.request
-
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--metadata", default='OpenITI_Github_clone_metadata_light-feb23.csv',
+            help="metadata csv file (path relative to the project folder)")
+        parser.add_argument(
+            "--relations", default="OpenITI_Github_clone_book_relations_selection.json",
+            help="book relations json file (path relative to the project folder)")
+        parser.add_argument(
+            "--name-elements", default="test_name_elements.json",
+            help="name elements json file (path relative to the project folder)")
+        parser.add_argument(
+            "--bulk", action="store_true",
+            help="load the metadata records in batches (bulk_create) instead of row by row")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="number of objects per bulk_create batch (only used with --bulk and --delta)")
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="number of worker processes used to parse the metadata csv")
+        parser.add_argument(
+            "--delta", action="store_true",
+            help="do not delete the existing data, but only insert, update or delete "
+                 "the metadata records that changed since the last load")
+        parser.add_argument(
+            "--shadow", action="store_true",
+            help="load the data into a copy of the database, "
+                 "and replace the live database with it when loading is finished")
+        parser.add_argument(
+            "--resume", action="store_true",
+            help="continue an unfinished --bulk load after the last committed batch "
+                 "(instead of deleting the data and starting over)")
+        parser.add_argument(
+            "--report", dest="report_path",
+            help="path of the JSON file to which the timings of the load are written "
+                 "(default: ingest_reports/load_data2-<timestamp>.json)")
+
     def handle(self, **options):
-        filename = 'OpenITI_Github_clone_metadata_light-feb23.csv'
+        if options["resume"] and (not options["bulk"] or options["delta"] or options["shadow"]):
+            raise CommandError("--resume can only be used with --bulk (without --delta and --shadow)")
+        report = IngestReport("load_data2")
+        with report:
+            if not options["shadow"]:
+                self.load(report, **options)
+            else:
+                self.load_shadow(report, **options)
+        report.write(options["report_path"])
+
+    def load_shadow(self, report, **options):
+        # build the complete dataset in a shadow database,
+        # so that the API never serves partially loaded data:
+        live_path = get_live_database_path()
+        with report.phase("copy database"):
+            shadow_path = build_shadow_database(live_path)
+        print("Loading into shadow database", shadow_path)
+        with use_database(shadow_path):
+            call_command("migrate", verbosity=0)
+            self.load(report, **options)
+        swap_database(shadow_path, live_path)
+        print("Replaced", live_path, "with the shadow database")
+
+    def load(self, report, **options):
+        filename = options["metadata"]
         #filename = 'https://raw.githubusercontent.com/OpenITI/kitab-metadata-automation/master/output/OpenITI_Github_clone_metadata_light.csv'
 
         # with urllib.request.urlopen(filename) as url:
         #     data = url.read().decode('utf-8')
         # #filename = '../test.json'
 
-        versionMeta.objects.all().delete()
-        a2bRelation.objects.all().delete()
-
-        personName.objects.all().delete()
-        textMeta.objects.all().delete()
-        relationType.objects.all().delete()
-        authorMeta.objects.all().delete()
-
         fp = os.path.join(settings.BASE_DIR, filename)
         print(fp)
-        records = read_csv(fp)
-        load_records(records)
-
-        # read_json(filename)
+        checkpoint = None
+        if options["bulk"] and not options["delta"]:
+            # the bulk load commits every batch, so that it can be resumed:
+            checkpoint = start_checkpoint("load_data2", fp, resume=options["resume"])
+
+        if not options["delta"] and not options["resume"]:
+            with report.phase("delete"):
+                versionMeta.objects.all().delete()
+                a2bRelation.objects.all().delete()
+
+                personName.objects.all().delete()
+                textMeta.objects.all().delete()
+                relationType.objects.all().delete()
+                authorMeta.objects.all().delete()
+                # the corpus statistics are updated while loading:
+                reset_insights()
+
+        records = iter_records(fp, workers=options["workers"], chunk_size=options["batch_size"],
+                               skip=checkpoint.offset if checkpoint else 0)
+        changed = True
+        if options["delta"]:
+            # NB: the name elements loader below uses get_or_create, so it only adds what is missing;
+            # the relations loader also deletes the relations that are no longer in the file
+            sync = sync_records(records, batch_size=options["batch_size"], report=report)
+            changed = sync.changed()
+        elif options["bulk"]:
+            bulk_load_records(records, batch_size=options["batch_size"], report=report,
+                              checkpoint=checkpoint)
+        else:
+            with report.phase("records (row by row)") as phase:
+                phase["rows"] += load_records(records)
 
-        book_relations_fn = "OpenITI_Github_clone_book_relations_selection.json"
+        book_relations_fn = options["relations"]
         fp = os.path.join(settings.BASE_DIR, book_relations_fn)
         print(fp)
-        load_book_relations(fp)
+        with report.phase("relations") as phase:
+            counts = load_book_relations(fp, batch_size=options["batch_size"],
+                                         delete_missing=options["delta"])
+            phase["rows"] += counts["created"] + counts["deleted"]
+            changed = changed or any(counts.values())
 
-        name_elements_fn = "test_name_elements.json"
+        name_elements_fn = options["name_elements"]
         fp = os.path.join(settings.BASE_DIR, name_elements_fn)
-        load_name_elements(fp)
+        with report.phase("name elements") as phase:
+            counts = load_name_elements(fp)
+            phase["rows"] += counts["names"]
+            changed = changed or counts["created"]
+
+        if not changed:
+            # a delta load without changes: the facets, the search index
+            # and the cached counts and responses are still up to date
+            print("Nothing changed since the last load")
+            return
+
+        # precompute the facet values of the versions (see the facets/ endpoint):
+        with report.phase("facets") as phase:
+            phase["rows"] += refresh_facets(batch_size=options["batch_size"])
+
+        # rebuild the full-text index used by ?search= (see api/search.py):
+        with report.phase("search index") as phase:
+            phase["rows"] += rebuild_search_index(batch_size=options["batch_size"]) or 0
+
+        # update the table statistics that SQLite uses to choose the indexes of a query
+        # (e.g., api_author_date_idx for /version/all/?ordering=text_id__author_id__date):
+        if connection.vendor == "sqlite":
+            with report.phase("statistics"), connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+        if checkpoint:
+            finish_checkpoint(checkpoint)
+        # invalidate the cached counts (see api/caching.py):
+        bump_generation()
 
 
 def load_name_elements(fp):
+    """Load the name elements of the authors from the name elements json file
+    and return the number of names in the file and the number of
+    authors and names that were created"""
     languages = {"AR": "ara", "EN": "eng",
                  "FA": "per", "PE": "per", "LA": "lat"}
-    with open(fp, mode="r", encoding="utf-8") as file:
-        data = json.load(file)
-    for author_uri in data:
+    n_names = 0
+    n_created = 0
+    insights = InsightsDelta()
+    for author_uri, author_names in iter_json_items(fp):
         author_id, created = authorMeta.objects.get_or_create(
             author_uri=author_uri
         )
-        print(author_uri, "created:", created)
-        for lang in data[author_uri]:
+        insights.authors += created
+        n_created += created
+        for lang in author_names:
             lang_code = languages[lang]
-            d = data[author_uri][lang]
-            print(d)
+            d = author_names[lang]
+            n_names += 1
             name, created = personName.objects.get_or_create(
                 author_id=author_id,
                 language=lang_code,
@@ -72,190 +192,142 @@ def load_name_elements(fp):
                 laqab=d["laqab"],
                 nisba=d["nisba"]
             )
-
-
-def load_book_relations(fp):
-    with open(fp, mode="r", encoding="utf-8") as file:
-        data = json.load(file)
-    for book_uri in data:
-        print(book_uri)
-        print(data[book_uri])
-        for rel_d in data[book_uri]:
-            # create the main relation type in the relationType table if it does not exist yet:
-            print("main_rel_type:", rel_d["main_rel_type"])
-            mrt, mrt_created = relationType.objects.get_or_create(
-                name=rel_d["main_rel_type"]
-            )
-            print("created?", mrt_created)
-            # create the main relation type in the relationType table if it does not exist yet:
-            print("sec_rel_type:", rel_d["sec_rel_type"])
-            if "sec_rel_type" in rel_d and rel_d["sec_rel_type"]:
-                rt, srt_created = relationType.objects.get_or_create(
-                    name=rel_d["sec_rel_type"],
-                )
-                rt.parent_type.add(mrt)
+            n_created += created
+    insights.apply()
+    return dict(names=n_names, created=n_created)
+
+
+def load_book_relations(fp, batch_size=1000, delete_missing=False):
+    """Load the relations from the book relations json file
+    and return the number of relations, relation types and persons
+    that were created (and the number of relations that were deleted).
+
+    Relation types and endpoint URIs are resolved through dictionaries
+    that are built with a single query per table, and all new relations
+    are inserted with bulk_create (instead of several get_or_create
+    queries per relation).
+
+    Relations with a book URI that is not in the textMeta table are skipped
+    (a textMeta record cannot be created without an author);
+    missing person URIs are added to the authorMeta table.
+
+    The (possibly compressed) json file is read twice, one book at a time
+    (see iter_json_items): first to collect the relation types and persons,
+    then to create the relations in batches of batch_size.
+
+    With delete_missing=True (delta loads), the relations between texts
+    and persons that are no longer in the file are deleted
+    (relations with a place are not loaded from this file, so they are kept).
+    """
+    def iter_relations():
+        for book_uri, book_relations in iter_json_items(fp):
+            yield from book_relations
+
+    # collect the relation types and persons that do not exist yet:
+    rel_types = {rt.name: rt for rt in relationType.objects.all()}
+    author_ids = dict(authorMeta.objects.values_list("author_uri", "id"))
+    new_types = set()
+    type_links = set()  # (secondary relation type, main relation type)
+    new_persons = set()
+    for rel_d in iter_relations():
+        for key in ("main_rel_type", "sec_rel_type"):
+            if rel_d.get(key) and rel_d[key] not in rel_types:
+                new_types.add(rel_d[key])
+        if rel_d.get("sec_rel_type"):
+            type_links.add((rel_d["sec_rel_type"], rel_d["main_rel_type"]))
+        for uri in (rel_d["source"], rel_d["dest"]):
+            if get_uri_type(uri) == "person" and uri not in author_ids:
+                new_persons.add(uri)
+
+    # create the main and secondary relation types that do not exist yet:
+    relationType.objects.bulk_create([relationType(name=name) for name in sorted(new_types)])
+    rel_types = {rt.name: rt for rt in relationType.objects.all()}
+
+    # link the secondary relation types to their main relation type:
+    ParentType = relationType.parent_type.through
+    parent_links = set(ParentType.objects.values_list("from_relationtype_id", "to_relationtype_id"))
+    new_links = set()
+    for sec_type, main_type in type_links:
+        link = (rel_types[sec_type].id, rel_types[main_type].id)
+        if link not in parent_links:
+            new_links.add(link)
+    ParentType.objects.bulk_create(
+        [ParentType(from_relationtype_id=a, to_relationtype_id=b) for a, b in new_links])
+
+    # create the persons that are not in the authorMeta table yet:
+    authorMeta.objects.bulk_create(
+        [authorMeta(author_uri=uri) for uri in sorted(new_persons)], batch_size=batch_size)
+    insights = InsightsDelta()
+    insights.authors = len(new_persons)
+    insights.apply()
+    author_ids = dict(authorMeta.objects.values_list("author_uri", "id"))
+    text_ids = dict(textMeta.objects.values_list("text_uri", "id"))
+
+    # create the relations:
+    fields = ("text_a_id_id", "text_b_id_id", "person_a_id_id", "person_b_id_id", "relation_type_id")
+    existing = collections.defaultdict(list)  # key: primary keys of the relations with that key
+    for pk, *key in a2bRelation.objects.filter(
+            place_a_id__isnull=True, place_b_id__isnull=True).values_list("id", *fields):
+        existing[tuple(key)].append(pk)
+    seen = set()
+    new_relations = []
+    n_relations = 0
+    unknown_uris = set()
+    for rel_d in iter_relations():
+        # if no secondary relation type is given, use the main relation type in the record:
+        rt = rel_types[rel_d.get("sec_rel_type") or rel_d["main_rel_type"]]
+        rel = dict.fromkeys(fields)
+        rel["relation_type_id"] = rt.id
+        skip = False
+        for uri, side in ((rel_d["source"], "a"), (rel_d["dest"], "b")):
+            if get_uri_type(uri) == "person":
+                rel["person_{}_id_id".format(side)] = author_ids[uri]
+            elif uri in text_ids:
+                rel["text_{}_id_id".format(side)] = text_ids[uri]
             else:
-                rt = mrt  # if no secondary relation type is given, use the main relation type in the record
-
-            a = rel_d["source"]
-            if len(a.split(".")) > 1:
-                a_type = "book"
-            else:
-                a_type = "person"
-            print("a=source:", a, a_type)
-            b = rel_d["dest"]
-            if len(b.split(".")) > 1:
-                b_type = "book"
-            else:
-                b_type = "person"
-            print("b=dest:", b, b_type)
-            if a_type == "book" and b_type == "book":
-                a_obj, a_created = textMeta.objects.get_or_create(
-                    text_uri=a
-                )
-                b_obj, b_created = textMeta.objects.get_or_create(
-                    text_uri=b
-                )
-                a2bRelation.objects.get_or_create(
-                    text_a_id=a_obj,
-                    text_b_id=b_obj,
-                    relation_type=rt
-                )
-            elif a_type == "person" and b_type == "book":
-                a_obj, a_created = authorMeta.objects.get_or_create(
-                    author_uri=a
-                )
-                b_obj, b_created = textMeta.objects.get_or_create(
-                    text_uri=b
-                )
-                a2bRelation.objects.get_or_create(
-                    person_a_id=a_obj,
-                    text_b_id=b_obj,
-                    relation_type=rt
-                )
-            elif a_type == "book" and b_type == "person":
-                a_obj, a_created = authorMeta.objects.get_or_create(
-                    text_uri=a
-                )
-                b_obj, b_created = authorMeta.objects.get_or_create(
-                    author_uri=b
-                )
-                a2bRelation.objects.get_or_create(
-                    text_a_id=a_obj,
-                    person_b_id=b_obj,
-                    relation_type=rt
-                )
-
-
-def read_json(filename):
-    record = {}
-    with open(filename, 'r') as f:
-        for line in f:
-
-            data = json.loads(line)
-            # print(data)
-            record['book_id'] = data['id']
-            record['book_uri'] = data['book']
-            record['char_length'] = data['char_length']
-            record['tok_length'] = data['tok_length']
-            record['date'] = data['date']
-            record['title_ar'] = data['title_ar']
-            record['title_lat'] = data['title_lat']
-            record['version_uri'] = data['versionUri']
-            record['url'] = data['url']
-            record['status'] = data['status'],
-            record['author_lat'] = data['author_lat']
-            bulk_load(record)
-
-
-def check_null(value):
-    if value == '':
-        return 0
-    else:
-        return value
-
-
-def get_annotation_status(value):
-    if value == 'mARkdown' or value == 'completed' or value == 'inProgress':
-        return value
-    else:
-        return 'notYetAnnotated'
-
-
-def get_version_lang(version_uri):
-    try:
-        return re.findall("-([a-z]{3})", version_uri)[0]
-    except:
-        return ""
-
-
-def ah2ce(date):
-    """convert AH date to CE date"""
-    return 622 + (int(date) * 354 / 365.25)
-
-
-def ce2ah(date):
-    """convert CE date to AH date"""
-    return (int(date) - 622) * 365.25 / 354
-
-
-def get_authorDateAH(date, book_type):
-    if book_type == "document":
-        return ce2ah(date)
-    return int(date)
-
-
-def get_authorDateCE(date, book_type):
-    if book_type != "document":
-        return ah2ce(date)
-    return int(date)
-
-
-def read_csv(filename):
-    records = []
-    with open(filename, 'r', encoding='utf-8') as f:
-
-        reader = csv.DictReader(f, fieldnames=['versionUri', 'date', 'author_ar', 'author_lat', 'book', 'title_ar', 'title_lat', 'ed_info', 'id',
-                                               'status', 'tok_length', 'url', 'tags', 'author_from_uri', 'author_lat_shuhra', 'author_lat_full_name', 'char_length'], delimiter='\t')
-
-        next(reader)
-        for data in reader:
-            record = {}
-            record['version_uri'] = data['versionUri']
-            record['version_lang'] = get_version_lang(record['version_uri'])
-            record['date'] = data['date']
-            record['author_ar'] = data['author_ar']
-            record['author_lat'] = data['author_lat']
-            record['text_uri'] = data['book']
-            record['title_ar'] = data['title_ar']
-            record['title_lat'] = data['title_lat']
-            record['ed_info'] = data['ed_info']
-            record['version_id'] = data['id']
-            record['status'] = data['status']
-            record['tok_length'] = check_null(data['tok_length'])
-            record['url'] = data['url']
-            record['tags'] = data['tags']
-            record['author_from_uri'] = data['author_from_uri']
-            record['author_lat_shuhra'] = data['author_lat_shuhra']
-            record['author_lat_full_name'] = data['author_lat_full_name']
-            record['char_length'] = check_null(data['char_length'])
-            record['annotation_status'] = get_annotation_status(
-                data['url'].split('.')[-1])
-            if "type" in data:
-                record["type"] = data["type"]
-            else:
-                record["type"] = "book"
-            records.append(record)
-    return records
+                unknown_uris.add(uri)
+                skip = True
+        if skip:
+            continue
+        key = tuple(rel[f] for f in fields)
+        if key in seen:
+            continue
+        seen.add(key)
+        if key in existing:
+            continue
+        new_relations.append(a2bRelation(**rel))
+        if len(new_relations) == batch_size:
+            a2bRelation.objects.bulk_create(new_relations)
+            n_relations += len(new_relations)
+            new_relations = []
+    a2bRelation.objects.bulk_create(new_relations)
+    n_relations += len(new_relations)
+
+    # delete the relations that are no longer in the file:
+    removed = []
+    if delete_missing:
+        removed = [pk for key, pks in existing.items() if key not in seen for pk in pks]
+        for i in range(0, len(removed), 500):
+            a2bRelation.objects.filter(id__in=removed[i:i+500]).delete()
+
+    print("Loaded {} relations ({} relation types, {} persons created, {} relations deleted)".format(
+        n_relations, len(new_types), len(new_persons), len(removed)))
+    if unknown_uris:
+        print("Skipped relations with {} unknown book URIs".format(len(unknown_uris)))
+    return dict(created=n_relations, types=len(new_types), persons=len(new_persons),
+                deleted=len(removed))
 
 
 def load_records(records):
+    """Load the metadata records row by row and return the number of records"""
     print("START LOADING RECORDS")
+    n_records = 0
+    insights = InsightsDelta()
     for record in records:
+        n_records += 1
         # print(authorMeta.objects.filter(author_uri = "0001AbuTalibCabdManaf").exists())
         # never create duplicate author data, except for Anonymous authors:
-        print(record['version_uri'])
-        author_uri = record['version_uri'].split(".")[0]
+        author_uri = record.version_uri.split(".")[0]
         if re.findall('\d{4}Anonymous\.', author_uri):
             create_new = True
         else:
@@ -266,50 +338,54 @@ def load_records(records):
         if create_new:
             am, am_created = authorMeta.objects.get_or_create(
 
-                author_uri=record['version_uri'].split(".")[0],
-                author_ar=record['author_ar'],
-                author_lat=record['author_lat'],
-                date=record['date'],
-                authorDateAH=get_authorDateAH(record['date'], record['type']),
-                authorDateCE=get_authorDateCE(record['date'], record['type']),
-                authorDateString=str(record['date'])
+                author_uri=record.version_uri.split(".")[0],
+                author_ar=record.author_ar,
+                author_lat=record.author_lat,
+                date=record.date,
+                authorDateAH=get_authorDateAH(record.date, record.type),
+                authorDateCE=get_authorDateCE(record.date, record.type),
+                authorDateString=str(record.date)
             )
         else:
             am = authorMeta.objects.filter(
-                author_uri=record['version_uri'].split(".")[0]).first()
+                author_uri=record.version_uri.split(".")[0]).first()
             am_created = False
+        insights.authors += am_created
 
-        if not textMeta.objects.filter(text_uri=record['text_uri']).exists():
+        if not textMeta.objects.filter(text_uri=record.text_uri).exists():
             item, created = textMeta.objects.get_or_create(
                 author_id=am,
-                text_uri=record['text_uri'],
-                title_ar=record['title_ar'],
-                title_lat=record['title_lat'],
-                text_type=record["type"],
-                tags=record["tags"]
+                text_uri=record.text_uri,
+                title_ar=record.title_ar,
+                title_lat=record.title_lat,
+                text_type=record.type,
+                tags=record.tags
             )
+            insights.books += created
         else:
-            item = textMeta.objects.filter(text_uri=record['text_uri']).first()
+            item = textMeta.objects.filter(text_uri=record.text_uri).first()
 
-        versionMeta.objects.get_or_create(
+        version, created = versionMeta.objects.get_or_create(
             text_id=item,
-            version_id=record['version_id'],
-            version_uri=record['version_uri'],
-            char_length=record['char_length'],
-            tok_length=record['tok_length'],
-            url=record['url'],
-            ed_info=record['ed_info'],
-            tags=record['tags'],
-            annotation_status=record['annotation_status'],
-            status=record['status'],
-            #language = record['version_lang']
-            version_lang=record['version_lang']
+            version_id=record.version_id,
+            version_uri=record.version_uri,
+            char_length=record.char_length,
+            tok_length=record.tok_length,
+            url=record.url,
+            ed_info=record.ed_info,
+            tags=record.tags,
+            annotation_status=record.annotation_status,
+            status=record.status,
+            #language = record.version_lang
+            version_lang=record.version_lang
         )
+        if created:
+            insights.add_version(record.version_uri, record.tok_length, record.status)
         # name elements are not separately in the metadata file as it is now;
         # loading bogus data for now!
         if am_created:
             for lan in ("ar", "lat"):
-                name_elements = re.split(" *:: *", record['author_'+lan])
+                name_elements = re.split(" *:: *", getattr(record, 'author_'+lan))
                 while len(name_elements) < 5:
                     name_elements.append("")
                 random.shuffle(name_elements)
@@ -323,27 +399,6 @@ def load_records(records):
                     laqab=name_elements[3],
                     nisba=name_elements[4],
                 )
+    insights.apply()
+    return n_records
 
-
-def bulk_load(record):
-    # print(record['url'])
-    instance = [
-        # Book(
-        textMeta(
-            book_id=record['book_id'],
-            book_uri=record['book_uri'],
-            char_length=record['char_length'],
-            tok_length=record['tok_length'],
-            date=record['date'],
-            title_ar=record['title_ar'],
-            title_lat=record['title_lat'],
-            version_uri=record['version_uri'],
-            url=record['url'],
-            status=record['status'],
-            author_lat=record['author_lat'],
-            author_ar=record['author_ar'],
-            annotation_status=record['annotation_status']
-        )
-    ]
-    print(instance)
-    # Book.objects.bulk_create(instance)
@@ -1,42 +1,49 @@
-
-import json
-import csv
-from webbrowser import get
-from django.db import models
 from api.models import TextReuseStats
+from api.ingest import iter_stats_rows, load_stats_rows, start_checkpoint, finish_checkpoint
+from api.instrumentation import IngestReport
+from api.caching import bump_generation
 from django.core.management.base import BaseCommand
-import re
-import random
-import itertools
 
-from django.contrib.auth.models import User
 
 class Command(BaseCommand):
-    def handle(self, **options):
+    def add_arguments(self, parser):
         #C:\Users\smerchant\OneDrive\KITAB\Statistical Data\Release\Oct 2022
-        filename = '/mnt/c/Users/smerchant/OneDrive/KITAB/Statistical Data/Release/Oct 2022/stats-Oct2022_bi-dir.csv'
-        superusers = User.objects.filter(is_superuser=True)
-        for user in superusers:
-            print(user, superusers)
-        exit
-        TextReuseStats.objects.all().delete()
-
-        read_csv(filename)
+        parser.add_argument(
+            "filename", nargs="?",
+            default='/mnt/c/Users/smerchant/OneDrive/KITAB/Statistical Data/Release/Oct 2022/stats-Oct2022_bi-dir.csv',
+            help="(tab-separated) bi-directional text reuse stats file")
+        parser.add_argument(
+            "--batch-size", type=int, default=10000,
+            help="number of rows per insert batch")
+        parser.add_argument(
+            "--raw", action="store_true",
+            help="insert the rows with cursor.executemany instead of bulk_create (fastest)")
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="number of worker processes used to convert the csv rows")
+        parser.add_argument(
+            "--resume", action="store_true",
+            help="continue an unfinished load after the last committed batch "
+                 "(instead of deleting the stats and starting over)")
+        parser.add_argument(
+            "--report", dest="report_path",
+            help="path of the JSON file to which the timings of the load are written "
+                 "(default: ingest_reports/load_stats_data-<timestamp>.json)")
 
+    def handle(self, **options):
+        report = IngestReport("load_stats_data")
+        with report:
+            # every batch is committed with the number of rows loaded so far,
+            # so that a crashed load can be resumed:
+            checkpoint = start_checkpoint("load_stats_data", options["filename"],
+                                          resume=options["resume"])
+            if not options["resume"]:
+                with report.phase("delete"):
+                    TextReuseStats.objects.all().delete()
 
-def read_csv(filename):
-    record = {}
-    with open(filename, 'r', encoding='utf-8') as f:
-    
-        reader = csv.DictReader(f, delimiter='\t')
-        #for data in itertools.islice(reader, 300):
-        for data in (reader):
-            TextReuseStats.objects.get_or_create(
-            book_1 = data['_T1'],
-            book_2 = data['_T2'],
-            instances_count=data['instances'],
-            book1_word_match=data['WM1_Total'],
-            book2_word_match=data['WM2_Total'],
-            book1_match_book2_per=data['WM_B1inB2'],
-            book2_match_book1_per=data['WM_B2inB1'],
-            )
+            chunks = iter_stats_rows(options["filename"], workers=options["workers"],
+                                     chunk_size=options["batch_size"], skip=checkpoint.offset)
+            load_stats_rows(chunks, raw=options["raw"], report=report, checkpoint=checkpoint)
+            finish_checkpoint(checkpoint)
+            bump_generation()
+        report.write(options["report_path"])
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from api.search import rebuild_search_index
+from api.caching import bump_generation
+
+
+class Command(BaseCommand):
+    """Rebuild the full-text search index of the authors, texts and versions
+    (see api/search.py).
+
+    NB: load_data2 rebuilds the index after loading the data,
+    so this is only needed after the data was changed in another way
+    (e.g., in the admin interface), after the index tables were created,
+    or after a migration dropped the triggers of the normalized field indexes."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="number of documents inserted per query")
+
+    def handle(self, **options):
+        n_docs = rebuild_search_index(batch_size=options["batch_size"])
+        if n_docs is None:
+            print("The database has no search index tables (see migration 0012_search_index)")
+        else:
+            print("Indexed {} authors, texts and versions".format(n_docs))
+            # the cached counts of searches may have changed:
+            bump_generation()
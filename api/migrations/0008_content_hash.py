@@ -0,0 +1,28 @@
+# Generated by Django 3.2.6 on 2026-10-18 14:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_rename_number_of_unique_versions_corpusinsights_number_of_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='authormeta',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='textmeta',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='versionmeta',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
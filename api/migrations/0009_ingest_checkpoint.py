@@ -0,0 +1,24 @@
+# Generated by Django 3.2.6 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestCheckpoint',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('command', models.CharField(max_length=50, unique=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('state', models.JSONField(blank=True, default=dict)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
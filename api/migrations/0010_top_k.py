@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-18 15:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_ingest_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='corpusinsights',
+            name='top_k',
+            field=models.IntegerField(default=10),
+        ),
+        migrations.AlterField(
+            model_name='versionmeta',
+            name='tok_length',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.6 on 2026-10-18 15:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_top_k'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionFacet',
+            fields=[
+                ('version', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='facet', serialize=False, to='api.versionmeta')),
+                ('century', models.IntegerField(blank=True, null=True)),
+                ('status', models.CharField(blank=True, max_length=3)),
+                ('annotation_status', models.CharField(blank=True, max_length=50)),
+                ('version_lang', models.CharField(blank=True, max_length=3)),
+                ('text_type', models.CharField(blank=True, max_length=10)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VersionFacetTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.CharField(db_index=True, max_length=100)),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facet_tags', to='api.versionmeta')),
+            ],
+        ),
+    ]
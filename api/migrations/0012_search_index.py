@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+# FTS5 tables of the search index (see api/search.py);
+# they are only created in SQLite databases that support the trigram tokenizer
+# (SQLite >= 3.34), in other databases the search uses LIKE conditions:
+SEARCH_TABLES = ["api_author_search", "api_text_search", "api_version_search"]
+
+
+def create_search_tables(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        options = [row[0] for row in cursor.fetchall()]
+        if "ENABLE_FTS5" not in options or connection.Database.sqlite_version_info < (3, 34):
+            print("SQLite does not support FTS5 trigram tables; the search index is not created")
+            return
+        for table in SEARCH_TABLES:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5("
+                "content, content='', tokenize='trigram')".format(table))
+
+
+def drop_search_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_version_facets'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_tables, drop_search_tables),
+    ]
@@ -0,0 +1,111 @@
+# Generated by Django 3.2.6 on 2026-10-18 15:23
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+# fields that get a normalized copy (the "_norm" field), per model:
+NORMALIZED_FIELDS = {
+    "authorMeta": ["author_ar", "author_lat"],
+    "textMeta": ["title_ar", "title_lat"],
+    "personName": ["shuhra", "nasab", "kunya", "ism", "laqab", "nisba"],
+}
+
+# a copy of the normalization of api/normalization.py at the time of this migration
+# (the migration must keep working if that module changes):
+REPLACEMENTS = str.maketrans({
+    "ٱ": "ا",  # alef wasla
+    "ة": "ه",  # ta marbuta
+    "ـ": None,  # tatweel
+    "ʿ": None, "ʾ": None, "ʻ": None, "ʼ": None, "'": None, "`": None, "‘": None, "’": None,
+    "ŧ": None,  # ta marbuta in the OpenITI transliteration (e.g., Ḥanīfaŧ)
+    "đ": "d", "Đ": "d",
+})
+
+
+def normalize(s):
+    if not s:
+        return ""
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(c for c in s if unicodedata.category(c) != "Mn")
+    s = s.translate(REPLACEMENTS).casefold()
+    return " ".join(s.split())
+
+
+def fill_normalized_fields(apps, schema_editor, batch_size=1000):
+    """Normalize the names and titles that are already in the database
+    (in batches, so that the tables are not loaded into memory at once)"""
+    for model_name, fields in NORMALIZED_FIELDS.items():
+        model = apps.get_model("api", model_name)
+        norm_fields = [field + "_norm" for field in fields]
+        batch = []
+        for obj in model.objects.only("pk", *fields).order_by().iterator(chunk_size=batch_size):
+            for field in fields:
+                setattr(obj, field + "_norm", normalize(getattr(obj, field))[:255])
+            batch.append(obj)
+            if len(batch) == batch_size:
+                model.objects.bulk_update(batch, norm_fields)
+                batch = []
+        model.objects.bulk_update(batch, norm_fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='authormeta',
+            name='author_ar_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='authormeta',
+            name='author_lat_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='personname',
+            name='ism_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='personname',
+            name='kunya_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='personname',
+            name='laqab_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='personname',
+            name='nasab_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='personname',
+            name='nisba_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='personname',
+            name='shuhra_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='textmeta',
+            name='title_ar_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='textmeta',
+            name='title_lat_norm',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.RunPython(fill_normalized_fields, migrations.RunPython.noop),
+    ]
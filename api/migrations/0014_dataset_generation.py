@@ -0,0 +1,22 @@
+# Generated by Django 3.2.6 on 2026-10-18 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_normalized_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetGeneration',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('generation', models.BigIntegerField(default=0)),
+                ('table_sizes', models.JSONField(blank=True, default=dict)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 3.2.6 on 2026-10-18 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_dataset_generation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='authormeta',
+            index=models.Index(fields=['date'], name='api_author_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='authormeta',
+            index=models.Index(fields=['authorDateAH'], name='api_author_date_ah_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='textmeta',
+            index=models.Index(fields=['title_ar'], name='api_text_title_ar_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='textmeta',
+            index=models.Index(fields=['title_lat'], name='api_text_title_lat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='versionmeta',
+            index=models.Index(fields=['version_uri'], name='api_version_uri_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='versionmeta',
+            index=models.Index(fields=['char_length'], name='api_version_char_length_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='versionmeta',
+            index=models.Index(fields=['version_lang'], name='api_version_lang_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='versionmeta',
+            index=models.Index(fields=['annotation_status'], name='api_version_annotation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='placemeta',
+            index=models.Index(fields=['thuraya_uri'], name='api_place_thuraya_uri_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='relationtype',
+            index=models.Index(fields=['name'], name='api_relationtype_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='textreusestats',
+            index=models.Index(fields=['instances_count'], name='api_reuse_instances_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='textreusestats',
+            index=models.Index(fields=['book1_word_match'], name='api_reuse_book1_words_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='textreusestats',
+            index=models.Index(fields=['book2_word_match'], name='api_reuse_book2_words_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='textreusestats',
+            index=models.Index(fields=['book1_match_book2_per'], name='api_reuse_book1_per_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='textreusestats',
+            index=models.Index(fields=['book2_match_book1_per'], name='api_reuse_book2_per_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='versionmeta',
+            index=models.Index(fields=['status', 'tok_length'], name='api_version_status_tok_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='a2brelation',
+            index=models.Index(fields=['text_a_id', 'text_b_id'], name='api_relation_texts_idx'),
+        ),
+    ]
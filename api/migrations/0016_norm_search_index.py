@@ -0,0 +1,69 @@
+from django.db import migrations
+
+
+# FTS5 trigram tables for the filters on the normalized fields (see api/search.py):
+# table name: (indexed table, normalized columns).
+# The tables use the indexed table as their content, and triggers keep them
+# up to date when rows are inserted, updated or deleted;
+# they are only created in SQLite databases that support the trigram tokenizer
+# (SQLite >= 3.34), in other databases the filters use LIKE conditions.
+# NB: a migration that rebuilds one of the indexed tables (e.g., an AlterField in SQLite)
+# drops its triggers; the filters then fall back to LIKE conditions until
+# the rebuild_search_index command (or load_data2) has created them again (see api/search.py).
+NORM_TABLES = {
+    "api_author_norm": ("api_authormeta", ["author_ar_norm", "author_lat_norm"]),
+    "api_text_norm": ("api_textmeta", ["title_ar_norm", "title_lat_norm"]),
+    "api_name_norm": ("api_personname", ["shuhra_norm", "nasab_norm", "kunya_norm",
+                                         "ism_norm", "laqab_norm", "nisba_norm"]),
+}
+
+
+def create_norm_tables(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        options = [row[0] for row in cursor.fetchall()]
+        if "ENABLE_FTS5" not in options or connection.Database.sqlite_version_info < (3, 34):
+            print("SQLite does not support FTS5 trigram tables; the normalized fields are not indexed")
+            return
+        for table, (content_table, columns) in NORM_TABLES.items():
+            names = ", ".join(columns)
+            new_values = ", ".join("new." + column for column in columns)
+            old_values = ", ".join("old." + column for column in columns)
+            delete = "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.id, {2});".format(
+                table, names, old_values)
+            insert = "INSERT INTO {}(rowid, {}) VALUES (new.id, {});".format(table, names, new_values)
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5("
+                "{}, content='{}', content_rowid='id', tokenize='trigram')".format(table, names, content_table))
+            cursor.execute("CREATE TRIGGER IF NOT EXISTS {}_insert AFTER INSERT ON {} BEGIN {} END".format(
+                table, content_table, insert))
+            cursor.execute("CREATE TRIGGER IF NOT EXISTS {}_delete AFTER DELETE ON {} BEGIN {} END".format(
+                table, content_table, delete))
+            cursor.execute("CREATE TRIGGER IF NOT EXISTS {}_update AFTER UPDATE OF {} ON {} BEGIN {} {} END".format(
+                table, names, content_table, delete, insert))
+            # index the rows that are already in the table:
+            cursor.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(table))
+
+
+def drop_norm_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table in NORM_TABLES:
+            for trigger in ("insert", "delete", "update"):
+                cursor.execute("DROP TRIGGER IF EXISTS {}_{}".format(table, trigger))
+            cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_norm_tables, drop_norm_tables),
+    ]
@@ -1,5 +1,7 @@
 from django.db import models
 
+from api.normalization import set_normalized_fields
+
 
 class authorMeta(models.Model):
     author_uri = models.CharField(max_length=50, unique=True, null=False)
@@ -9,6 +11,13 @@ class authorMeta(models.Model):
     authorDateAH = models.IntegerField(null=True, blank=True)
     authorDateCE = models.IntegerField(null=True, blank=True)
     authorDateString = models.CharField(max_length=255, blank=True)
+    # normalized copies of the name fields, used by the filters
+    # (see api/normalization.py; they are indexed in the FTS5 table api_author_norm, see api/search.py):
+    author_ar_norm = models.CharField(max_length=255, blank=True)
+    author_lat_norm = models.CharField(max_length=255, blank=True)
+    # hash of the metadata fields of the author, used for incremental (delta) loading
+    # (empty for authors that were not created from the metadata file):
+    content_hash = models.CharField(max_length=40, blank=True)
     # Create a relationship between two persons (e.g., person A is a student of person B)
     # using a many-to-many field:
     related_persons = models.ManyToManyField(
@@ -43,6 +52,17 @@ class authorMeta(models.Model):
 
     # NB: person to text relations are defined in the textMeta model
 
+    class Meta:
+        # (the indexes are used by the filters and orderings of the lists, see api/filters.py and api/tests.py)
+        indexes = [
+            models.Index(fields=["date"], name="api_author_date_idx"),
+            models.Index(fields=["authorDateAH"], name="api_author_date_ah_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        set_normalized_fields(self)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.author_uri
 
@@ -54,6 +74,12 @@ class textMeta(models.Model):
     # document, inscription, ...
     text_type = models.CharField(max_length=10, blank=True)
     tags = models.CharField(max_length=255, blank=True)
+    # normalized copies of the titles, used by the filters
+    # (see api/normalization.py; they are indexed in the FTS5 table api_text_norm, see api/search.py):
+    title_ar_norm = models.CharField(max_length=255, blank=True)
+    title_lat_norm = models.CharField(max_length=255, blank=True)
+    # hash of the metadata fields of the text, used for incremental (delta) loading:
+    content_hash = models.CharField(max_length=40, blank=True)
     author_id = models.ForeignKey(
         authorMeta, related_name='texts', related_query_name="text", on_delete=models.CASCADE)
     # BUT: one text can have more than one author! So, we should rather have:
@@ -95,6 +121,17 @@ class textMeta(models.Model):
         through_fields=("text_a_id", "place_b_id"),
     )
 
+    class Meta:
+        # (for the orderings of the version list on the titles, see api/tests.py)
+        indexes = [
+            models.Index(fields=["title_ar"], name="api_text_title_ar_idx"),
+            models.Index(fields=["title_lat"], name="api_text_title_lat_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        set_normalized_fields(self)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.text_uri
 
@@ -108,9 +145,21 @@ class personName(models.Model):
     ism = models.CharField(max_length=255, blank=True)
     laqab = models.CharField(max_length=255, blank=True)
     nisba = models.CharField(max_length=255, blank=True)
+    # normalized copies of the name elements, used by the filters
+    # (see api/normalization.py; they are indexed in the FTS5 table api_name_norm, see api/search.py):
+    shuhra_norm = models.CharField(max_length=255, blank=True)
+    nasab_norm = models.CharField(max_length=255, blank=True)
+    kunya_norm = models.CharField(max_length=255, blank=True)
+    ism_norm = models.CharField(max_length=255, blank=True)
+    laqab_norm = models.CharField(max_length=255, blank=True)
+    nisba_norm = models.CharField(max_length=255, blank=True)
     author_id = models.ForeignKey(authorMeta, related_name='personNames',
                                   related_query_name="personName", on_delete=models.DO_NOTHING)
 
+    def save(self, *args, **kwargs):
+        set_normalized_fields(self)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.language
 
@@ -121,7 +170,7 @@ class versionMeta(models.Model):
     text_id = models.ForeignKey(textMeta, related_name='versions',
                                 related_query_name="version", on_delete=models.CASCADE)
     char_length = models.IntegerField(null=True, blank=True)
-    tok_length = models.IntegerField(null=True, blank=True)
+    tok_length = models.IntegerField(null=True, blank=True, db_index=True)
     url = models.CharField(max_length=255, blank=True)
     editor = models.CharField(max_length=100, blank=True)
     edition_place = models.CharField(max_length=100, blank=True)
@@ -132,10 +181,46 @@ class versionMeta(models.Model):
     tags = models.CharField(max_length=100, blank=True)
     status = models.CharField(max_length=3, blank=True)
     annotation_status = models.CharField(max_length=50, blank=True)
+    # hash of the metadata fields of the version, used for incremental (delta) loading:
+    content_hash = models.CharField(max_length=40, blank=True)
+
+    class Meta:
+        # (the indexes are used by the filters and orderings of the lists, see api/filters.py and api/tests.py;
+        # the free-text fields (editor, publisher, tags, ...) are not indexed,
+        # because their substring filters cannot use an index)
+        indexes = [
+            models.Index(fields=["version_uri"], name="api_version_uri_idx"),
+            models.Index(fields=["char_length"], name="api_version_char_length_idx"),
+            models.Index(fields=["version_lang"], name="api_version_lang_idx"),
+            models.Index(fields=["annotation_status"], name="api_version_annotation_idx"),
+            # for the status filter, also in combination with the tok_length filters and ordering
+            # (e.g., /version/all/?status=pri&ordering=-tok_length):
+            models.Index(fields=["status", "tok_length"], name="api_version_status_tok_idx"),
+        ]
 
     def __str__(self):
         return self.version_uri
 
+
+class VersionFacet(models.Model):
+    """Facet values of a version, copied from the version, its text and its author
+    so that the facet counts can be computed without joins (see api.facets).
+    Refreshed by the load_data2 command."""
+    version = models.OneToOneField(versionMeta, primary_key=True, related_name="facet",
+                                   on_delete=models.CASCADE)
+    # century of the author's death date (AH), e.g. 4 for 310 AH:
+    century = models.IntegerField(null=True, blank=True)
+    status = models.CharField(max_length=3, blank=True)
+    annotation_status = models.CharField(max_length=50, blank=True)
+    version_lang = models.CharField(max_length=3, blank=True)
+    text_type = models.CharField(max_length=10, blank=True)
+
+
+class VersionFacetTag(models.Model):
+    """One tag of a version (the tags field of versionMeta, split on " :: ")"""
+    version = models.ForeignKey(versionMeta, related_name="facet_tags", on_delete=models.CASCADE)
+    tag = models.CharField(max_length=100, db_index=True)
+
 # class regionMeta (models.Model):
 #     thurayaURI = models.CharField(max_length=100)
 #     name_ar = models.CharField(max_length=100,blank=True)
@@ -162,6 +247,10 @@ class placeMeta (models.Model):
     )
     # region = models.ManyToManyField(regionMeta,related_name='places',related_query_name="place")
 
+    class Meta:
+        # (for the uri filters of the relations, see api/filters.py)
+        indexes = [models.Index(fields=["thuraya_uri"], name="api_place_thuraya_uri_idx")]
+
     def __str__(self):
         return self.person_id + "_" + self.place_id
 
@@ -176,6 +265,10 @@ class relationType(models.Model):
     # person_person, place_place, person_place, ...
     entities = models.CharField(max_length=50, blank=True)
 
+    class Meta:
+        # (for the relation_type filter and ordering of the relations, see api/filters.py)
+        indexes = [models.Index(fields=["name"], name="api_relationtype_name_idx")]
+
     def __str__(self):
         return self.relation_name
 
@@ -225,6 +318,13 @@ class a2bRelation (models.Model):
     authority = models.CharField(max_length=100, blank=True)
     confidence = models.CharField(max_length=100, blank=True)
 
+    class Meta:
+        indexes = [
+            # for the related texts of a text (textMeta.related_texts),
+            # without reading the relations table (e.g., /text/all/?related_text_title_lat=...):
+            models.Index(fields=["text_a_id", "text_b_id"], name="api_relation_texts_idx"),
+        ]
+
 # class text2textRelation (models.Model):
 #     #text1_id = models.ForeignKey(textMeta,related_name='text1_relations',related_query_name="text1_relation",on_delete=models.DO_NOTHING)
 #     #text2_id = models.ForeignKey(textMeta,related_name='text2_relations',related_query_name="text2_relation",on_delete=models.DO_NOTHING)
@@ -272,6 +372,17 @@ class TextReuseStats(models.Model):
     book2_match_book1_per = models.DecimalField(
         null=True, blank=True, max_digits=5, decimal_places=2)
 
+    class Meta:
+        # (the indexes are used by the range filters and orderings of /text-reuse-stats/;
+        # load_stats_data drops them while it loads the data, see api.ingest.load_stats_rows)
+        indexes = [
+            models.Index(fields=["instances_count"], name="api_reuse_instances_idx"),
+            models.Index(fields=["book1_word_match"], name="api_reuse_book1_words_idx"),
+            models.Index(fields=["book2_word_match"], name="api_reuse_book2_words_idx"),
+            models.Index(fields=["book1_match_book2_per"], name="api_reuse_book1_per_idx"),
+            models.Index(fields=["book2_match_book1_per"], name="api_reuse_book2_per_idx"),
+        ]
+
 
 class CorpusInsights(models.Model):
     id = models.AutoField(primary_key=True)
@@ -282,3 +393,45 @@ class CorpusInsights(models.Model):
     largest_book = models.IntegerField(null=True, blank=True)
     total_word_count_pri = models.IntegerField(null=True, blank=True)
     top_10_book_by_word_count = models.JSONField(null=True, blank=True)
+    # number of books in top_10_book_by_word_count:
+    top_k = models.IntegerField(default=10)
+
+
+class IngestCheckpoint(models.Model):
+    """Progress of an unfinished load (see api.ingest.start_checkpoint):
+    the number of input rows of the file that have been committed
+    to the database, and the state needed to finish the load
+    (e.g., the SQL of the indexes that were dropped for the load).
+    The checkpoint is deleted when the load is finished."""
+    id = models.AutoField(primary_key=True)
+    command = models.CharField(max_length=50, unique=True)
+    filename = models.CharField(max_length=255)
+    offset = models.BigIntegerField(default=0)
+    state = models.JSONField(default=dict, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def advance(self, n_rows):
+        """Record that n_rows more input rows have been committed
+        (call this inside the transaction that writes the rows)"""
+        self.offset += n_rows
+        self.save(update_fields=["offset", "updated"])
+
+    def __str__(self):
+        return "{} {} (row {})".format(self.command, self.filename, self.offset)
+
+
+class DatasetGeneration(models.Model):
+    """Generation of the data in the database: a counter that is incremented
+    by the load commands whenever they have changed the data (see api.caching.bump_generation),
+    together with the number of rows in the tables of the paginated lists at that time.
+
+    Cached results (e.g., the counts of the paginated lists) are keyed on the generation,
+    so that they are no longer used after the data was reloaded."""
+    id = models.AutoField(primary_key=True)
+    generation = models.BigIntegerField(default=0)
+    # number of rows per table (table name: number of rows):
+    table_sizes = models.JSONField(default=dict, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "generation {} ({})".format(self.generation, self.updated)
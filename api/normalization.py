@@ -0,0 +1,62 @@
+"""Normalization of Arabic and transliterated names and titles.
+
+The name and title filters (author_ar, title_lat, shuhra, nisba, ...)
+should find "Abū Ḥanīfaŧ" when the user types "Abu Hanifa",
+and "الإمام" when the user types "الامام". Therefore, the fields
+that are used by these filters have a normalized copy (a "_norm" field,
+e.g. authorMeta.author_lat_norm), which is filled when the objects
+are saved or created by the loaders, and the filters normalize
+the filter value in the same way before they look it up in these fields.
+
+Normalization:
+
+* all diacritics (combining marks) are removed: Latin accents and dots
+  (ā > a, Ḥ > H) and Arabic vowels, shadda, sukun, hamza above/below alef
+  (أ إ آ > ا) etc.
+* alef wasla is replaced by alef, ta marbuta by ha (ة > ه)
+* ʿayn and hamza signs (ʿ ʾ and apostrophes) and tatweel are removed,
+  as is the transliteration of ta marbuta (ŧ)
+* the string is lowercased and whitespace is collapsed
+"""
+
+import unicodedata
+
+
+# suffix of the normalized copy of a field:
+NORM_SUFFIX = "_norm"
+
+# characters that are replaced (or removed) after the diacritics were removed:
+REPLACEMENTS = str.maketrans({
+    "ٱ": "ا",  # alef wasla
+    "ة": "ه",  # ta marbuta
+    "ـ": None,  # tatweel
+    "ʿ": None, "ʾ": None, "ʻ": None, "ʼ": None, "'": None, "`": None, "‘": None, "’": None,
+    "ŧ": None,  # ta marbuta in the OpenITI transliteration (e.g., Ḥanīfaŧ)
+    "đ": "d", "Đ": "d",
+})
+
+
+def normalize(s):
+    """Return the normalized form of a string (see the module docstring)"""
+    if not s:
+        return ""
+    # decompose the characters into base characters and combining marks,
+    # and remove the marks:
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(c for c in s if unicodedata.category(c) != "Mn")
+    s = s.translate(REPLACEMENTS).casefold()
+    return " ".join(s.split())
+
+
+def get_normalized_fields(model):
+    """Return (field, normalized field) name pairs of a model"""
+    names = [field.name for field in model._meta.concrete_fields]
+    return [(name[:-len(NORM_SUFFIX)], name) for name in names if name.endswith(NORM_SUFFIX)]
+
+
+def set_normalized_fields(obj):
+    """Fill the normalized fields of a model instance; return the instance"""
+    for field, norm_field in get_normalized_fields(type(obj)):
+        max_length = obj._meta.get_field(norm_field).max_length
+        setattr(obj, norm_field, normalize(getattr(obj, field))[:max_length])
+    return obj
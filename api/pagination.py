@@ -0,0 +1,222 @@
+"""Pagination of the list endpoints.
+
+CustomPagination has two modes:
+
+* page numbers (default): ?page=3&page_size=50
+  Every page runs a COUNT(*) of the filtered list, and an OFFSET query
+  that has to skip all rows of the previous pages.
+
+* cursor (keyset) pagination: ?cursor=&page_size=50 for the first page;
+  the next and previous links contain the cursor of the next/previous page.
+  Instead of skipping rows with OFFSET, the page starts right after the
+  ordering values of the last row of the previous page
+  (e.g., WHERE tok_length < 12345 OR (tok_length = 12345 AND id > 678)),
+  which an index on the ordering field can seek to directly,
+  so every page costs the same, however deep it is.
+  The primary key is added to the ordering to make it unique.
+  The total count is only computed if ?count=true is given.
+
+  Cursor pagination works with any ordering on model fields (e.g., ?ordering=-tok_length);
+  results that are ordered by search relevance are paginated by page number.
+
+In both modes, the counts are cached until the data is reloaded (see api/caching.py).
+"""
+
+import base64
+import json
+
+from django.core.paginator import Paginator as DjangoPaginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from api.caching import cached_count, get_count_key
+
+
+def get_keyset_ordering(queryset):
+    """Return the ordering of a queryset as a list of (field, descending) tuples,
+    with the primary key added as last field;
+    or None if the queryset is ordered by something other than model fields"""
+    query = queryset.query
+    if query.extra_order_by or not all(isinstance(o, str) for o in query.order_by):
+        return None
+    ordering = []
+    for o in query.order_by:
+        if o == "?":
+            return None
+        ordering.append((o.lstrip("-"), o.startswith("-")))
+    if not any(field in ("pk", queryset.model._meta.pk.name) for field, desc in ordering):
+        ordering.append(("pk", False))
+    return ordering
+
+
+def order_keyset(queryset, ordering, reverse=False):
+    """Order a queryset by the keyset ordering (reversed for the previous page).
+
+    NULL values are always sorted as the smallest values
+    (the SQLite default), so that they can be compared in seek_keyset"""
+    order_by = []
+    for field, desc in ordering:
+        if desc != reverse:
+            order_by.append(F(field).desc(nulls_last=True))
+        else:
+            order_by.append(F(field).asc(nulls_first=True))
+    return queryset.order_by(*order_by)
+
+
+def seek_keyset(ordering, values, reverse=False):
+    """Build a filter for the rows that come after the row with these ordering values
+    (or before it, if reverse is True)"""
+    after = Q(pk__in=[])
+    equal = Q()
+    for (field, desc), value in zip(ordering, values):
+        if value is None:
+            greater = Q(**{field + "__isnull": False})
+            smaller = Q(pk__in=[])
+            same = Q(**{field + "__isnull": True})
+        else:
+            greater = Q(**{field + "__gt": value})
+            smaller = Q(**{field + "__lt": value}) | Q(**{field + "__isnull": True})
+            same = Q(**{field: value})
+        after |= equal & (smaller if desc != reverse else greater)
+        equal &= same
+    return after
+
+
+def encode_cursor(values, reverse=False):
+    s = json.dumps({"k": values, "r": reverse}, cls=DjangoJSONEncoder)
+    return base64.urlsafe_b64encode(s.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Return the ordering values and the direction of a cursor
+    (raise NotFound if the cursor is invalid)"""
+    try:
+        d = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return list(d["k"]), bool(d["r"])
+    except (ValueError, TypeError, KeyError, UnicodeEncodeError):
+        raise NotFound("Invalid cursor")
+
+
+class CachedCountPaginator(DjangoPaginator):
+    """Paginator that takes the count from the count cache (see api/caching.py)"""
+    def __init__(self, object_list, per_page, count_key, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_key = count_key
+
+    @cached_property
+    def count(self):
+        return cached_count(self.object_list, self.count_key)
+
+
+'''' Get all books by pagination, filter and search enable. we can select fields also.
+Example: /book/all/?fields=book_id or /book/all/?search=JK000001 or book/all/?fields=book_id&search=JK000001
+'''
+class CustomPagination(PageNumberPagination):
+        page_size = 10
+        page_size_query_param = 'page_size'
+        max_page_size = 200
+        last_page_strings = ('the_end',)
+        cursor_query_param = 'cursor'
+        count_query_param = 'count'
+
+        cursor_mode = False
+
+        def django_paginator_class(self, queryset, page_size):
+            return CachedCountPaginator(queryset, page_size, self.count_key)
+
+        def paginate_queryset(self, queryset, request, view=None):
+            self.count_key = get_count_key(request)
+            if self.cursor_query_param in request.query_params:
+                ordering = get_keyset_ordering(queryset)
+                if ordering is not None:
+                    return self.paginate_keyset(queryset, request, ordering)
+            return super().paginate_queryset(queryset, request, view)
+
+        def paginate_keyset(self, queryset, request, ordering):
+            """Return the page after (or before) the cursor in the request.
+
+            The queryset can be a model queryset (returns a list of objects)
+            or a values_list("pk", flat=True) queryset (returns a list of primary keys)"""
+            self.cursor_mode = True
+            self.request = request
+            self.ordering = ordering
+            self.page_size = self.get_page_size(request)
+            cursor = request.query_params[self.cursor_query_param]
+            values, reverse = decode_cursor(cursor) if cursor else (None, False)
+
+            self.count = None
+            if request.query_params.get(self.count_query_param, "").lower() in ("1", "true", "yes"):
+                self.count = cached_count(queryset, self.count_key)
+
+            rows = order_keyset(queryset, ordering, reverse)
+            if values is not None:
+                if len(values) != len(ordering):
+                    raise NotFound("Invalid cursor")
+                rows = rows.filter(seek_keyset(ordering, values, reverse))
+            fields = [field for field, desc in ordering]
+            rows = list(rows.values_list("pk", *fields)[:self.page_size + 1])
+            has_more = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            if reverse:
+                rows.reverse()
+                self.has_previous, self.has_next = has_more, True
+            else:
+                self.has_previous, self.has_next = values is not None, has_more
+            self.first_values = list(rows[0][1:]) if rows else None
+            self.last_values = list(rows[-1][1:]) if rows else None
+
+            pks = [row[0] for row in rows]
+            if queryset.query.values_select:
+                return pks
+            objs = queryset.in_bulk(pks)
+            return [objs[pk] for pk in pks]
+
+        def get_cursor_link(self, values, reverse):
+            url = self.request.build_absolute_uri()
+            url = remove_query_param(url, self.page_query_param)
+            return replace_query_param(url, self.cursor_query_param, encode_cursor(values, reverse))
+
+        def get_next_link(self):
+            if not self.cursor_mode:
+                return super().get_next_link()
+            if not self.has_next or self.last_values is None:
+                return None
+            return self.get_cursor_link(self.last_values, False)
+
+        def get_previous_link(self):
+            if not self.cursor_mode:
+                return super().get_previous_link()
+            if not self.has_previous or self.first_values is None:
+                return None
+            return self.get_cursor_link(self.first_values, True)
+
+        def get_paginated_response(self, data):
+            if self.cursor_mode:
+                return Response({
+                    'links': {
+                        'next': self.get_next_link(),
+                        'previous': self.get_previous_link()
+                    },
+                    'page_size': self.page_size,
+                    'has_pages': self.has_next,
+                    'count': self.count,  # None, unless ?count=true
+                    'pages': None,
+                    'results': data
+                })
+
+            return Response({
+                'links': {
+                    'next': self.get_next_link(),
+                    'previous': self.get_previous_link()
+                },
+                'page_size': self.page.paginator.per_page,
+                'has_pages': self.page.has_next(),
+                'count': self.page.paginator.count,
+                'pages': self.page.paginator.num_pages,
+                'results': data
+            })
@@ -0,0 +1,284 @@
+"""Full-text search index for the ?search= parameter of the author, text and version lists.
+
+DRF's SearchFilter turns every search term into an OR of `LIKE '%term%'`
+conditions on all search_fields, which are spread over the author, text,
+version and personName tables; every search therefore joins these tables
+(multiplying the rows) and scans all of them.
+
+Instead, the values of all search fields of an author, text or version
+are concatenated into one document per object, which is stored in an SQLite
+FTS5 table with the trigram tokenizer (api_author_search, api_text_search,
+api_version_search; the rowid of the document is the primary key of the object).
+The trigram tokenizer matches any substring of at least 3 characters
+(case insensitive), just like icontains.
+
+IndexSearchFilter looks up the matching ids in the index and joins them
+to the list query, ordered by relevance (bm25) unless another ?ordering= is given.
+Search terms shorter than 3 characters (which the trigram index cannot match)
+are still looked up with the SearchFilter's LIKE conditions;
+if the database is not SQLite or the index tables do not exist,
+the normal SearchFilter is used.
+
+The index is rebuilt by load_data2 after loading the data,
+and by the rebuild_search_index command.
+
+The name and title filters look up their (normalized, see api/normalization.py)
+value in the normalized fields with a substring match, which cannot use
+a B-tree index. These fields are therefore indexed in FTS5 trigram tables
+as well (api_author_norm, api_text_norm and api_name_norm, with one column
+per normalized field); these tables are kept up to date by triggers
+(see migration 0016), so they do not need to be rebuilt.
+A migration that rebuilds one of the indexed tables (e.g., an AlterField in SQLite)
+drops its triggers, after which the table would no longer match the data:
+the filters then use LIKE conditions instead (see has_norm_index),
+until rebuild_search_index has created the triggers again.
+"""
+
+import collections
+
+from django.db import connections, transaction
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+
+from api.models import authorMeta, personName, textMeta, versionMeta
+from api.normalization import NORM_SUFFIX, get_normalized_fields
+
+
+# fields to be excluded from search (because they are not string fields):
+#excl_flds = ["id", "date", "authorDateAH", "authorDateCE", "tok_length", "char_length",  # numeric fields
+#             "text", "personName", "version", "author_id", "version_id", "text_id"]      # foreign key fields
+excl_flds = [
+    # numeric fields:
+    "id", "date", "authorDateAH", "authorDateCE", "tok_length", "char_length",
+    # foreign key fields:
+    "text", "personName", "version", "author_id", "version_id", "text_id",
+    "related_persons", "related_places", "related_texts", "place_relations",
+    "person_a_id", "person_b_id", "text_a_id", "text_b_id",
+    "place_a_id", "place_b_id", "relation_type", "parent_type",
+    # related fields:
+    'authormeta', 'textmeta', 'related_person_a', 'related_person_b',
+    "related_text_a", "related_text_b",
+    # internal fields and tables:
+    "content_hash", "facet", "facet_tags"]
+
+
+def get_search_fields(model, prefix=""):
+    # NB: the normalized copies of the name fields (see api/normalization.py) are not searched
+    return [prefix + field.name for field in model._meta.get_fields()
+            if (field.name not in excl_flds) and not field.name.endswith(NORM_SUFFIX)]
+
+
+# the search fields of the author, text and version lists
+# (the fields that are included in the search index documents):
+SEARCH_FIELDS = {
+    "author": get_search_fields(authorMeta)
+        + get_search_fields(textMeta, "text__")
+        + get_search_fields(versionMeta, "text__version__")
+        + get_search_fields(personName, "personName__"),
+    "text": get_search_fields(textMeta)
+        + get_search_fields(authorMeta, "author_id__")
+        + get_search_fields(personName, "author_id__personName__")
+        + get_search_fields(versionMeta, "version__"),
+    "version": get_search_fields(versionMeta)
+        + get_search_fields(textMeta, "text_id__")
+        + get_search_fields(authorMeta, "text_id__author_id__")
+        + get_search_fields(personName, "text_id__author_id__personName__"),
+}
+
+# model and FTS5 table of every search index:
+SEARCH_INDEXES = {
+    "author": (authorMeta, "api_author_search"),
+    "text": (textMeta, "api_text_search"),
+    "version": (versionMeta, "api_version_search"),
+}
+
+# FTS5 tables of the normalized fields of every model:
+NORM_INDEXES = {
+    authorMeta: "api_author_norm",
+    textMeta: "api_text_norm",
+    personName: "api_name_norm",
+}
+
+# triggers that keep the FTS5 tables of the normalized fields up to date
+# (<table>_insert, <table>_delete and <table>_update):
+NORM_TRIGGERS = ["insert", "delete", "update"]
+
+# the trigram tokenizer cannot match shorter terms:
+MIN_TERM_LENGTH = 3
+
+
+# names of the tables and triggers in the databases (database name: set of names),
+# so that they are only looked up once per process:
+_table_names = dict()
+_trigger_names = dict()
+
+
+def has_table(table, using="default"):
+    """Check whether an FTS5 table exists in the (SQLite) database"""
+    conn = connections[using]
+    if conn.vendor != "sqlite":
+        return False
+    name = conn.settings_dict["NAME"]
+    if table not in _table_names.get(name, ()):
+        _table_names[name] = set(conn.introspection.table_names())
+    return table in _table_names[name]
+
+
+def has_norm_index(table, using="default"):
+    """Check whether an FTS5 table of the normalized fields exists in the (SQLite) database,
+    together with the triggers that keep it up to date"""
+    if not has_table(table, using):
+        return False
+    conn = connections[using]
+    name = conn.settings_dict["NAME"]
+    if name not in _trigger_names:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+            _trigger_names[name] = set(row[0] for row in cursor.fetchall())
+    return all("{}_{}".format(table, trigger) in _trigger_names[name] for trigger in NORM_TRIGGERS)
+
+
+def forget_tables(using="default"):
+    """Look up the tables and triggers of the database again on the next check
+    (after they were created or dropped)"""
+    name = connections[using].settings_dict["NAME"]
+    _table_names.pop(name, None)
+    _trigger_names.pop(name, None)
+
+
+def has_search_index(entity, using="default"):
+    """Check whether the search index table of an entity exists in the database"""
+    return has_table(SEARCH_INDEXES[entity][1], using)
+
+
+def build_documents(entity):
+    """Return a pk: document dictionary with the (unique) values
+    of all search fields of every object of an entity.
+
+    The fields are read in one query per related table
+    (e.g., for the authors: the author fields, the name fields,
+    the text fields and the version fields), so that the rows are not
+    multiplied by joining all one-to-many relations at once."""
+    model = SEARCH_INDEXES[entity][0]
+    paths = collections.defaultdict(list)
+    for field in SEARCH_FIELDS[entity]:
+        paths[field.rpartition("__")[0]].append(field)
+    docs = collections.defaultdict(dict)
+    for fields in paths.values():
+        for pk, *values in model.objects.values_list("pk", *fields).order_by().iterator():
+            docs[pk].update(dict.fromkeys(v for v in values if v))
+    # NB: values are separated by newlines, so that search terms
+    # (which cannot contain newlines) do not match across field boundaries:
+    return {pk: "\n".join(values) for pk, values in docs.items()}
+
+
+def create_norm_triggers(using="default"):
+    """Create the triggers of the FTS5 tables of the normalized fields
+    that are missing (e.g., because a migration rebuilt the indexed table),
+    and rebuild these FTS5 tables from the normalized fields"""
+    conn = connections[using]
+    for model, table in NORM_INDEXES.items():
+        if not has_table(table, using) or has_norm_index(table, using):
+            continue
+        content_table = model._meta.db_table
+        columns = [model._meta.get_field(norm_field).column for field, norm_field in get_normalized_fields(model)]
+        names = ", ".join(columns)
+        delete = "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.id, {2});".format(
+            table, names, ", ".join("old." + column for column in columns))
+        insert = "INSERT INTO {}(rowid, {}) VALUES (new.id, {});".format(
+            table, names, ", ".join("new." + column for column in columns))
+        with transaction.atomic(using=using), conn.cursor() as cursor:
+            cursor.execute("CREATE TRIGGER IF NOT EXISTS {}_insert AFTER INSERT ON {} BEGIN {} END".format(
+                table, content_table, insert))
+            cursor.execute("CREATE TRIGGER IF NOT EXISTS {}_delete AFTER DELETE ON {} BEGIN {} END".format(
+                table, content_table, delete))
+            cursor.execute("CREATE TRIGGER IF NOT EXISTS {}_update AFTER UPDATE OF {} ON {} BEGIN {} {} END".format(
+                table, names, content_table, delete, insert))
+            # the rows may have changed while there were no triggers:
+            cursor.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(table))
+        print("Created the triggers of", table)
+        forget_tables(using)
+
+
+def rebuild_search_index(batch_size=1000, using="default"):
+    """Rebuild the search indexes from the database
+    (and create the missing triggers of the FTS5 tables of the normalized fields);
+    return the number of indexed documents
+    (or None if the database has no search index tables)"""
+    n_docs = 0
+    conn = connections[using]
+    create_norm_triggers(using)
+    for entity, (model, table) in SEARCH_INDEXES.items():
+        if not has_search_index(entity, using):
+            return None
+        docs = list(build_documents(entity).items())
+        with transaction.atomic(using=using), conn.cursor() as cursor:
+            # the tables are contentless, so they can only be emptied with delete-all:
+            cursor.execute("INSERT INTO {0}({0}) VALUES ('delete-all')".format(table))
+            for i in range(0, len(docs), batch_size):
+                cursor.executemany(
+                    "INSERT INTO {}(rowid, content) VALUES (%s, %s)".format(table),
+                    docs[i:i+batch_size])
+        n_docs += len(docs)
+    return n_docs
+
+
+def build_match_query(terms):
+    """Build an FTS5 query that matches documents that contain all terms
+    (every term is quoted, so that it is matched as a literal substring)"""
+    return " AND ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+
+def search_index(queryset, entity, terms):
+    """Filter a queryset (of the model of the entity) to the objects
+    whose documents contain all terms, ordered by relevance"""
+    model, table = SEARCH_INDEXES[entity]
+    return queryset.extra(
+        tables=[table],
+        where=["{}.rowid = {}.{}".format(table, model._meta.db_table, model._meta.pk.column),
+               "{} MATCH %s".format(table)],
+        params=[build_match_query(terms)],
+        select={"search_rank": "{}.rank".format(table)},
+        order_by=["search_rank"])
+
+
+def norm_index_lookup(model, field_path, value, using="default"):
+    """Return a filter (lookup: value dictionary) that finds the objects of a model
+    whose normalized field (field_path, e.g. "text_id__author_id__personName__shuhra_norm")
+    contains the (normalized) value, using the FTS5 table of the normalized fields;
+    return None if the value is too short or the table (or one of its triggers) does not exist"""
+    if len(value) < MIN_TERM_LENGTH:
+        return None
+    path, _, field_name = field_path.rpartition("__")
+    for name in path.split("__") if path else []:
+        model = model._meta.get_field(name).related_model
+    table = NORM_INDEXES.get(model)
+    if table is None or not has_norm_index(table, using):
+        return None
+    query = "{} : {}".format(model._meta.get_field(field_name).column, build_match_query([value]))
+    lookup = path + "__pk__in" if path else "pk__in"
+    return {lookup: RawSQL("SELECT rowid FROM {0} WHERE {0} MATCH %s".format(table), [query])}
+
+
+class IndexSearchFilter(filters.SearchFilter):
+    """SearchFilter that looks up the search terms in the search index
+    of the view (view.search_index: "author", "text" or "version")"""
+    like_terms = None
+
+    def get_search_terms(self, request):
+        if self.like_terms is not None:
+            return self.like_terms
+        return super().get_search_terms(request)
+
+    def filter_queryset(self, request, queryset, view):
+        entity = getattr(view, "search_index", None)
+        terms = self.get_search_terms(request)
+        index_terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+        if not entity or not index_terms or not has_search_index(entity, queryset.db):
+            return super().filter_queryset(request, queryset, view)
+        queryset = search_index(queryset, entity, index_terms)
+        # look up the short terms with the LIKE conditions of the SearchFilter:
+        self.like_terms = [term for term in terms if len(term) < MIN_TERM_LENGTH]
+        if self.like_terms:
+            queryset = super().filter_queryset(request, queryset, view)
+        return queryset
@@ -3,12 +3,41 @@ from operator import truediv
 from rest_framework import serializers
 from .models import personName, textMeta, authorMeta, versionMeta, CorpusInsights, TextReuseStats, relationType, a2bRelation
 from rest_flex_fields import FlexFieldsModelSerializer
+from .normalization import NORM_SUFFIX
 
 '''
 Using drf-flex-fields app to select particular fields which allows fields to be expanded
 https://github.com/rsinger86/drf-flex-fields
 '''
 
+# fields that are only used internally (e.g., by the data loaders)
+# and should not be part of the API output
+# (as well as the normalized copies of the name and title fields, see api/normalization.py):
+INTERNAL_FIELDS = ("content_hash",)
+
+
+def get_internal_fields(model):
+    return tuple(f.name for f in model._meta.get_fields()
+                 if f.name in INTERNAL_FIELDS or f.name.endswith(NORM_SUFFIX))
+
+
+class ExcludeInternalFieldsMixin:
+    """Exclude the internal fields from the nested representations
+    that are generated automatically for related objects (`depth` > 0)"""
+
+    def build_nested_field(self, field_name, relation_info, nested_depth):
+        field_class, field_kwargs = super().build_nested_field(
+            field_name, relation_info, nested_depth)
+        model = relation_info.related_model
+        exclude = get_internal_fields(model)
+        if exclude:
+            class NestedSerializer(ExcludeInternalFieldsMixin, field_class):
+                class Meta(field_class.Meta):
+                    fields = None
+            NestedSerializer.Meta.exclude = exclude
+            field_class = NestedSerializer
+        return field_class, field_kwargs
+
 
 class personNameSerializer(FlexFieldsModelSerializer):
 
@@ -21,7 +50,7 @@ class personNameSerializer(FlexFieldsModelSerializer):
         depth = 0
 
 
-class VersionMetaSerializer(FlexFieldsModelSerializer):
+class VersionMetaSerializer(ExcludeInternalFieldsMixin, FlexFieldsModelSerializer):
     """This serializer is used to serialize the version metadata in version queries,
     and includes the text and author metadata"""
     # author_names = personNameSerializer(many=True, read_only=True)
@@ -29,7 +58,7 @@ class VersionMetaSerializer(FlexFieldsModelSerializer):
 
     class Meta:
         model = versionMeta
-        fields = ("__all__")
+        exclude = ("content_hash",)
         depth = 3  # expand text and author metadata
 
 
@@ -38,7 +67,7 @@ class ShallowVersionSerializer(FlexFieldsModelSerializer):
     (it excludes the author and text metadata)"""
     class Meta:
         model = versionMeta
-        fields = ("__all__")
+        exclude = ("content_hash",)
         depth = 0  # exclude text and author metadata
 
 
@@ -49,13 +78,29 @@ class RelationTypeSerializer(FlexFieldsModelSerializer):
         # depth=0
 
 
-class AllRelationSerializer(FlexFieldsModelSerializer):
+class AllRelationSerializer(ExcludeInternalFieldsMixin, FlexFieldsModelSerializer):
 
     class Meta:
         model = a2bRelation
         fields = ("__all__")
         depth = 2
 
+
+class CompactRelationSerializer(serializers.ModelSerializer):
+    """Serialize a relation with the URIs of the related persons, texts and places
+    (and the name of the relation type) instead of the full nested objects"""
+    person_a_id = serializers.SlugRelatedField(slug_field="author_uri", read_only=True)
+    person_b_id = serializers.SlugRelatedField(slug_field="author_uri", read_only=True)
+    text_a_id = serializers.SlugRelatedField(slug_field="text_uri", read_only=True)
+    text_b_id = serializers.SlugRelatedField(slug_field="text_uri", read_only=True)
+    place_a_id = serializers.SlugRelatedField(slug_field="thuraya_uri", read_only=True)
+    place_b_id = serializers.SlugRelatedField(slug_field="thuraya_uri", read_only=True)
+    relation_type = serializers.SlugRelatedField(slug_field="name", read_only=True)
+
+    class Meta:
+        model = a2bRelation
+        fields = ("__all__")
+
 # class RelatedTextSerializer(FlexFieldsModelSerializer):
 #     relation_types = RelationTypeSerializer(many=True, read_only=True)
 
@@ -66,7 +111,7 @@ class AllRelationSerializer(FlexFieldsModelSerializer):
 #         depth=1
 
 
-class TextSerializer(FlexFieldsModelSerializer):
+class TextSerializer(ExcludeInternalFieldsMixin, FlexFieldsModelSerializer):
     # def get_relations(self):
     #     print("get relations:")
     #     print(a2bRelation.objects.get(text_a_id=self))
@@ -82,7 +127,7 @@ class TextSerializer(FlexFieldsModelSerializer):
         depth = 1
 
 
-class AuthorMetaSerializer(FlexFieldsModelSerializer):
+class AuthorMetaSerializer(ExcludeInternalFieldsMixin, FlexFieldsModelSerializer):
     #texts = serializers.SlugRelatedField(many=True, read_only=True, slug_field='text_uri')
     #versions = serializers.SlugRelatedField(many=True, read_only=True, slug_field='version_uri')
     texts = TextSerializer(many=True, read_only=True)
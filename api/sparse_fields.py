@@ -0,0 +1,126 @@
+"""Sparse fieldsets: only load the columns and relations of the requested fields.
+
+The serializers of the lists are FlexFieldsModelSerializers, so clients
+can select the fields of the results with ?fields= (e.g.,
+/version/all/?fields=version_id,tok_length) or leave out fields with ?omit=
+(e.g., /author/all/?omit=texts). But the view querysets load all columns,
+and join and prefetch all nested objects, which the serializer then throws away.
+
+SparseFieldsMixin restricts the view queryset to the fields that are
+left after ?fields= and ?omit= were applied to the serializer:
+
+* only the columns of these fields are loaded (QuerySet.only);
+* the joins (select_related) and prefetches of the relations
+  that are not among these fields are dropped.
+
+If nothing is left to join or prefetch, TwoPhaseListMixin (api/views.py)
+loads the page of objects in a single query.
+
+NB: the flex fields only apply ?fields= and ?omit= to the top-level fields
+of the results, so the nested objects are still loaded with all their fields.
+"""
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.constants import LOOKUP_SEP
+
+
+# query parameters of the flex fields that select fields:
+SPARSE_FIELDS_PARAMS = ("fields", "omit")
+
+
+def get_serializer_sources(serializer):
+    """Return the names of the model fields or relations used by the fields
+    that the serializer will output (after ?fields= and ?omit= were applied);
+    or None, if the serializer is not a flex fields serializer
+    or has fields that do not correspond to a model field"""
+    if not hasattr(serializer, "apply_flex_fields"):
+        return None
+    if not serializer._flex_fields_applied:
+        serializer.apply_flex_fields()
+    sources = []
+    for field in serializer.fields.values():
+        if field.source == "*":
+            return None
+        sources.append(field.source.split(".")[0])
+    return sources
+
+
+def get_model_field(model, name):
+    """Return the field of a model with this name (or the reverse relation
+    with this accessor name, e.g. "texts" for the texts of an author)"""
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        for rel in model._meta.related_objects:
+            if rel.get_accessor_name() == name:
+                return rel
+    return None
+
+
+def get_select_related_paths(select_related, prefix=""):
+    """Turn the select_related tree of a query into a list of lookups"""
+    paths = []
+    for name, children in select_related.items():
+        if children:
+            paths.extend(get_select_related_paths(children, prefix + name + LOOKUP_SEP))
+        else:
+            paths.append(prefix + name)
+    return paths
+
+
+def get_lookup_root(lookup):
+    """Return the first relation of a prefetch_related lookup (a string or a Prefetch)"""
+    path = getattr(lookup, "prefetch_through", lookup)
+    return path.split(LOOKUP_SEP)[0]
+
+
+def restrict_queryset(queryset, names):
+    """Restrict a queryset to the columns and relations that are needed
+    for these model fields and relations"""
+    model = queryset.model
+    columns = []
+    relations = set()
+    for name in names:
+        field = get_model_field(model, name)
+        if field is None:
+            # (e.g., a property of the model)
+            return queryset
+        if field.concrete and not field.many_to_many:
+            columns.append(field.name)
+        if field.is_relation:
+            relations.add(name)
+
+    queryset = queryset.only(*columns)
+
+    lookups = [lookup for lookup in queryset._prefetch_related_lookups
+               if get_lookup_root(lookup) in relations]
+    queryset = queryset.prefetch_related(None).prefetch_related(*lookups)
+
+    select_related = queryset.query.select_related
+    if isinstance(select_related, dict):
+        paths = [path for path in get_select_related_paths(select_related)
+                 if path.split(LOOKUP_SEP)[0] in relations]
+        queryset = queryset.select_related(None)
+        if paths:
+            queryset = queryset.select_related(*paths)
+    elif select_related and not relations:
+        # (select_related() without arguments joins all foreign keys)
+        queryset = queryset.select_related(None)
+    return queryset
+
+
+class SparseFieldsMixin:
+    """Restrict the queryset of a list view to the fields requested
+    with ?fields= and ?omit= (see the module docstring)"""
+
+    def get_queryset(self):
+        return self.get_sparse_queryset(super().get_queryset())
+
+    def get_sparse_queryset(self, queryset):
+        request = getattr(self, "request", None)
+        if request is None or not any(param in request.query_params for param in SPARSE_FIELDS_PARAMS):
+            return queryset
+        names = get_serializer_sources(self.get_serializer())
+        if names is None:
+            return queryset
+        return restrict_queryset(queryset, names)
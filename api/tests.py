@@ -1,3 +1,1110 @@
-from django.test import TestCase
+import collections
+import contextlib
+import csv
+import datetime
+import decimal
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_filters import rest_framework as django_filters
+
+from .models import authorMeta, textMeta, versionMeta, personName, relationType, a2bRelation, CorpusInsights
+from .models import DatasetGeneration, TextReuseStats, IngestCheckpoint
+from .search import rebuild_search_index, has_search_index, has_table, has_norm_index, forget_tables, NORM_INDEXES
+from .normalization import normalize
+from .caching import bump_generation
+from .facets import FACET_FIELDS, get_century, split_tags
+from .insights import rebuild_insights, query_top_books, TOP_BOOKS_PER, TOP_K, MAX_TOP_K
+from .ingest import METADATA_FIELDNAMES, COMPRESSED_OPENERS, MetadataRecord, iter_records, iter_chunks
+from .ingest import iter_json_items
+from .ingest import build_shadow_database, swap_database, MetadataWriter
+from .management.commands.load_data2 import load_book_relations
+from .management.commands import load_stats_data as load_stats_data_command
+from .views import authorListView, textListView, versionListView, relationsListView, getTextReuseStats
+
+
+def create_test_corpus(n_authors=6):
+    """Create n_authors authors, each with a name, two texts with two versions each,
+    and relations from their texts to another text and to another author"""
+    rel_type = relationType.objects.create(name="COMM")
+    authors = []
+    texts = []
+    for i in range(n_authors):
+        author = authorMeta.objects.create(
+            author_uri="0{}00Author{}".format(i + 1, i), author_lat="Author {}".format(i),
+            authorDateAH=(i + 1) * 100)
+        personName.objects.create(author_id=author, language="lat", shuhra="Author {}".format(i))
+        authors.append(author)
+        for j in range(2):
+            text = textMeta.objects.create(
+                author_id=author, text_uri="{}.Text{}".format(author.author_uri, j),
+                title_lat="Text {} {}".format(i, j))
+            texts.append(text)
+            for k in range(2):
+                versionMeta.objects.create(
+                    text_id=text, version_id="V{}{}{}".format(i, j, k),
+                    version_uri="{}.V{}{}{}-ara1".format(text.text_uri, i, j, k),
+                    tok_length=1000 * (i + j + k), status="pri" if k == 0 else "sec")
+    for n, text in enumerate(texts):
+        a2bRelation.objects.create(
+            text_a_id=text, text_b_id=texts[(n + 1) % len(texts)], relation_type=rel_type)
+        a2bRelation.objects.create(
+            text_a_id=text, person_b_id=authors[(n + 1) % len(authors)], relation_type=rel_type)
+        a2bRelation.objects.create(
+            person_a_id=text.author_id, person_b_id=authors[n % len(authors)], relation_type=rel_type)
+    return authors
+
+
+def write_stats(path, rows=None):
+    """Write a (tab-separated) text reuse stats file (default: STATS_ROWS)"""
+    with open_output(path) as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(STATS_HEADER)
+        writer.writerows(STATS_ROWS if rows is None else rows)
+    return path
+
+
+def get_stats():
+    return list(TextReuseStats.objects.order_by("id").values_list(
+        "book_1", "book_2", "instances_count", "book1_word_match", "book2_word_match",
+        "book1_match_book2_per", "book2_match_book1_per"))
+
+
+def get_stats_indexes():
+    """Return the names of the (non-unique) indexes of the TextReuseStats table"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s "
+                       "AND sql IS NOT NULL", [TextReuseStats._meta.db_table])
+        return sorted(row[0] for row in cursor.fetchall())
+
+
+# (the responses are not cached, so that every request runs the queries of the view):
+@override_settings(RESPONSE_CACHE_TIMEOUTS={})
+class QueryCountTestCase(TestCase):
+    """Check that the number of queries of the list endpoints
+    does not grow with the number of results on a page"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_corpus()
+        # record the table sizes, like the load commands (see api/caching.py):
+        bump_generation()
+
+    def setUp(self):
+        cache.clear()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_author_list_queries(self):
+        n_small, small_page = self.count_queries("/author/all/?page_size=1")
+        n_large, large_page = self.count_queries("/author/all/?page_size=6")
+        self.assertEqual(len(large_page["results"]), 6)
+        self.assertTrue(all(author["texts"] for author in large_page["results"]))
+        self.assertEqual(n_small, n_large)
+        # generation (with the table sizes, instead of the count) + ids of the page + authors + names + texts + versions
+        # + related texts (+ their related texts, persons and places)
+        # + related persons (+ their related persons and places):
+        self.assertLessEqual(n_large, 13)
+
+    def test_version_list_queries(self):
+        n_small, small_page = self.count_queries("/version/all/?page_size=1")
+        n_large, large_page = self.count_queries("/version/all/?page_size=24")
+        self.assertEqual(len(large_page["results"]), 24)
+        self.assertTrue(all(v["text_id"]["author_id"]["author_uri"] for v in large_page["results"]))
+        self.assertEqual(n_small, n_large)
+        n_ordered, ordered_page = self.count_queries(
+            "/version/all/?page_size=24&ordering=-text_id__author_id__date")
+        self.assertEqual(n_ordered, n_large)
+
+    def test_two_phase_list(self):
+        # a filter on a one-to-many relation must not repeat the author:
+        author = authorMeta.objects.get(author_uri="0100Author0")
+        personName.objects.create(author_id=author, language="eng", shuhra="Author 0 al-Thani")
+        n_queries, page = self.count_queries("/author/all/?shuhra=author 0")
+        self.assertEqual(page["count"], 1)
+        self.assertEqual([a["author_uri"] for a in page["results"]], ["0100Author0"])
+        # the ordering of the first phase is kept in the page:
+        n_queries, page = self.count_queries("/version/all/?ordering=-tok_length&page_size=5&page=2")
+        tok_lengths = [v["tok_length"] for v in page["results"]]
+        self.assertEqual(tok_lengths, sorted(tok_lengths, reverse=True))
+        self.assertEqual(page["count"], 24)
+
+    def test_cursor_pagination(self):
+        n_queries, pages = self.count_queries("/version/all/?ordering=-tok_length&page_size=24")
+        expected = [v["version_uri"] for v in pages["results"]]
+        tok_lengths = [v["tok_length"] for v in pages["results"]]
+        # walk forward through the cursor pages:
+        url, versions, n_pages = "/version/all/?ordering=-tok_length&page_size=5&cursor=", [], 0
+        while url:
+            n_queries, page = self.count_queries(url)
+            self.assertIsNone(page["count"])
+            versions += page["results"]
+            url, n_pages = page["links"]["next"], n_pages + 1
+        # (versions with the same tok_length are ordered by id in the cursor pages):
+        self.assertEqual([v["tok_length"] for v in versions], tok_lengths)
+        self.assertEqual(sorted(v["version_uri"] for v in versions), sorted(expected))
+        self.assertEqual(n_pages, 5)
+        # and back from the last page:
+        n_queries, page = self.count_queries(page["links"]["previous"])
+        self.assertEqual(page["results"], versions[15:20])
+        # the count is only computed on request:
+        n_queries, page = self.count_queries("/version/all/?cursor=&count=true")
+        self.assertEqual(page["count"], 24)
+        response = self.client.get("/version/all/?cursor=xyz")
+        self.assertEqual(response.status_code, 404)
+
+    def test_count_cache(self):
+        n_first, page = self.count_queries("/version/all/?status=pri&page_size=5")
+        self.assertEqual(page["count"], 12)
+        # the count of the same filters is cached (also for other pages and orderings):
+        n_queries, page = self.count_queries("/version/all/?page=2&page_size=5&ordering=-tok_length&status=pri")
+        self.assertEqual(page["count"], 12)
+        self.assertEqual(n_queries, n_first - 1)
+        n_queries, page = self.count_queries("/version/all/?status=sec&page_size=5")
+        self.assertEqual(n_queries, n_first)
+        # until the data is reloaded:
+        text = textMeta.objects.get(text_uri="0100Author0.Text0")
+        versionMeta.objects.create(text_id=text, version_id="V999", version_uri="0100Author0.Text0.V999-ara1",
+                                   status="pri")
+        n_queries, page = self.count_queries("/version/all/?status=pri&page_size=5")
+        self.assertEqual(page["count"], 12)
+        # (the count of an unfiltered list is the recorded table size:)
+        n_queries, page = self.count_queries("/version/all/?page_size=5")
+        self.assertEqual(page["count"], 24)
+        bump_generation()
+        n_queries, page = self.count_queries("/version/all/?status=pri&page_size=5")
+        self.assertEqual(page["count"], 13)
+        n_queries, page = self.count_queries("/version/all/?page_size=5")
+        self.assertEqual(page["count"], 25)
+        n_queries, page = self.count_queries("/version/all/?cursor=&count=true")
+        self.assertEqual(page["count"], 25)
+        # the recorded table sizes are only used for COUNT_CACHE_TIMEOUT seconds after a load,
+        # so that other changes (e.g., in the admin) also show up in the unfiltered counts:
+        versionMeta.objects.filter(version_id="V999").delete()
+        self.assertEqual(self.count_queries("/version/all/?page_size=5")[1]["count"], 25)
+        DatasetGeneration.objects.update(
+            updated=timezone.now() - datetime.timedelta(seconds=settings.COUNT_CACHE_TIMEOUT + 1))
+        self.assertEqual(self.count_queries("/version/all/?page_size=5")[1]["count"], 24)
+
+    def test_sparse_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/version/all/?fields=version_id,tok_length&ordering=-tok_length")
+        page = response.json()
+        self.assertEqual(set(page["results"][0]), {"version_id", "tok_length"})
+        # the versions are loaded in one query, without the texts and authors
+        # and without the other columns:
+        sqls = [q["sql"] for q in queries.captured_queries if '"api_versionmeta"."tok_length"' in q["sql"]]
+        self.assertEqual(len(sqls), 1)
+        self.assertNotIn("JOIN", sqls[0])
+        self.assertNotIn('"api_versionmeta"."version_uri"', sqls[0])
+        # the omitted relations are not prefetched:
+        n_all, all_page = self.count_queries("/author/all/?page_size=6")
+        n_omit, omit_page = self.count_queries("/author/all/?page_size=6&omit=texts")
+        self.assertLess(n_omit, n_all)
+        for author, sparse_author in zip(all_page["results"], omit_page["results"]):
+            del author["texts"]
+            self.assertEqual(author, sparse_author)
+
+    def test_relation_list_queries(self):
+        # (the first three relations are a text-text, a text-person
+        # and a person-person relation, so all relations are prefetched):
+        n_small, small_page = self.count_queries("/relations/all/?page_size=3")
+        n_large, large_page = self.count_queries("/relations/all/?page_size=36")
+        self.assertEqual(len(large_page["results"]), 36)
+        self.assertEqual(n_small, n_large)
+
+    def test_compact_relations(self):
+        n_queries, page = self.count_queries(
+            "/relations/all/?compact=true&page_size=50&uri=0100Author0.Text0")
+        # generation + count + relations (with the related objects joined):
+        self.assertEqual(n_queries, 3)
+        self.assertEqual(page["count"], 3)
+        for rel in page["results"]:
+            self.assertEqual(rel["relation_type"], "COMM")
+            self.assertIn("0100Author0.Text0", (rel["text_a_id"], rel["text_b_id"]))
+        n_queries, page = self.count_queries("/relations/all/?compact=true&relation_type=other")
+        self.assertEqual(page["count"], 0)
+
+
+class ResponseCacheTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_corpus()
+        bump_generation()
+
+    def setUp(self):
+        caches["responses"].clear()
+
+    def tearDown(self):
+        # (the generation is rolled back after the test):
+        caches["responses"].clear()
+
+    def get(self, url, cached):
+        """Get a page and check whether it was served from the response cache
+        (i.e., without any query)"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries) == 0, cached)
+        return response.json()
+
+    def test_cached_responses(self):
+        for url in ["/author/all/?page_size=3", "/text/0100Author0.Text0/", "/corpusinsights/",
+                    "/relations/all/?compact=true&uri=0100Author0.Text0"]:
+            first = self.get(url, cached=False)
+            self.assertEqual(self.get(url, cached=True), first)
+        # the order of the query parameters does not matter:
+        self.get("/author/all/?page_size=3&ordering=-date&author_lat=author", cached=False)
+        self.get("/author/all/?author_lat=author&ordering=-date&page_size=3", cached=True)
+        # errors are not cached:
+        for i in range(2):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/text/0100Author0.Nothing/")
+            self.assertEqual(response.status_code, 404)
+            self.assertGreater(len(queries), 0)
+
+    @override_settings(RESPONSE_CACHE_MAX_SIZE=5000)
+    def test_large_responses(self):
+        # (a page of 3 authors is smaller than the limit, a page of 6 authors is larger):
+        self.get("/author/all/?page_size=3", cached=False)
+        self.get("/author/all/?page_size=3", cached=True)
+        self.get("/author/all/?page_size=6", cached=False)
+        self.get("/author/all/?page_size=6", cached=False)
+
+    def test_reload(self):
+        page = self.get("/version/all/?status=pri", cached=False)
+        self.assertEqual(page["count"], 12)
+        text = textMeta.objects.get(text_uri="0100Author0.Text0")
+        versionMeta.objects.create(text_id=text, version_id="V999", version_uri="0100Author0.Text0.V999-ara1",
+                                   status="pri")
+        self.assertEqual(self.get("/version/all/?status=pri", cached=True)["count"], 12)
+        # the responses of the previous generation are not used after a load:
+        bump_generation()
+        self.assertEqual(self.get("/version/all/?status=pri", cached=False)["count"], 13)
+
+
+    def test_rebuild_insights(self):
+        # (the statistics have not been computed yet):
+        self.assertEqual(self.get("/corpusinsights/", cached=False), [])
+        self.get("/corpusinsights/", cached=True)
+        self.get("/top-books/", cached=False)
+        self.get("/top-books/", cached=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command("load_aggregated_stats", "--top-k", "3")
+        # the responses of the previous generation are not used after the rebuild:
+        insights = self.get("/corpusinsights/", cached=False)
+        self.assertEqual(len(json.loads(insights[0]["top_10_book_by_word_count"])), 3)
+        self.get("/top-books/", cached=False)
+
+class SearchIndexTestCase(TestCase):
+    """Check that ?search= returns the same results with the search index
+    as the LIKE conditions on all search fields"""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_corpus()
+        cls.n_docs = rebuild_search_index()
+
+    def search(self, url, terms):
+        response = self.client.get(url, {"search": terms, "page_size": 200})
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"]
+
+    def test_index(self):
+        if not has_search_index("author"):
+            self.skipTest("the database does not support the search index")
+        # 6 authors, 12 texts, 24 versions:
+        self.assertEqual(self.n_docs, 42)
+
+    def test_search_authors(self):
+        results = self.search("/author/all/", "author5 1")  # "1" is looked up with LIKE
+        self.assertEqual([a["author_uri"] for a in results], ["0600Author5"])
+        results = self.search("/author/all/", "V011")  # version URI of the first author
+        self.assertEqual([a["author_uri"] for a in results], ["0100Author0"])
+        self.assertEqual(self.search("/author/all/", "author nothing"), [])
+
+    def test_search_texts(self):
+        results = self.search("/text/all/", "AUTHOR2.text")
+        self.assertEqual(sorted(t["text_uri"] for t in results),
+                         ["0300Author2.Text0", "0300Author2.Text1"])
+
+    def test_search_versions(self):
+        results = self.search("/version/all/", "Author1.Text1")
+        self.assertEqual(sorted(v["version_uri"] for v in results),
+                         ["0200Author1.Text1.V110-ara1", "0200Author1.Text1.V111-ara1"])
+        results = self.search("/version/all/", "pri Text0")
+        self.assertEqual(len(results), 6)
+        self.assertTrue(all(v["status"] == "pri" for v in results))
+
+
+class NormalizationTestCase(TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize("Abū Ḥanīfaŧ al-Nuʿmān"), "abu hanifa al-numan")
+        self.assertEqual(normalize("Ibn ʿAbd  al-Barr"), normalize("ibn 'abd al-barr"))
+        self.assertEqual(normalize("أبو حنيفة"), "ابو حنيفه")
+        self.assertEqual(normalize("إِسْمَاعِيل"), "اسماعيل")
+        self.assertEqual(normalize(None), "")
+
+    def test_normalized_filters(self):
+        author = authorMeta.objects.create(
+            author_uri="0150AbuHanifa", author_lat="Abū Ḥanīfaŧ", author_ar="أبو حنيفة")
+        personName.objects.create(author_id=author, language="ara", shuhra="أبو حنيفة")
+        textMeta.objects.create(author_id=author, text_uri="0150AbuHanifa.Wasiyya", title_lat="Waṣiyyaŧ")
+        for url in ["/author/all/?author_lat=Abu Hanifa", "/author/all/?author_ar=ابو حنيفه",
+                    "/author/all/?shuhra=ابو حنيفة", "/text/all/?title_lat=wasiyya"]:
+            response = self.client.get(url)
+            self.assertEqual(response.json()["count"], 1, url)
+
+    def test_norm_index(self):
+        if not has_table("api_name_norm"):
+            self.skipTest("the database does not support the index of the normalized fields")
+        author = authorMeta.objects.create(author_uri="0255Jahiz", author_lat="al-Jāḥiẓ")
+        name = personName.objects.create(author_id=author, language="lat", nisba="al-Baṣrī")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_authors("/author/all/?nisba=basri"), ["0255Jahiz"])
+        self.assertTrue(any("api_name_norm MATCH" in query["sql"] for query in queries))
+        # the index is kept up to date by triggers (also for bulk updates and deletes):
+        self.assertEqual(self.get_authors("/author/all/?shuhra=basri"), [])
+        name.nisba = "al-Kinānī"
+        name.save()
+        self.assertEqual(self.get_authors("/author/all/?nisba=basri"), [])
+        self.assertEqual(self.get_authors("/author/all/?nisba=kinan"), ["0255Jahiz"])
+        authorMeta.objects.filter(pk=author.pk).update(author_lat_norm="al-jahiz abu uthman")
+        self.assertEqual(self.get_authors("/author/all/?author_lat=Abu ʿUthman"), ["0255Jahiz"])
+        personName.objects.all().delete()
+        self.assertEqual(self.get_authors("/author/all/?nisba=kinan"), [])
+        # values that are too short for the trigram index are matched with LIKE:
+        self.assertEqual(self.get_authors("/author/all/?author_lat=ja"), ["0255Jahiz"])
+
+    def test_missing_norm_triggers(self):
+        if not has_table("api_name_norm"):
+            self.skipTest("the database does not support the index of the normalized fields")
+        for table in NORM_INDEXES.values():
+            self.assertTrue(has_norm_index(table), table)
+        author = authorMeta.objects.create(author_uri="0255Jahiz", author_lat="al-Jāḥiẓ")
+        name = personName.objects.create(author_id=author, language="lat", nisba="al-Baṣrī")
+        # (like a migration that rebuilds the personName table):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER api_name_norm_update")
+        forget_tables()
+        self.addCleanup(forget_tables)
+        name.nisba = "al-Kinānī"
+        name.save()
+        # without the trigger, the index no longer matches the data, so it is not used:
+        self.assertFalse(has_norm_index("api_name_norm"))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_authors("/author/all/?nisba=kinan"), ["0255Jahiz"])
+        self.assertFalse(any("api_name_norm MATCH" in query["sql"] for query in queries))
+        self.assertEqual(self.get_authors("/author/all/?nisba=basri"), [])
+        # rebuild_search_index creates the trigger again (and rebuilds the index):
+        with contextlib.redirect_stdout(io.StringIO()):
+            rebuild_search_index()
+        self.assertTrue(has_norm_index("api_name_norm"))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_authors("/author/all/?nisba=kinan"), ["0255Jahiz"])
+        self.assertTrue(any("api_name_norm MATCH" in query["sql"] for query in queries))
+        self.assertEqual(self.get_authors("/author/all/?nisba=basri"), [])
+        name.nisba = "al-Baṣrī"
+        name.save()
+        self.assertEqual(self.get_authors("/author/all/?nisba=basri"), ["0255Jahiz"])
+
+    def get_authors(self, url):
+        response = self.client.get(url)
+        return [author["author_uri"] for author in response.json()["results"]]
+
+
+# filters that cannot use an index ((filterset, filter): reason);
+# QueryPlanTestCase checks that all other filters use indexes:
+SUBSTRING_SCAN = "substring filter (icontains) on a free-text field: LIKE '%...%' cannot use an index " \
+                 "(the ?search= parameter looks these fields up in the search index)"
+UNINDEXED_FILTERS = {
+    ("versionFilter", "version_uri_contains"): SUBSTRING_SCAN,
+    ("versionFilter", "editor"): SUBSTRING_SCAN,
+    ("versionFilter", "editor_place"): SUBSTRING_SCAN,
+    ("versionFilter", "publisher"): SUBSTRING_SCAN,
+    ("versionFilter", "edition_date"): SUBSTRING_SCAN,
+    ("versionFilter", "edition"): SUBSTRING_SCAN,
+    ("versionFilter", "tags"): SUBSTRING_SCAN,
+    ("textFilter", "text_type"): SUBSTRING_SCAN,
+    ("textFilter", "tag"): SUBSTRING_SCAN,
+    ("textReuseFilter", "book_1"): "substring filter (icontains) on the book URI; "
+                                   "the text reuse stats are not in the search index",
+    ("textReuseFilter", "book_2"): "substring filter (icontains) on the book URI; "
+                                   "the text reuse stats are not in the search index",
+}
+
+# orderings that are sorted in a temporary B-tree ((view, field): reason):
+UNINDEXED_ORDERINGS = {
+    ("versionListView", "text_id__author_id__date"):
+        "SQLite only reads the authors in the order of api_author_date_idx (and their texts and versions "
+        "with the foreign key indexes) if it has table statistics; load_data2 runs ANALYZE after a load, "
+        "but the test database has no statistics",
+    ("relationsListView", "relation_type__name"):
+        "relation_type is nullable, so the relation types are LEFT JOINed, and SQLite cannot read "
+        "the relations in the order of api_relationtype_name_idx",
+}
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "the query plans are checked in SQLite")
+class QueryPlanTestCase(TestCase):
+    """Check with EXPLAIN QUERY PLAN that the filters and orderings
+    of the lists use indexes instead of reading whole tables.
+
+    (The test database has no statistics (see ANALYZE),
+    so SQLite plans the queries as if all tables were large.)"""
+
+    views = [authorListView, textListView, versionListView, relationsListView, getTextReuseStats]
+
+    def get_value(self, filter):
+        if isinstance(filter, django_filters.BaseRangeFilter):
+            return "100,200"
+        if isinstance(filter, django_filters.NumberFilter):
+            return "100"
+        return "abc"
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def get_table_scans(self, plan):
+        """Return the steps of a query plan that read a whole table or index:
+        "SCAN table" and "SCAN table USING (COVERING) INDEX ..."
+        (but not the lookups in an FTS5 table, "SCAN table VIRTUAL TABLE INDEX n:M...")"""
+        return [step for step in plan
+                if step.startswith("SCAN ") and not re.match(r"SCAN \S+ VIRTUAL TABLE INDEX \d+:M", step)]
+
+    def test_filters(self):
+        for view in self.views:
+            filterset_class = view.filterset_class
+            model = filterset_class._meta.model
+            for name, filter in filterset_class.base_filters.items():
+                with self.subTest(view=view.__name__, filter=name):
+                    filterset = filterset_class({name: self.get_value(filter)}, queryset=model.objects.all())
+                    self.assertTrue(filterset.is_valid(), filterset.errors)
+                    # (the ids of the filtered objects, as in the count and the first phase of the lists):
+                    plan = self.explain(filterset.qs.values("pk"))
+                    if (filterset_class.__name__, name) in UNINDEXED_FILTERS:
+                        # (if such a filter can use an index now, remove it from UNINDEXED_FILTERS):
+                        self.assertNotEqual(self.get_table_scans(plan), [], plan)
+                    else:
+                        self.assertEqual(self.get_table_scans(plan), [], plan)
+
+    def test_orderings(self):
+        for view in self.views:
+            model = view.filterset_class._meta.model
+            fields = getattr(view, "ordering_fields", None) or []
+            for ordering in fields + ["-" + field for field in fields]:
+                with self.subTest(view=view.__name__, ordering=ordering):
+                    plan = self.explain(model.objects.order_by(ordering).values("pk")[:10])
+                    # (the first rows are read from an index, in the order of the index;
+                    # a "SCAN ... USING INDEX" stops after the page):
+                    if (view.__name__, ordering.lstrip("-")) in UNINDEXED_ORDERINGS:
+                        self.assertIn("USE TEMP B-TREE FOR ORDER BY", plan)
+                    else:
+                        self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", plan)
+
+
+def metadata_row(version_uri, tok_length=1000, status="pri", **values):
+    """Return a row of the metadata csv for a version
+    (version_uri: author.book.version-lang, e.g. 0150AbuHanifa.Wasiyya.Sham01-ara1)"""
+    author_uri, book = version_uri.split(".")[:2]
+    row = dict.fromkeys(METADATA_FIELDNAMES, "")
+    row.update(
+        versionUri=version_uri, date=author_uri[:4], book=author_uri + "." + book,
+        author_ar="مؤلف {}".format(author_uri), author_lat="Muʾallif {} :: {}".format(author_uri[4:], author_uri),
+        title_ar="كتاب {}".format(book), title_lat="Kitāb {}".format(book),
+        id=version_uri.split(".")[2].split("-")[0], status=status,
+        tok_length=str(tok_length), char_length=str(tok_length * 5),
+        url="https://example.org/{}.completed".format(version_uri), tags="_SHICR :: tag")
+    row.update(values)
+    return row
+
+
+def open_output(path):
+    """Open an (optionally compressed) file for writing, like api.ingest.open_input"""
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1], open)
+    return opener(path, mode="wt", encoding="utf-8", newline="")
+
+
+def write_metadata(path, rows):
+    with open_output(path) as f:
+        writer = csv.DictWriter(f, fieldnames=METADATA_FIELDNAMES, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_json(path, data):
+    with open_output(path) as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def relation(source, dest, main_rel_type="COMM", sec_rel_type=""):
+    return dict(source=source, dest=dest, main_rel_type=main_rel_type, sec_rel_type=sec_rel_type)
+
+
+def name_elements(shuhra):
+    names = dict.fromkeys(["nasab", "kunya", "ism", "laqab", "nisba"], "")
+    return {"AR": dict(names, shuhra=shuhra), "LA": dict(names, shuhra=normalize(shuhra))}
+
+
+class LoadDataMixin:
+    """Write small input files to a temporary folder and load them with the load commands"""
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def path(self, filename):
+        return os.path.join(self.tmp, filename)
+
+    def load_data2(self, *args, rows=(), relations=None, names=None, metadata="metadata.csv"):
+        """Write the metadata rows, relations and name elements and load them with load_data2"""
+        write_metadata(self.path(metadata), rows)
+        write_json(self.path("relations.json"), relations or {})
+        write_json(self.path("names.json"), names or {})
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            call_command("load_data2", "--metadata", self.path(metadata),
+                         "--relations", self.path("relations.json"), "--name-elements", self.path("names.json"),
+                         "--report", self.path("report.json"), *args)
+        return stdout.getvalue()
+
+    def load_stats_data(self, *args):
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            call_command("load_stats_data", *args, "--report", self.path("report.json"))
+        return stdout.getvalue()
+
+    def dump_database(self, hashes=True):
+        """Return the contents of the metadata tables, in a form that can be compared
+        (the metadata loaders shuffle the elements of the names, so they are sorted)"""
+        author_fields = ["author_uri", "author_ar", "author_lat", "date", "authorDateAH", "authorDateCE",
+                         "authorDateString", "author_ar_norm", "author_lat_norm"]
+        text_fields = ["text_uri", "author_id__author_uri", "title_ar", "title_lat", "text_type", "tags",
+                       "title_ar_norm", "title_lat_norm"]
+        version_fields = ["version_id", "version_uri", "text_id__text_uri", "char_length", "tok_length", "url",
+                          "ed_info", "tags", "annotation_status", "status", "version_lang"]
+        if hashes:
+            author_fields.append("content_hash")
+            text_fields.append("content_hash")
+            version_fields.append("content_hash")
+        name_fields = ["shuhra", "nasab", "kunya", "ism", "laqab", "nisba"]
+        names = [(author_uri, language, sorted(elements))
+                 for author_uri, language, *elements in personName.objects.values_list(
+                     "author_id__author_uri", "language", *name_fields)]
+        relations = [tuple(uri or "" for uri in rel) for rel in a2bRelation.objects.values_list(
+            "text_a_id__text_uri", "text_b_id__text_uri", "person_a_id__author_uri", "person_b_id__author_uri",
+            "relation_type__name")]
+        insights = CorpusInsights.objects.values(
+            "number_of_unique_authors", "number_of_books", "number_of_versions", "total_word_count",
+            "largest_book", "total_word_count_pri", "top_10_book_by_word_count", "top_k").get()
+        insights["top_10_book_by_word_count"] = json.loads(insights["top_10_book_by_word_count"])
+        return dict(
+            authors=sorted(authorMeta.objects.values_list(*author_fields), key=str),
+            texts=sorted(textMeta.objects.values_list(*text_fields), key=str),
+            versions=sorted(versionMeta.objects.values_list(*version_fields), key=str),
+            names=sorted(names),
+            relations=sorted(relations),
+            insights=insights,
+        )
+
+
+# two releases of the metadata: the second release removes a version, a text and an author,
+# changes a version and an author and adds a version, a text and an author:
+RELEASE_1 = [
+    metadata_row("0150AbuHanifa.Wasiyya.Sham01-ara1", 1000),
+    metadata_row("0150AbuHanifa.Wasiyya.Sham02-ara1", 1200, status="sec"),
+    metadata_row("0150AbuHanifa.Fiqh.Sham03-ara1", 3000),
+    metadata_row("0255Jahiz.Hayawan.Sham04-ara1", 50000),
+    metadata_row("0255Jahiz.Bayan.Sham05-ara1", 30000),
+    metadata_row("0310Tabari.Tarikh.Sham06-ara1", 900000),
+]
+RELEASE_2 = [
+    metadata_row("0150AbuHanifa.Wasiyya.Sham01-ara1", 1100),
+    metadata_row("0150AbuHanifa.Fiqh.Sham03-ara1", 3000),
+    metadata_row("0255Jahiz.Hayawan.Sham04-ara1", 50000, author_lat="al-Jāḥiẓ"),
+    metadata_row("0255Jahiz.Hayawan.Sham05-ara1", 30000),
+    metadata_row("0774IbnKathir.Bidaya.Sham07-ara1", 700000),
+]
+RELATIONS_1 = {
+    "0255Jahiz.Bayan": [relation("0255Jahiz.Bayan", "0150AbuHanifa.Wasiyya")],
+    "0310Tabari.Tarikh": [relation("0310Tabari.Tarikh", "0255Jahiz", "BIO")],
+    "0150AbuHanifa.Fiqh": [relation("0150AbuHanifa.Fiqh", "0150AbuHanifa.Wasiyya", "COMM", "SHARH")],
+}
+RELATIONS_2 = {
+    "0150AbuHanifa.Fiqh": [relation("0150AbuHanifa.Fiqh", "0150AbuHanifa.Wasiyya", "COMM", "SHARH")],
+    "0774IbnKathir.Bidaya": [relation("0774IbnKathir.Bidaya", "0255Jahiz.Hayawan"),
+                             relation("0774IbnKathir.Bidaya", "0150AbuHanifa", "BIO")],
+}
+NAMES = {
+    "0150AbuHanifa": name_elements("أبو حنيفة"),
+    "0255Jahiz": name_elements("الجاحظ"),
+    "0310Tabari": name_elements("الطبري"),
+}
+
+
+class DeltaLoadTestCase(LoadDataMixin, TestCase):
+
+    def test_delta_equals_full_load(self):
+        self.load_data2("--bulk", rows=RELEASE_2, relations=RELATIONS_2, names=NAMES)
+        full = self.dump_database()
+        self.load_data2("--bulk", rows=RELEASE_1, relations=RELATIONS_1, names=NAMES)
+        self.assertNotEqual(self.dump_database(), full)
+        self.load_data2("--delta", rows=RELEASE_2, relations=RELATIONS_2, names=NAMES)
+        self.assertEqual(self.dump_database(), full)
+
+    def test_unchanged_delta(self):
+        self.load_data2("--bulk", rows=RELEASE_1, relations=RELATIONS_1, names=NAMES)
+        generation = DatasetGeneration.objects.get().generation
+        output = self.load_data2("--delta", rows=RELEASE_1, relations=RELATIONS_1, names=NAMES)
+        self.assertIn("Nothing changed", output)
+        # the cached counts and responses are not invalidated:
+        self.assertEqual(DatasetGeneration.objects.get().generation, generation)
+        # a removed relation is a change:
+        relations = dict(RELATIONS_1, **{"0255Jahiz.Bayan": []})
+        self.load_data2("--delta", rows=RELEASE_1, relations=relations, names=NAMES)
+        self.assertEqual(DatasetGeneration.objects.get().generation, generation + 1)
+        self.assertFalse(a2bRelation.objects.filter(text_a_id__text_uri="0255Jahiz.Bayan").exists())
+
+
+class InsightsDeltaTestCase(LoadDataMixin, TestCase):
+    """The corpus statistics that the loaders update with InsightsDelta
+    must be the same as the statistics recomputed by rebuild_insights"""
+
+    def assertInsightsRebuilt(self):
+        insights = self.dump_database()["insights"]
+        rebuild_insights()
+        self.assertEqual(insights, self.dump_database()["insights"])
+
+    def test_insights_delta(self):
+        self.load_data2(rows=RELEASE_1, relations=RELATIONS_1, names=NAMES)
+        self.assertInsightsRebuilt()
+        self.load_data2("--bulk", "--batch-size", "2", rows=RELEASE_1, relations=RELATIONS_1, names=NAMES)
+        self.assertInsightsRebuilt()
+        self.assertEqual(CorpusInsights.objects.get().largest_book, 900000)
+        # the delta removes the largest book (one of the top books) and changes another one:
+        rebuild_insights(top_k=2)
+        self.load_data2("--delta", "--batch-size", "2", rows=RELEASE_2, relations=RELATIONS_2, names=NAMES)
+        self.assertEqual(CorpusInsights.objects.get().largest_book, 700000)
+        self.assertInsightsRebuilt()
+        # a delta that only adds books:
+        rows = RELEASE_2 + [metadata_row("0900Author.Book.Sham08-ara1", 800000, status="sec"),
+                            metadata_row("0150AbuHanifa.Wasiyya.Sham09-ara1", 5000)]
+        self.load_data2("--delta", rows=rows, relations=RELATIONS_2, names=NAMES)
+        self.assertEqual(list(json.loads(CorpusInsights.objects.get().top_10_book_by_word_count)),
+                         ["0900Author.Book", "0774IbnKathir.Bidaya"])
+        self.assertInsightsRebuilt()
+
+
+class TopBooksTestCase(LoadDataMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches["responses"].clear()
+        # Tabari has the 5 largest versions (in 3 texts):
+        self.rows = [
+            metadata_row("0310Tabari.Tarikh.Sham01-ara1", 900000),
+            metadata_row("0310Tabari.Tarikh.Sham02-ara1", 890000),
+            metadata_row("0310Tabari.Tafsir.Sham03-ara1", 880000),
+            metadata_row("0310Tabari.Tafsir.Sham04-ara1", 870000),
+            metadata_row("0310Tabari.Ikhtilaf.Sham05-ara1", 860000),
+            metadata_row("0774IbnKathir.Bidaya.Sham06-ara1", 700000),
+            metadata_row("0774IbnKathir.Tafsir.Sham07-ara1", 650000),
+            metadata_row("0255Jahiz.Hayawan.Sham08-ara1", 50000),
+            metadata_row("0255Jahiz.Bayan.Sham09-ara1", 30000, status="sec"),
+            metadata_row("0150AbuHanifa.Wasiyya.Sham10-ara1", 1000),
+            metadata_row("0150AbuHanifa.Fiqh.Sham11-ara1", ""),
+        ]
+        self.load_data2("--bulk", rows=self.rows)
+
+    def brute_force_top_books(self, k, per):
+        """Group all versions by text or author and keep the k largest groups"""
+        largest = dict()
+        for v in versionMeta.objects.filter(tok_length__isnull=False).values("version_uri", "tok_length"):
+            uri = TOP_BOOKS_PER[per](v["version_uri"])
+            if uri not in largest or v["tok_length"] > largest[uri]["tok_length"]:
+                largest[uri] = v
+        return sorted(largest.items(), key=lambda item: -item[1]["tok_length"])[:k]
+
+    def test_query_top_books(self):
+        for per in TOP_BOOKS_PER:
+            for k in range(0, 8):
+                top_books = query_top_books(k, per)
+                self.assertEqual(list(top_books.items()), self.brute_force_top_books(k, per), (k, per))
+        self.assertEqual(list(query_top_books(3, "author")), ["0310Tabari", "0774IbnKathir", "0255Jahiz"])
+        self.assertEqual(list(query_top_books(3, "text")),
+                         ["0310Tabari.Tarikh", "0310Tabari.Tafsir", "0310Tabari.Ikhtilaf"])
+
+    def test_top_books_view(self):
+        response = self.client.get("/top-books/?k=2&per=author")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [
+            {"author_uri": "0310Tabari", "version_uri": "0310Tabari.Tarikh.Sham01-ara1", "tok_length": 900000},
+            {"author_uri": "0774IbnKathir", "version_uri": "0774IbnKathir.Bidaya.Sham06-ara1",
+             "tok_length": 700000},
+        ])
+        response = self.client.get("/top-books/")
+        self.assertEqual([book["text_uri"] for book in response.json()],
+                         [uri for uri, book in self.brute_force_top_books(TOP_K, "text")])
+        for url in ["/top-books/?k=0", "/top-books/?k=abc", "/top-books/?k={}".format(MAX_TOP_K + 1),
+                    "/top-books/?per=version"]:
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+
+
+class FacetsTestCase(LoadDataMixin, TestCase):
+    """The facet counts of /facets/ must match the versions listed by /version/all/
+    for the same filters"""
+
+    def setUp(self):
+        super().setUp()
+        caches["responses"].clear()
+        cache.clear()
+        rows = RELEASE_1 + RELEASE_2[3:] + [
+            metadata_row("0150AbuHanifa.Fiqh.Sham08-per1", 2000, status="sec", tags="_SHICR"),
+            metadata_row("0310Tabari.Tarikh.Sham09-ara1", 800000, tags="_SHICR :: history :: history"),
+            metadata_row("0310Tabari.Tafsir.Sham10-ara1", 700000, tags=""),
+        ]
+        self.load_data2("--bulk", rows=rows, relations=RELATIONS_1, names=NAMES)
+
+    def count_listed_versions(self, query):
+        """Count the facet values of the versions listed by /version/all/?query"""
+        response = self.client.get("/version/all/?page_size=100&fields=version_uri&" + query)
+        self.assertEqual(response.status_code, 200)
+        uris = [v["version_uri"] for v in response.json()["results"]]
+        counts = {field: collections.Counter() for field in FACET_FIELDS + ["tags"]}
+        for v in versionMeta.objects.filter(version_uri__in=uris).values(
+                "status", "annotation_status", "version_lang", "tags",
+                "text_id__text_type", "text_id__author_id__authorDateAH"):
+            counts["century"][get_century(v["text_id__author_id__authorDateAH"])] += 1
+            counts["text_type"][v["text_id__text_type"]] += 1
+            for field in ["status", "annotation_status", "version_lang"]:
+                counts[field][v[field]] += 1
+            counts["tags"].update(split_tags(v["tags"]))
+        return len(uris), counts
+
+    def test_facet_counts(self):
+        for query in ["", "status=pri", "died_before_AH=300", "died_between_AH=200,400&status=sec",
+                      "tags=history", "language=per", "tok_count_gte=3000&died_after_AH=200",
+                      "died_after_AH=2000"]:
+            response = self.client.get("/facets/?" + query)
+            self.assertEqual(response.status_code, 200, query)
+            facets = response.json()
+            total, counts = self.count_listed_versions(query)
+            self.assertEqual(facets["total"], total, query)
+            for field, counter in counts.items():
+                self.assertEqual({item["value"]: item["count"] for item in facets[field]},
+                                 dict(counter), (query, field))
+        self.assertEqual(self.client.get("/facets/?died_before_AH=abc").status_code, 400)
+
+
+class IngestReportTestCase(LoadDataMixin, TestCase):
+
+    def test_report(self):
+        output = self.load_data2("--bulk", "--batch-size", "4", rows=RELEASE_1, relations=RELATIONS_1, names=NAMES)
+        self.assertIn("Report written to " + self.path("report.json"), output)
+        with open(self.path("report.json"), encoding="utf-8") as f:
+            report = json.load(f)
+        self.assertEqual(set(report), {"command", "started", "total_seconds", "total_queries",
+                                       "peak_rss_mb", "phases"})
+        self.assertEqual(report["command"], "load_data2")
+        phases = report["phases"]
+        for name in ["parse", "authors", "texts", "versions", "names", "insights",
+                     "relations", "name elements", "facets", "search index"]:
+            self.assertIn(name, phases)
+        for name, phase in phases.items():
+            self.assertEqual(set(phase), {"seconds", "rows", "rows_per_sec", "queries"}, name)
+        # the rows of the metadata file, and of the tables that were written:
+        self.assertEqual(phases["parse"]["rows"], len(RELEASE_1))
+        self.assertEqual(phases["authors"]["rows"], 3)
+        self.assertEqual(phases["texts"]["rows"], 5)
+        self.assertEqual(phases["versions"]["rows"], len(RELEASE_1))
+        self.assertEqual(phases["facets"]["rows"], len(RELEASE_1))
+        # (the parse phase reads the file, the other phases write to the database):
+        self.assertEqual(phases["parse"]["queries"], 0)
+        for name in ["authors", "texts", "versions", "relations", "name elements", "facets"]:
+            self.assertGreater(phases[name]["queries"], 0, name)
+        self.assertGreaterEqual(report["total_queries"], sum(phase["queries"] for phase in phases.values()))
+
+
+class BulkLoadTestCase(LoadDataMixin, TestCase):
+
+    def test_bulk_equals_row_by_row(self):
+        # (the row-by-row loader does not fill the content hashes):
+        self.load_data2(rows=RELEASE_1, relations=RELATIONS_1, names=NAMES)
+        row_by_row = self.dump_database(hashes=False)
+        self.load_data2("--bulk", "--batch-size", "2", rows=RELEASE_1, relations=RELATIONS_1, names=NAMES)
+        self.assertEqual(self.dump_database(hashes=False), row_by_row)
+        self.assertEqual(versionMeta.objects.count(), len(RELEASE_1))
+
+
+class RecordReaderTestCase(LoadDataMixin, SimpleTestCase):
+
+    def test_iter_records(self):
+        rows = RELEASE_1[:4] + [metadata_row("0310Tabari.Tarikh.Sham06-ara1", tok_length="", char_length="")]
+        write_metadata(self.path("metadata.csv"), rows)
+        records = iter_records(self.path("metadata.csv"))
+        # the file is read one row at a time:
+        record = next(records)
+        self.assertIsInstance(record, MetadataRecord)
+        self.assertEqual(record.version_uri, "0150AbuHanifa.Wasiyya.Sham01-ara1")
+        self.assertEqual((record.author_uri, record.text_uri, record.version_id),
+                         ("0150AbuHanifa", "0150AbuHanifa.Wasiyya", "Sham01"))
+        self.assertEqual((record.tok_length, record.char_length), (1000, 5000))
+        self.assertEqual((record.version_lang, record.annotation_status, record.type),
+                         ("ara", "completed", "book"))
+        records = list(records)
+        self.assertEqual(len(records), 4)
+        self.assertEqual((records[-1].tok_length, records[-1].char_length), (0, 0))
+        # (a resumed load skips the rows that were already loaded):
+        self.assertEqual([r.version_id for r in iter_records(self.path("metadata.csv"), skip=3)],
+                         ["Sham04", "Sham06"])
+        self.assertEqual([len(chunk) for chunk in iter_chunks(range(5), 2)], [2, 2, 1])
+
+    def test_workers(self):
+        rows = [metadata_row("0150AbuHanifa.Wasiyya.Sham{:03d}-ara1".format(i), i) for i in range(25)]
+        write_metadata(self.path("metadata.csv"), rows)
+        records = list(iter_records(self.path("metadata.csv")))
+        # the worker processes convert chunks of rows, the records keep the order of the file:
+        self.assertEqual(list(iter_records(self.path("metadata.csv"), workers=2, chunk_size=4)), records)
+        self.assertEqual(list(iter_records(self.path("metadata.csv"), workers=2, chunk_size=4, skip=10)),
+                         records[10:])
+
+    def test_iter_json_items(self):
+        data = {
+            "0255Jahiz.Hayawan": [relation("0255Jahiz.Hayawan", "0310Tabari.Tarikh")],
+            "0310Tabari": {"AR": {"shuhra": "الطبري", "ism": "محمد \\ \"بن\" جرير"}},
+            "numbers": [123456789, -1.5e-10, 0, True, False, None],
+            "empty": [{}, [], ""],
+        }
+        write_json(self.path("data.json"), data)
+        items = list(data.items())
+        # the values are split across the blocks of the file at every possible position:
+        for block_size in range(1, 12):
+            self.assertEqual(list(iter_json_items(self.path("data.json"), block_size)), items)
+        self.assertEqual(list(iter_json_items(self.path("data.json"))), items)
+        with open(self.path("empty.json"), "w") as f:
+            f.write(" {\n} ")
+        self.assertEqual(list(iter_json_items(self.path("empty.json"), 1)), [])
+        with open(self.path("invalid.json"), "w") as f:
+            f.write('{"a": 1 "b": 2}')
+        with self.assertRaises(ValueError):
+            list(iter_json_items(self.path("invalid.json"), 2))
+
+    def test_compressed_input(self):
+        rows = RELEASE_1[:4]
+        write_metadata(self.path("metadata.csv"), rows)
+        records = list(iter_records(self.path("metadata.csv")))
+        data = {"0150AbuHanifa": name_elements("أبو حنيفة")}
+        for ext in COMPRESSED_OPENERS:
+            # (the files are decompressed while they are read)
+            write_metadata(self.path("metadata.csv" + ext), rows)
+            self.assertEqual(list(iter_records(self.path("metadata.csv" + ext))), records)
+            write_json(self.path("names.json" + ext), data)
+            self.assertEqual(list(iter_json_items(self.path("names.json" + ext), 5)), list(data.items()))
+
+
+class BookRelationsTestCase(LoadDataMixin, TestCase):
+
+    def test_load_book_relations(self):
+        self.load_data2("--bulk", rows=RELEASE_1, names=NAMES)
+        relations = dict(RELATIONS_1, **{
+            "0255Jahiz.Hayawan": [relation("0255Jahiz.Hayawan", "0200Unknown", "BIO"),
+                                  relation("0255Jahiz.Hayawan", "0999Missing.Book")],
+        })
+        write_json(self.path("relations.json"), relations)
+        with contextlib.redirect_stdout(io.StringIO()):
+            counts = load_book_relations(self.path("relations.json"), batch_size=2)
+        # 4 relations (the relation with an unknown book is skipped), the types COMM, SHARH and BIO,
+        # and the person 0200Unknown, which is not in the metadata:
+        self.assertEqual(counts, dict(created=4, types=3, persons=1, deleted=0))
+        self.assertTrue(authorMeta.objects.filter(author_uri="0200Unknown").exists())
+        sharh = relationType.objects.get(name="SHARH")
+        self.assertEqual([t.name for t in sharh.parent_type.all()], ["COMM"])
+        self.assertEqual(a2bRelation.objects.get(text_a_id__text_uri="0150AbuHanifa.Fiqh").relation_type, sharh)
+        self.assertEqual(a2bRelation.objects.get(person_b_id__author_uri="0200Unknown").text_a_id.text_uri,
+                         "0255Jahiz.Hayawan")
+        # loading the same file again creates nothing:
+        with contextlib.redirect_stdout(io.StringIO()):
+            counts = load_book_relations(self.path("relations.json"), batch_size=2)
+        self.assertEqual(counts, dict(created=0, types=0, persons=0, deleted=0))
+        self.assertEqual(a2bRelation.objects.count(), 4)
+
+
+STATS_HEADER = ["_T1", "_T2", "instances", "WM1_Total", "WM2_Total", "WM_B1inB2", "WM_B2inB1", "extra"]
+STATS_ROWS = [
+    ["Shamela0001-ara1", "JK0001-ara1", "12", "3400", "1200", "35.2941", "100", "x"],
+    ["Shamela0001-ara1", "JK0002-ara1", "1", "3400", "80", "0.005", "12.5", "x"],
+    ["Shamela0002-ara1", "JK0001-ara1", "", "", "", "", "", "x"],
+    ["JK0002-ara1", "JK0001-ara1", "7", "80", "1200", "99.999", "0.3333", "x"],
+    ["JK0003-ara1", "JK0001-ara1", "3", "90", "1200", "1.125", "2", "x"],
+]
+
+
+class StatsLoadTestCase(LoadDataMixin, TestCase):
+
+    @unittest.skipUnless(connection.vendor == "sqlite", "the indexes are dropped in SQLite")
+    def test_raw_equals_bulk_create(self):
+        indexes = get_stats_indexes()
+        self.assertTrue(indexes)
+        path = write_stats(self.path("stats.csv"))
+        self.load_stats_data(path, "--batch-size", "2")
+        stats = get_stats()
+        self.assertEqual(stats[0], ("Shamela0001-ara1", "JK0001-ara1", 12, 3400, 1200,
+                                    decimal.Decimal("35.29"), decimal.Decimal("100.00")))
+        self.assertEqual(stats[2], ("Shamela0002-ara1", "JK0001-ara1", None, None, None, None, None))
+        self.load_stats_data(path, "--batch-size", "2", "--raw")
+        self.assertEqual(get_stats(), stats)
+        # the indexes that were dropped for the load are rebuilt:
+        self.assertEqual(get_stats_indexes(), indexes)
+        self.assertFalse(IngestCheckpoint.objects.exists())
+
+
+class ShadowDatabaseTestCase(LoadDataMixin, SimpleTestCase):
+    # (Django keeps the in-memory test database open,
+    # so the shadow database functions are tested on database files of their own)
+
+    def query(self, path, sql):
+        with contextlib.closing(sqlite3.connect(path)) as db, db:
+            return db.execute(sql).fetchall()
+
+    def test_build_and_swap(self):
+        live_path = self.path("db.sqlite3")
+        self.query(live_path, "CREATE TABLE t (value TEXT)")
+        self.query(live_path, "INSERT INTO t VALUES ('old')")
+        shadow_path = build_shadow_database(live_path)
+        self.query(shadow_path, "UPDATE t SET value = 'new'")
+        # the live database is not changed until the swap:
+        self.assertEqual(self.query(live_path, "SELECT value FROM t"), [("old",)])
+        swap_database(shadow_path, live_path)
+        self.assertEqual(self.query(live_path, "SELECT value FROM t"), [("new",)])
+        self.assertFalse(os.path.exists(shadow_path))
+
+    def test_wal_database(self):
+        live_path = self.path("db.sqlite3")
+        self.query(live_path, "CREATE TABLE t (value TEXT)")
+        shadow_path = build_shadow_database(live_path)
+        open(live_path + "-wal", "w").close()
+        with self.assertRaises(CommandError):
+            swap_database(shadow_path, live_path)
+        self.assertTrue(os.path.exists(shadow_path))
+
+
+class CheckDuplicatesTestCase(LoadDataMixin, SimpleTestCase):
+
+    def test_fix_duplicate_ids(self):
+        rows = [
+            metadata_row("0150AbuHanifa.Wasiyya.Sham01-ara1"),
+            metadata_row("0150AbuHanifa.Fiqh.Sham011-ara1"),
+            metadata_row("0255Jahiz.Hayawan.Sham04-ara1", id="Sham01"),
+            metadata_row("0255Jahiz.Bayan.Sham05-ara1", id="Sham01", book=""),
+        ]
+        write_metadata(self.path("metadata.csv.gz"), rows)
+        write_json(self.path("relations.json"), {
+            "0150AbuHanifa.Fiqh": [relation("0150AbuHanifa.Fiqh", "0150AbuHanifa.Unknown")]})
+        write_json(self.path("names.json"), {"0150AbuHanifa": name_elements("أبو حنيفة")})
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            call_command("check_duplicate_version_ids", "--metadata", self.path("metadata.csv.gz"),
+                         "--relations", self.path("relations.json"),
+                         "--name-elements", self.path("names.json"), "--fix", self.path("fixed.csv"))
+        output = stdout.getvalue()
+        self.assertIn("duplicate version ids: 2", output)
+        self.assertIn("orphan text URIs: 1", output)
+        self.assertIn("authors missing from the name elements file: 1", output)
+        self.assertIn("relations pointing at unknown URIs: 1", output)
+        # the first row with an id keeps it, the others get the first unused number:
+        fixed = [record.version_id for record in iter_records(self.path("fixed.csv"))]
+        self.assertEqual(fixed, ["Sham01", "Sham011", "Sham012", "Sham013"])
+        self.assertEqual([r.version_uri for r in iter_records(self.path("fixed.csv"))],
+                         [row["versionUri"] for row in rows])
+
+
+class ResumeTestCase(LoadDataMixin, TestCase):
+    """Simulate a crash in the middle of a load, and resume it"""
+
+    def crash_after(self, n_calls, func):
+        """Return a wrapper of func that raises an error on call n_calls + 1"""
+        calls = []
+
+        def wrapper(*args, **kwargs):
+            calls.append(1)
+            if len(calls) > n_calls:
+                raise RuntimeError("crash")
+            return func(*args, **kwargs)
+        return wrapper
+
+    def test_resume_bulk_load(self):
+        rows = RELEASE_1 + RELEASE_2[3:]
+        self.load_data2("--bulk", rows=rows, relations=RELATIONS_1, names=NAMES)
+        expected = self.dump_database()
+        with mock.patch.object(MetadataWriter, "write", self.crash_after(2, MetadataWriter.write)):
+            with self.assertRaises(RuntimeError):
+                self.load_data2("--bulk", "--batch-size", "3", rows=rows, relations=RELATIONS_1, names=NAMES)
+        # the first 2 batches were committed:
+        self.assertEqual(IngestCheckpoint.objects.get(command="load_data2").offset, 6)
+        self.load_data2("--bulk", "--batch-size", "3", "--resume", rows=rows, relations=RELATIONS_1, names=NAMES)
+        self.assertEqual(self.dump_database(), expected)
+        self.assertFalse(IngestCheckpoint.objects.exists())
+        # there is nothing left to resume:
+        with self.assertRaises(CommandError):
+            self.load_data2("--bulk", "--resume", rows=rows, relations=RELATIONS_1, names=NAMES)
+
+    def test_resume_stats_load(self):
+        path = write_stats(self.path("stats.csv"))
+        indexes = get_stats_indexes()
+        self.load_stats_data(path, "--batch-size", "2")
+        expected = get_stats()
+
+        original = load_stats_data_command.iter_stats_rows
+
+        def iter_stats_rows(*args, **kwargs):
+            # the file is read in chunks of 2 rows, the third chunk crashes:
+            return map(self.crash_after(2, lambda chunk: chunk), original(*args, **kwargs))
+        with mock.patch.object(load_stats_data_command, "iter_stats_rows", iter_stats_rows):
+            with self.assertRaises(RuntimeError):
+                self.load_stats_data(path, "--batch-size", "2")
+        self.assertEqual(IngestCheckpoint.objects.get(command="load_stats_data").offset, 4)
+        self.assertEqual(get_stats(), expected[:4])
+        self.load_stats_data(path, "--batch-size", "2", "--resume")
+        self.assertEqual(get_stats(), expected)
+        # the indexes that were dropped by the crashed load are rebuilt:
+        self.assertEqual(get_stats_indexes(), indexes)
+        self.assertFalse(IngestCheckpoint.objects.exists())
+
+    def test_restart_crashed_stats_load(self):
+        path = write_stats(self.path("stats.csv"))
+        indexes = get_stats_indexes()
+        original = load_stats_data_command.iter_stats_rows
+
+        def iter_stats_rows(*args, **kwargs):
+            return map(self.crash_after(1, lambda chunk: chunk), original(*args, **kwargs))
+        with mock.patch.object(load_stats_data_command, "iter_stats_rows", iter_stats_rows):
+            with self.assertRaises(RuntimeError):
+                self.load_stats_data(path, "--batch-size", "2")
+        self.assertEqual(get_stats_indexes(), [])
+        # a new load (without --resume) rebuilds the indexes that the crashed load dropped:
+        self.load_stats_data(path, "--batch-size", "2")
+        self.assertEqual(get_stats_indexes(), indexes)
+        self.assertEqual(len(get_stats()), len(STATS_ROWS))
+        self.assertFalse(IngestCheckpoint.objects.exists())
@@ -4,6 +4,8 @@ from . import views
 urlpatterns = [
     path('', views.apiOverview, name='api-overview'),
     path('corpusinsights/', views.getCorpusInsights, name='corpusinsights'),
+    path('top-books/', views.getTopBooks, name='top-books'),
+    path('facets/', views.getFacets, name='facets'),
     path('author/', views.authorListView.as_view(), name='author-list-all'),
     path('author/all/', views.authorListView.as_view(), name='author-list-all'),
     path('author/<str:author_uri>/', views.getAuthor, name='author'),
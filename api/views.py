@@ -8,11 +8,18 @@ from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination
 from django_filters import rest_framework as django_filters
 from rest_framework import filters
+from django.db.models import Prefetch
 
 
-from .models import authorMeta, personName, textMeta, versionMeta, CorpusInsights,TextReuseStats, a2bRelation
-from .serializers import TextSerializer,VersionMetaSerializer,personNameSerializer,AuthorMetaSerializer, TextReuseStatsSerializer, CorpusInsightsSerializer,AllRelationSerializer
-from .filters import authorFilter, versionFilter, textFilter,textReuseFilter
+from .models import authorMeta, personName, textMeta, versionMeta, CorpusInsights,TextReuseStats, a2bRelation, placeMeta, relationType
+from .serializers import TextSerializer,VersionMetaSerializer,personNameSerializer,AuthorMetaSerializer, TextReuseStatsSerializer, CorpusInsightsSerializer,AllRelationSerializer, CompactRelationSerializer
+from .filters import authorFilter, versionFilter, textFilter,textReuseFilter, relationFilter
+from .insights import query_top_books, TOP_K, MAX_TOP_K, TOP_BOOKS_PER
+from .facets import get_facet_counts
+from .search import IndexSearchFilter, SEARCH_FIELDS
+from .pagination import CustomPagination
+from .sparse_fields import SparseFieldsMixin
+from .caching import cache_response, CachedResponseMixin
 
 @api_view(['GET'])
 def apiOverview(request):
@@ -29,6 +36,9 @@ def apiOverview(request):
         'Search texts:': 'text/all/?search= e.g., `text/all/?search=الجاحظ Hayawan`',
         'List all text versions:': 'version/all/',
         'Search text versions:': 'text/all/?search= e.g., `text/all/?search=الجاحظ Hayawan Shamela`',
+        'Largest books (per text or per author):': 'top-books/?k=&per= e.g., `top-books/?k=20&per=author`',
+        'List all relations (paginated):': 'relations/all/?relation_type=&uri=&compact= e.g., `relations/all/?relation_type=sharh&compact=true`',
+        'Count versions per century, status, language, text type, tag, ...:': 'facets/?<version filters> e.g., `facets/?died_before_AH=500&status=pri`',
     }
 
     return Response(api_urls)
@@ -42,6 +52,7 @@ def bookList(request):
 
 ## Get a text by its text_uri
 @api_view(['GET'])
+@cache_response('details')
 def getText(request, text_uri):
     
     try:
@@ -53,6 +64,7 @@ def getText(request, text_uri):
 
 ## Get a text version by its version_id
 @api_view(['GET'])
+@cache_response('details')
 def getVersion(request, version_id):
     
     try:
@@ -64,6 +76,7 @@ def getVersion(request, version_id):
 
 ## Get an author record by its author_uri
 @api_view(['GET'])
+@cache_response('details')
 def getAuthor(request, author_uri):
     
     try:
@@ -76,6 +89,7 @@ def getAuthor(request, author_uri):
 
 ## Get some aggregated stats on the corpus like authors no, book no. etc.
 @api_view(['GET'])
+@cache_response('corpusinsights')
 def getCorpusInsights(request):
     corpus_insight_stats = CorpusInsights.objects.all()
     
@@ -89,6 +103,42 @@ def getCorpusInsights(request):
     return Response(serializer.data)
 
 
+## Get the largest version of the K largest texts or authors
+## (k: number of books, default 10; per: "text" (default) or "author")
+@api_view(['GET'])
+@cache_response('top-books')
+def getTopBooks(request):
+    per = request.query_params.get("per", "text")
+    if per not in TOP_BOOKS_PER:
+        return Response({"error": "per must be one of: " + ", ".join(TOP_BOOKS_PER)},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        k = int(request.query_params.get("k", TOP_K))
+    except ValueError:
+        k = 0
+    if not 1 <= k <= MAX_TOP_K:
+        return Response({"error": "k must be a number between 1 and {}".format(MAX_TOP_K)},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    top_books = query_top_books(k, per)
+    results = [dict({per + "_uri": uri}, **book) for uri, book in top_books.items()]
+    return Response(results)
+
+
+## Count the versions per facet (century, status, annotation_status, version_lang, text_type, tags)
+## for the same filters as version/all/ (e.g. facets/?died_before_AH=500&status=pri)
+@api_view(['GET'])
+@cache_response('facets')
+def getFacets(request):
+    version_filter = versionFilter(request.query_params, queryset=versionMeta.objects.all())
+    if not version_filter.is_valid():
+        return Response(version_filter.errors, status=status.HTTP_400_BAD_REQUEST)
+    # only restrict the counts to the filtered versions if any filter is used:
+    if any(value not in (None, "", []) for value in version_filter.form.cleaned_data.values()):
+        return Response(get_facet_counts(version_filter.qs))
+    return Response(get_facet_counts())
+
+
 
 ## Remove this before going live as we shouldn't allow any POST method      
 @api_view(['POST'])
@@ -100,64 +150,92 @@ def bookCreate(request):
 
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-'''' Get all books by pagination, filter and search enable. we can select fields also.
-Example: /book/all/?fields=book_id or /book/all/?search=JK000001 or book/all/?fields=book_id&search=JK000001
-'''
-class CustomPagination(PageNumberPagination):
-        page_size = 10
-        page_size_query_param = 'page_size'
-        max_page_size = 200
-        last_page_strings = ('the_end',)
-        
-        def get_paginated_response(self, data):
-       
-            return Response({
-                'links': {
-                    'next': self.get_next_link(),
-                    'previous': self.get_previous_link()
-                },
-                'page_size': self.page.paginator.per_page,
-                'has_pages': self.page.has_next(),
-                'count': self.page.paginator.count,
-                'pages': self.page.paginator.num_pages,
-                'results': data
-            })
-
-# fields to be excluded from search (because they are not string fields):
-#excl_flds = ["id", "date", "authorDateAH", "authorDateCE", "tok_length", "char_length",  # numeric fields
-#             "text", "personName", "version", "author_id", "version_id", "text_id"]      # foreign key fields
-excl_flds = [
-    # numeric fields:
-    "id", "date", "authorDateAH", "authorDateCE", "tok_length", "char_length",
-    # foreign key fields:
-    "text", "personName", "version", "author_id", "version_id", "text_id", 
-    "related_persons", "related_places", "related_texts", "place_relations", 
-    "person_a_id", "person_b_id", "text_a_id", "text_b_id", 
-    "place_a_id", "place_b_id", "relation_type", "parent_type",
-    # related fields:
-    'authormeta', 'textmeta', 'related_person_a', 'related_person_b',
-    "related_text_a", "related_text_b"]
-
-class authorListView(generics.ListAPIView):
+class TwoPhaseListMixin:
+    """Run the filtered list queries in two phases:
+
+    1. look up only the (distinct) primary keys of the filtered and ordered
+       objects, and count and paginate these;
+    2. load the objects of the page (by primary key) with the prefetch plan
+       of the view queryset, and serialize them.
+
+    The filters on one-to-many relations (e.g., the name filters) and the search
+    join several tables, which multiplies the rows; in the first phase only the
+    primary key (and the ordering columns) have to be de-duplicated,
+    instead of all columns of the joined tables.
+
+    If the queryset has nothing to join or prefetch (e.g., because only
+    a few columns were requested with ?fields=, see api/sparse_fields.py),
+    the objects of the page are loaded right away, in one query."""
+
+    def get_distinct(self, queryset):
+        """Return the distinct rows of a filtered queryset, in a consistent order"""
+        if len(queryset.query.alias_map) > 1:
+            # the filters joined other tables, which may have multiplied the rows:
+            queryset = queryset.distinct()
+        if not queryset.ordered:
+            # paginating unordered rows gives inconsistent pages:
+            queryset = queryset.order_by("pk")
+        return queryset
+
+    def get_ids(self, queryset):
+        """Return the distinct primary keys of a filtered queryset"""
+        return self.get_distinct(queryset.values_list("pk", flat=True))
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if not queryset._prefetch_related_lookups and not queryset.query.select_related:
+            rows = self.get_distinct(queryset)
+            page = self.paginate_queryset(rows)
+            if page is None:
+                page = list(rows)
+        else:
+            ids = self.get_ids(queryset)
+            page = self.paginate_queryset(ids)
+            if page is None:
+                page = list(ids)
+            objs = self.get_queryset().in_bulk(page)
+            page = [objs[pk] for pk in page if pk in objs]
+        serializer = self.get_serializer(page, many=True)
+        if self.paginator is None:
+            return Response(serializer.data)
+        return self.get_paginated_response(serializer.data)
+
+
+class authorListView(CachedResponseMixin, SparseFieldsMixin, TwoPhaseListMixin, generics.ListAPIView):
     """
     Return a paginated list of author metadata objects
     (each containing metadata on an author, his texts and versions of his texts)
     """
-    queryset = authorMeta.objects.all()
+    # AuthorMetaSerializer nests the texts of the author (with their versions,
+    # related texts and related persons) and the names of the author.
+    # Fetch all of these for the whole page in one query per relation
+    # (instead of several queries per author), so that the number of queries
+    # does not depend on the page size:
+    queryset = authorMeta.objects.prefetch_related(
+        "personNames",
+        Prefetch("texts", queryset=textMeta.objects.prefetch_related(
+            "versions",
+            # the related texts and persons are serialized with all their fields,
+            # including their own many-to-many relations:
+            Prefetch("related_texts", queryset=textMeta.objects.prefetch_related(
+                "related_texts", "related_persons", "related_places")),
+            Prefetch("related_persons", queryset=authorMeta.objects.prefetch_related(
+                "related_persons", "related_places")),
+        )),
+    )
     serializer_class = AuthorMetaSerializer 
     pagination_class = CustomPagination
+    cache_endpoint = 'lists'  # see RESPONSE_CACHE_TIMEOUTS in kitab/settings.py
 
     # customize the search: 
     
 
-    search_fields = [field.name for field in authorMeta._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["text__"+ field.name for field in textMeta._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["text__version__"+ field.name for field in versionMeta._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["personName__"+ field.name for field in personName._meta.get_fields() if (field.name not in excl_flds)]
+    # the search fields are defined in api/search.py,
+    # the search terms are looked up in the search index of the authors:
+    search_fields = SEARCH_FIELDS["author"]
+    search_index = "author"
     print("AUTHOR SEARCH FIELDS:")
     print(search_fields)
-    # NB: excl_flds needs to be declared outside of the class for the list comprehension to work, 
-    # otherwise you get a NameError; see https://stackoverflow.com/a/13913933
     # print()
     # print("Search fields:")
     # print(search_fields)
@@ -166,7 +244,7 @@ class authorListView(generics.ListAPIView):
 
     # Customize filtering:
     
-    filter_backends = (django_filters.DjangoFilterBackend,filters.SearchFilter,filters.OrderingFilter)    
+    filter_backends = (django_filters.DjangoFilterBackend,IndexSearchFilter,filters.OrderingFilter)    
     filterset_class = authorFilter
 
     # old experiments with filters by Sohail:
@@ -187,20 +265,40 @@ class authorListView(generics.ListAPIView):
 
 
 
-class versionListView(generics.ListAPIView):
-    queryset = versionMeta.objects.all()
+class versionListView(CachedResponseMixin, SparseFieldsMixin, TwoPhaseListMixin, generics.ListAPIView):
+    # VersionMetaSerializer expands the text and author of every version (depth 3),
+    # including the related texts, persons and places of both.
+    # Join the text and author into the version query (select_related),
+    # and fetch the related objects for the whole page in one query per relation,
+    # so that the number of queries does not depend on the page size:
+    queryset = versionMeta.objects.select_related("text_id__author_id").prefetch_related(
+        Prefetch("text_id__author_id__related_persons", queryset=authorMeta.objects.prefetch_related(
+            "related_persons", "related_places")),
+        "text_id__author_id__related_places",
+        Prefetch("text_id__related_texts", queryset=textMeta.objects.select_related("author_id").prefetch_related(
+            "author_id__related_persons", "author_id__related_places",
+            Prefetch("related_texts", queryset=textMeta.objects.prefetch_related(
+                "related_texts", "related_persons", "related_places")),
+            Prefetch("related_persons", queryset=authorMeta.objects.prefetch_related(
+                "related_persons", "related_places")),
+            "related_places")),
+        Prefetch("text_id__related_persons", queryset=authorMeta.objects.prefetch_related(
+            Prefetch("related_persons", queryset=authorMeta.objects.prefetch_related(
+                "related_persons", "related_places")),
+            "related_places")),
+        "text_id__related_places",
+    )
     serializer_class = VersionMetaSerializer 
     pagination_class = CustomPagination
+    cache_endpoint = 'lists'
 
     #search_fields = [field.name for field in authorMeta._meta.get_fields() if(field.name not in ["text","author_names", 'date', 'authorDateAH', 'authorDateCE', 'id'])]+ \
     #["version__"+ field.name for field in textMeta._meta.get_fields() if(field.name not in ["version","id", 'authorMeta'])]\
     #+ ["text__version__"+ field.name for field in versionMeta._meta.get_fields() if(field.name not in ["id", 'textMeta','tok_length','char_length'])]\
     #+ ["author_names__"+ field.name for field in personName._meta.get_fields() if(field.name not in ["id", 'authorMeta'])]
     print("FEILD", versionMeta._meta.get_fields())
-    search_fields = [field.name for field in versionMeta._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["text_id__"+ field.name for field in textMeta._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["text_id__author_id__"+ field.name for field in authorMeta._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["text_id__author_id__personName__"+ field.name for field in personName._meta.get_fields() if (field.name not in excl_flds)]
+    search_fields = SEARCH_FIELDS["version"]
+    search_index = "version"
 
     print("VERSION SEARCH FIELDS:")
     print(search_fields)
@@ -208,20 +306,27 @@ class versionListView(generics.ListAPIView):
 
     # Customize filtering:
     
-    filter_backends = (django_filters.DjangoFilterBackend,filters.SearchFilter,filters.OrderingFilter)    
+    filter_backends = (django_filters.DjangoFilterBackend,IndexSearchFilter,filters.OrderingFilter)    
     filterset_class = versionFilter
 
 
     ordering_fields = ['text_id__title_lat', 'text_id__title_ar', "text_id__author_id__date", 'tok_length']
     ordering_fields = (ordering_fields)
 
-class textListView(generics.ListAPIView):
-    queryset = textMeta.objects.all()
+class textListView(CachedResponseMixin, SparseFieldsMixin, TwoPhaseListMixin, generics.ListAPIView):
+    # TextSerializer nests the versions, related texts and related persons of the text
+    # (including the many-to-many relations of the related texts and persons);
+    # fetch these for the whole page in one query per relation:
+    queryset = textMeta.objects.prefetch_related(
+        "versions",
+        Prefetch("related_texts", queryset=textMeta.objects.prefetch_related(
+            "related_texts", "related_persons", "related_places")),
+        Prefetch("related_persons", queryset=authorMeta.objects.prefetch_related(
+            "related_persons", "related_places")),
+    )
     #filter_fields = ['title_lat', 'book_id', 'title_ar', 'annotation_status']
-    search_fields = [field.name for field in textMeta._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["author_id__"+ field.name for field in authorMeta._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["author_id__personName__"+ field.name for field in personName._meta.get_fields() if (field.name not in excl_flds)] \
-        + ["version__"+ field.name for field in versionMeta._meta.get_fields() if (field.name not in excl_flds)]
+    search_fields = SEARCH_FIELDS["text"]
+    search_index = "text"
         
     #print(search_fields)
 
@@ -229,27 +334,81 @@ class textListView(generics.ListAPIView):
     #ordering_fields = ['title_lat', 'title_ar']
     serializer_class = TextSerializer 
     pagination_class = CustomPagination
-    filter_backends = (django_filters.DjangoFilterBackend,filters.SearchFilter,filters.OrderingFilter)    
+    cache_endpoint = 'lists'
+    filter_backends = (django_filters.DjangoFilterBackend,IndexSearchFilter,filters.OrderingFilter)    
     filterset_class = textFilter
     #filter_backends = (django_filters.DjangoFilterBackend,filters.SearchFilter,filters.OrderingFilter)    
     # search_fields = (search_fields)
     # filter_fields = (search_fields)
     #ordering_fields = (ordering_fields)
 
-class relationsListView(generics.ListAPIView):
-    queryset = a2bRelation.objects.all()
-    #for q in queryset:
-    #    print(q.text_a_id)
+# AllRelationSerializer expands the persons, texts and places on both sides
+# of a relation (depth 2), including their own many-to-many relations.
+# Prefetch these for the whole page (one query per relation),
+# the foreign keys themselves are joined into the relations query:
+RELATION_PREFETCHES = [
+    Prefetch("relation_type__parent_type", queryset=relationType.objects.prefetch_related("parent_type")),
+]
+for side in ("a", "b"):
+    RELATION_PREFETCHES += [
+        Prefetch("person_{}_id__related_persons".format(side), queryset=authorMeta.objects.prefetch_related(
+            "related_persons", "related_places")),
+        Prefetch("person_{}_id__related_places".format(side), queryset=placeMeta.objects.prefetch_related(
+            "place_relations")),
+        "text_{}_id__author_id__related_persons".format(side),
+        "text_{}_id__author_id__related_places".format(side),
+        Prefetch("text_{}_id__related_texts".format(side), queryset=textMeta.objects.prefetch_related(
+            "related_texts", "related_persons", "related_places")),
+        Prefetch("text_{}_id__related_persons".format(side), queryset=authorMeta.objects.prefetch_related(
+            "related_persons", "related_places")),
+        Prefetch("text_{}_id__related_places".format(side), queryset=placeMeta.objects.prefetch_related(
+            "place_relations")),
+        Prefetch("place_{}_id__place_relations".format(side), queryset=placeMeta.objects.prefetch_related(
+            "place_relations")),
+    ]
+
+
+class relationsListView(CachedResponseMixin, SparseFieldsMixin, generics.ListAPIView):
+    """
+    Return a paginated list of relations
+
+    Use ?compact=true to get the URIs of the related persons, texts and places
+    (and the name of the relation type) instead of the full nested objects
+    """
     serializer_class = AllRelationSerializer 
+    pagination_class = CustomPagination
+    cache_endpoint = 'relations'
+
+    filter_backends = (django_filters.DjangoFilterBackend, filters.OrderingFilter)
+    filterset_class = relationFilter
+    ordering_fields = ["id", "relation_type__name"]
+
+    def is_compact(self):
+        return self.request.query_params.get("compact", "").lower() in ("1", "true", "yes")
+
+    def get_serializer_class(self):
+        if self.is_compact():
+            return CompactRelationSerializer
+        return AllRelationSerializer
+
+    def get_queryset(self):
+        queryset = a2bRelation.objects.select_related(
+            "relation_type", "person_a_id", "person_b_id", "place_a_id", "place_b_id",
+            "text_a_id__author_id", "text_b_id__author_id").order_by("id")
+        if not self.is_compact():
+            queryset = queryset.prefetch_related(*RELATION_PREFETCHES)
+        # (only load the fields requested with ?fields= or ?omit=, see api/sparse_fields.py):
+        return self.get_sparse_queryset(queryset)
 
 ## Text Reuse Stats
 
-class getTextReuseStats(generics.ListAPIView):
+class getTextReuseStats(CachedResponseMixin, generics.ListAPIView):
     
     queryset = TextReuseStats.objects.all()
     serializer_class = TextReuseStatsSerializer 
     #serializer = TextReuseStatsSerializer(queryset, many=True)
     pagination_class = CustomPagination
+    cache_endpoint = 'text-reuse-stats'
     
 
     filter_backends = (django_filters.DjangoFilterBackend,filters.SearchFilter,filters.OrderingFilter)    
@@ -130,6 +130,42 @@ DATABASES = {
 }
 DATA_UPLOAD_MAX_NUMBER_FIELDS = None
 
+# Cache (used by the throttling and by the count cache of the paginated lists, see api/caching.py):
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # the data of the API responses (see api/caching.py);
+    # when it is full, the least recently used third of the entries is removed
+    # (at most MAX_ENTRIES * RESPONSE_CACHE_MAX_SIZE bytes, i.e. 256 MB per server process):
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+        'OPTIONS': {'MAX_ENTRIES': 500},
+    },
+}
+# number of seconds the counts of the paginated lists are cached
+# (they are not used anymore after the data was reloaded anyway):
+COUNT_CACHE_TIMEOUT = 60 * 60
+# number of seconds the responses of the endpoints are cached
+# (until the data is reloaded; endpoints that are not listed are not cached):
+RESPONSE_CACHE_TIMEOUTS = {
+    'corpusinsights': 24 * 60 * 60,
+    'top-books': 24 * 60 * 60,
+    'facets': 60 * 60,
+    'details': 60 * 60,  # author/<author_uri>/, text/<text_uri>/, version/<version_id>/
+    'lists': 10 * 60,  # author/all/, text/all/, version/all/
+    'relations': 10 * 60,
+    'text-reuse-stats': 10 * 60,
+}
+# number of seconds after which the server notices that the data was reloaded
+# (the load commands run in another process):
+RESPONSE_CACHE_GENERATION_TIMEOUT = 10
+# largest response (in bytes) that is cached; larger responses (e.g., list pages
+# with a large page_size) are computed again for every request:
+RESPONSE_CACHE_MAX_SIZE = 512 * 1024
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 